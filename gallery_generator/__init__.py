@@ -22,6 +22,7 @@ logger.info('This is {} v{}'.format(__name__, __version__))
 # config
 CONFIG_DIR_NAME = '.gallery'
 PAGE_DIR_NAME = 'pages'
+CACHE_DIR_NAME = 'cache'  # created on demand
 
 CONFIG_DIRS = [
     '{}'.format(CONFIG_DIR_NAME),  # dir itself
@@ -1,28 +1,68 @@
 import pathlib
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import Session
 
-from gallery_generator import CONFIG_DIR_NAME
+from gallery_generator import logger, CONFIG_DIR_NAME
 from gallery_generator.models import Base
 
+l_logger = logger.getChild('controllers.database')
+
 
 class GalleryDatabase:
 
     DATABASE_NAME = 'gallery.sqlite3'
+    BUSY_TIMEOUT = 60  # in seconds, how long a connection waits for the lock of another one (e.g., of a worker)
 
     def __init__(self, root: pathlib.Path):
         self.path = root / CONFIG_DIR_NAME / self.DATABASE_NAME
         self.db_file = 'sqlite:///{}'.format(self.path)
+        self.upgraded = False
 
     def exists(self) -> bool:
         return self.path.exists()
 
     def _engine(self):
-        return create_engine(self.db_file)
+        return create_engine(self.db_file, connect_args={'timeout': self.BUSY_TIMEOUT})
 
     def create_schema(self):
         Base.metadata.create_all(self._engine())
+        self.upgraded = True
+
+    def upgrade_schema(self):
+        """Bring the schema of a database created by a previous version up to date: create the missing tables, add
+        the missing columns (which are nullable, so that the existing rows get `NULL`) and the missing indexes.
+        Otherwise, the database must be created again, with `--init`.
+        """
+
+        engine = self._engine()
+        Base.metadata.create_all(engine)  # (only the missing tables)
+
+        inspector = inspect(engine)
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing = set(column['name'] for column in inspector.get_columns(table.name))
+
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+
+                    if column.primary_key or not column.nullable or column.unique:
+                        raise RuntimeError(
+                            'database `{}` is too old (`{}.{}` cannot be added), run `--init` to create it again'
+                            .format(self.path, table.name, column.name))
+
+                    l_logger.info('ADD COLUMN {}.{}'.format(table.name, column.name))
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(engine.dialect))))
+
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+        self.upgraded = True
 
     def make_session(self) -> Session:
+        if not self.upgraded and self.exists():
+            self.upgrade_schema()
+
         return Session(self._engine())
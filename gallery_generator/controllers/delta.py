@@ -0,0 +1,92 @@
+import hashlib
+import json
+import pathlib
+from typing import Dict, List
+
+from gallery_generator import logger, CONFIG_DIR_NAME
+from gallery_generator.controllers.output import OutputWriter
+
+l_logger = logger.getChild('controllers.delta')
+
+
+class OutputManifest:
+    """Record the size and the hash of every output file of a target, and compare them to the ones of the previous
+    build (in the same target), so that only what changed has to be deployed.
+
+    The hash of a file is only computed again if its size or its modification time changed.
+    """
+
+    MANIFEST_NAME = 'outputs.json'
+
+    def __init__(self, root: pathlib.Path, target: pathlib.Path):
+        self.path = root / CONFIG_DIR_NAME / self.MANIFEST_NAME
+        self.target = target
+
+        self.previous: Dict[str, dict] = {}
+        self.current: Dict[str, dict] = {}
+
+        self.added: List[str] = []
+        self.changed: List[str] = []
+        self.removed: List[str] = []
+
+    def load(self):
+        if self.path.exists():
+            with self.path.open() as f:
+                data = json.load(f)
+
+            # a manifest is only valid for the target it was built for
+            if data.get('target') == str(self.target.resolve()):
+                self.previous = data['files']
+
+    def save(self):
+        with self.path.open('w') as f:
+            json.dump(
+                {
+                    'target': str(self.target.resolve()),
+                    'files': self.current,
+                    'added': self.added,
+                    'changed': self.changed,
+                    'removed': self.removed
+                },
+                f, indent=0, sort_keys=True
+            )
+
+    def update(self, writer: OutputWriter):
+        """List the files written by `writer` (which is closed), and compare them to the previous ones
+        """
+
+        self.current = {}
+
+        for url, size, mtime, sha256 in writer.get_files():
+            previous = self.previous.get(url)
+
+            if sha256 is None:
+                if previous is not None and previous['size'] == size and previous['mtime'] == mtime:
+                    sha256 = previous['sha256']
+                else:
+                    sha256 = hashlib.sha256(writer.read_output(url)).hexdigest()
+
+            self.current[url] = {'size': size, 'mtime': mtime, 'sha256': sha256}
+
+        self.added = sorted(url for url in self.current if url not in self.previous)
+        self.changed = sorted(
+            url for url, file in self.current.items()
+            if url in self.previous and self.previous[url]['sha256'] != file['sha256']
+        )
+        self.removed = sorted(url for url in self.previous if url not in self.current)
+
+    def export_delta(self, writer: OutputWriter, directory: pathlib.Path):
+        """Copy the files which were added or changed in `directory`, together with `delta.json`, which lists them
+        and the ones to remove
+        """
+
+        directory_writer = OutputWriter(directory)
+
+        for url in self.added + self.changed:
+            directory_writer.write(url, writer.read_output(url))
+
+        directory_writer.write('delta.json', json.dumps(
+            {'added': self.added, 'changed': self.changed, 'removed': self.removed}, indent=0, sort_keys=True))
+
+        l_logger.info('{} file(s) exported in `{}`, {} to remove'.format(
+            len(self.added) + len(self.changed), directory, len(self.removed)))
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import pathlib
+from typing import Dict, Union, Callable
+
+from gallery_generator import CONFIG_DIR_NAME
+
+
+def digest(*inputs) -> str:
+    """Hash of `inputs`, through their JSON representation
+    """
+
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class DependencyManifest:
+    """Record the hash of the inputs of each output of the update phase, so that an output whose inputs did not
+    change since the previous run (in the same target) can be skipped.
+
+    It also records where the fingerprinted outputs actually are (e.g., `style.css` in `style.0123456789.css`).
+    """
+
+    MANIFEST_NAME = 'dependencies.json'
+
+    def __init__(self, root: pathlib.Path, target: pathlib.Path, exists: Callable[[str], bool] = None):
+        self.path = root / CONFIG_DIR_NAME / self.MANIFEST_NAME
+        self.target = target
+        self.exists = exists if exists is not None else lambda url: (target / url).exists()  # (in the target)
+
+        self.previous: Dict[str, str] = {}
+        self.current: Dict[str, str] = {}
+
+        self.previous_assets: Dict[str, str] = {}
+        self.assets: Dict[str, str] = {}
+
+    def load(self):
+        if self.path.exists():
+            with self.path.open() as f:
+                data = json.load(f)
+
+            # a manifest is only valid for the target it was built for
+            if data.get('target') == str(self.target.resolve()):
+                self.previous = data['outputs']
+                self.previous_assets = data.get('assets', {})
+
+    def save(self):
+        with self.path.open('w') as f:
+            json.dump(
+                {'target': str(self.target.resolve()), 'outputs': self.current, 'assets': self.assets},
+                f, indent=0, sort_keys=True
+            )
+
+    def is_up_to_date(self, url: Union[str, pathlib.Path], inputs_digest: str) -> bool:
+        """Record `inputs_digest` for `url`, and check if it is the same as during the previous run
+        """
+
+        url = str(url)
+        self.current[url] = inputs_digest
+
+        output_url = self.previous_assets.get(url, url)
+        if self.previous.get(url) == inputs_digest and self.exists(output_url):
+            if output_url != url:
+                self.assets[url] = output_url
+            return True
+
+        return False
+
+    def set_output_url(self, url: Union[str, pathlib.Path], output_url: Union[str, pathlib.Path]):
+        """Record that `url` was written in `output_url`"""
+
+        if str(output_url) != str(url):
+            self.assets[str(url)] = str(output_url)
+        else:
+            self.assets.pop(str(url), None)
+
+    def get_output_url(self, url: Union[str, pathlib.Path]) -> str:
+        return self.assets.get(str(url), str(url))
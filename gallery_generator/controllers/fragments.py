@@ -0,0 +1,66 @@
+from typing import Dict, List, Tuple, Callable
+
+from markupsafe import Markup
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from gallery_generator.models import PictureFragment
+
+
+class PictureFragmentCache:
+    """Rendered HTML of the pictures (which appear on several tag pages), under the digest of its inputs.
+
+    Fragments are kept in memory during the build and, if `session` is given, in the database for the next ones.
+    """
+
+    def __init__(self, session: Session = None):
+        self.session = session
+        self.fragments: Dict[int, Tuple[str, Markup]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, items: List[Tuple[int, str]], render: Callable[[int], str]) -> List[Markup]:
+        """Get the fragments of `items`, as `(picture_id, digest)`, calling `render(i)` for the `i`-th one if it is
+        not in the cache (or if its inputs changed)
+        """
+
+        missing = [picture_id for picture_id, d in items if self.fragments.get(picture_id, (None, ))[0] != d]
+
+        # look in the database
+        if missing and self.session is not None:
+            for picture_id, d, html in self.session.execute(
+                    select(PictureFragment.picture_id, PictureFragment.digest, PictureFragment.html)
+                    .where(PictureFragment.picture_id.in_(missing))):
+                self.fragments[picture_id] = d, Markup(html)
+
+        fragments = []
+        rendered = []
+
+        for i, (picture_id, d) in enumerate(items):
+            fragment_digest, fragment = self.fragments.get(picture_id, (None, None))
+
+            if fragment_digest != d:
+                fragment = Markup(render(i))
+                self.fragments[picture_id] = d, fragment
+                rendered.append(dict(picture_id=picture_id, digest=d, html=str(fragment)))
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            fragments.append(fragment)
+
+        # keep the new ones
+        if rendered and self.session is not None:
+            query = insert(PictureFragment)
+            self.session.execute(
+                query.on_conflict_do_update(
+                    index_elements=[PictureFragment.picture_id],
+                    set_=dict(digest=query.excluded.digest, html=query.excluded.html)
+                ),
+                rendered
+            )
+            self.session.commit()
+
+        return fragments
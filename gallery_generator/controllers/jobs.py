@@ -0,0 +1,241 @@
+import datetime
+import os
+import socket
+import time
+import uuid
+from typing import Iterable, Tuple, List, Dict, Any
+
+from sqlalchemy import select, update, delete, func, or_, and_, case
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from gallery_generator import logger
+from gallery_generator.controllers.thumbnails import Thumbnailer
+from gallery_generator.models import Picture, ThumbnailJob
+from gallery_generator.snapshot import PictureRecord
+
+l_logger = logger.getChild('controllers.jobs')
+
+
+class ThumbnailJobQueue:
+    """Queue of the thumbnails to create, stored in the database (in `thumbnail_job`), so that it is shared by the
+    workers (which may be other processes) and survives them.
+
+    A worker claims a batch of jobs for `lease` seconds. If it does not finish them in time (e.g., because it crashed),
+    they can be claimed by another one, unless they were already attempted `max_attempts` times. A job which fails is
+    quarantined, with its error, and so is its picture, unless the type is one of the `optional_types` (then, the
+    picture is shown without it). Quarantined jobs are attempted again when their picture changes (or see `retry()`).
+    """
+
+    BATCH_SIZE = 8
+    LEASE = 600  # in seconds
+    MAX_ATTEMPTS = 3
+    CHUNK_SIZE = 500  # jobs inserted at once
+
+    def __init__(
+        self,
+        session: Session,
+        worker: str = None,
+        batch_size: int = BATCH_SIZE,
+        lease: int = LEASE,
+        max_attempts: int = MAX_ATTEMPTS,
+        optional_types: Iterable[str] = ()
+    ):
+        self.session = session
+        self.worker = worker if worker is not None else '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.optional_types = tuple(optional_types)
+
+    def _quarantine(self, **values) -> dict:
+        """The values of a job which failed, depending on whether its type is optional"""
+
+        return dict(
+            state=case(
+                (ThumbnailJob.type.in_(self.optional_types), ThumbnailJob.SKIPPED), else_=ThumbnailJob.FAILED),
+            picture_modified=select(Picture.date_obj_modified)
+            .where(Picture.id == ThumbnailJob.picture_id)
+            .scalar_subquery(),
+            **values
+        )
+
+    def retry(self, changed_only: bool = False):
+        """Attempt the quarantined jobs again (only the ones whose picture changed since, if `changed_only`)
+        """
+
+        query = update(ThumbnailJob)\
+            .where(ThumbnailJob.state.in_([ThumbnailJob.FAILED, ThumbnailJob.SKIPPED]))\
+            .values(state=ThumbnailJob.PENDING, attempts=0, worker=None, error=None)\
+            .execution_options(synchronize_session=False)
+
+        if changed_only:
+            query = query.where(
+                ThumbnailJob.picture_modified != select(Picture.date_obj_modified)
+                .where(Picture.id == ThumbnailJob.picture_id)
+                .scalar_subquery()
+            )
+
+        self.session.execute(query)
+        self.session.commit()
+
+    def _insert(self, values: List[dict]):
+        # a job which is done is pending again (its thumbnails are missing again), a quarantined one is left as is
+        query = insert(ThumbnailJob)
+        query = query.on_conflict_do_update(
+            index_elements=[ThumbnailJob.picture_id, ThumbnailJob.type],
+            set_=dict(state=ThumbnailJob.PENDING, attempts=0, priority=query.excluded.priority),
+            where=or_(ThumbnailJob.state == ThumbnailJob.PENDING, ThumbnailJob.state == ThumbnailJob.DONE)
+        )
+
+        self.session.execute(query, values)
+
+    def clean(self):
+        """Remove the jobs of the pictures which were removed, and attempt the quarantined ones whose picture changed
+        again (which goes through the whole queue, so see `add()` to add jobs many times)
+        """
+
+        self.session.execute(
+            delete(ThumbnailJob)
+            .where(ThumbnailJob.picture_id.notin_(select(Picture.id)))
+            .execution_options(synchronize_session=False)
+        )
+
+        self.retry(changed_only=True)
+
+    def enqueue(self, jobs: Iterable[Tuple[int, str, int]]):
+        """Add the jobs `(picture_id, type, priority)`, if they are not in the queue yet (or update their priority),
+        after cleaning the queue
+        """
+
+        self.clean()
+        self.add(jobs)
+
+    def add(self, jobs: Iterable[Tuple[int, str, int]]):
+        """Add the jobs `(picture_id, type, priority)`, as `enqueue()`, but without cleaning the queue"""
+
+        values = []
+        for picture_id, ttype, priority in jobs:
+            values.append(
+                dict(picture_id=picture_id, type=ttype, state=ThumbnailJob.PENDING, attempts=0, priority=priority))
+            if len(values) >= self.CHUNK_SIZE:
+                self._insert(values)
+                values = []
+
+        if values:
+            self._insert(values)
+
+        self.session.commit()
+
+    def claim(self) -> List[Any]:
+        """Claim a batch of jobs (as rows of `thumbnail_job`), which may be empty if there is no job left
+        """
+
+        now = datetime.datetime.now()
+        expired = and_(ThumbnailJob.state == ThumbnailJob.CLAIMED, ThumbnailJob.lease_expires < now)
+
+        # the jobs which were attempted too many times (e.g., the picture makes the workers crash) are quarantined
+        self.session.execute(
+            update(ThumbnailJob)
+            .where(expired, ThumbnailJob.attempts >= self.max_attempts)
+            .values(**self._quarantine(error='abandoned after {} attempts'.format(self.max_attempts)))
+            .execution_options(synchronize_session=False)
+        )
+
+        # (a single statement, so two workers cannot claim the same job)
+        token = '{}/{}'.format(self.worker, uuid.uuid4().hex[:8])
+        claimable = select(ThumbnailJob.id)\
+            .where(or_(ThumbnailJob.state == ThumbnailJob.PENDING, expired))\
+            .order_by(ThumbnailJob.priority, ThumbnailJob.id)\
+            .limit(self.batch_size)
+
+        self.session.execute(
+            update(ThumbnailJob)
+            .where(ThumbnailJob.id.in_(claimable.scalar_subquery()))
+            .values(
+                state=ThumbnailJob.CLAIMED,
+                worker=token,
+                lease_expires=now + datetime.timedelta(seconds=self.lease),
+                attempts=ThumbnailJob.attempts + 1
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        self.session.commit()
+
+        return self.session.execute(
+            select(ThumbnailJob.id, ThumbnailJob.picture_id, ThumbnailJob.type, ThumbnailJob.worker)
+            .where(ThumbnailJob.worker == token, ThumbnailJob.state == ThumbnailJob.CLAIMED)
+            .order_by(ThumbnailJob.priority, ThumbnailJob.id)
+        ).all()
+
+    def _finish(self, job: Any, **values):
+        # (unless it was claimed by another worker in the meantime)
+        self.session.execute(
+            update(ThumbnailJob)
+            .where(ThumbnailJob.id == job.id, ThumbnailJob.worker == job.worker)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+        self.session.commit()
+
+    def complete(self, job: Any):
+        """Mark `job` as done, committing the thumbnails it created at the same time"""
+
+        self._finish(job, state=ThumbnailJob.DONE, error=None)
+
+    def release(self, job: Any):
+        """Give `job` back, without attempting it"""
+
+        self._finish(job, state=ThumbnailJob.PENDING, worker=None, attempts=ThumbnailJob.attempts - 1)
+
+    def fail(self, job: Any, error: Exception):
+        self._finish(job, **self._quarantine(error='{}: {}'.format(type(error).__name__, error)))
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per state"""
+
+        return dict(
+            self.session.execute(select(ThumbnailJob.state, func.count()).group_by(ThumbnailJob.state)).all())
+
+
+def run_jobs(queue: ThumbnailJobQueue, thumbnailer: Thumbnailer, deadline: float = None) -> Tuple[int, int]:
+    """Claim and run jobs of `queue` with `thumbnailer`, until there is no job left (or until `deadline`, as given
+    by `time.monotonic()`). Return the number of jobs which were done and failed.
+    """
+
+    done, failed = 0, 0
+
+    while deadline is None or time.monotonic() < deadline:
+        jobs = queue.claim()
+        if not jobs:
+            break
+
+        pictures = dict(
+            (row.id, PictureRecord(*row)) for row in queue.session.execute(
+                select(*PictureRecord.columns()).where(Picture.id.in_(set(job.picture_id for job in jobs))))
+        )
+
+        for job in jobs:
+            if deadline is not None and time.monotonic() >= deadline:
+                queue.release(job)
+                continue
+
+            picture = pictures.get(job.picture_id)
+
+            try:
+                if picture is not None:  # (otherwise, it was removed)
+                    thumbnailer.refresh(picture)
+                    thumbnailer.create_missing(picture, [job.type], commit=False)  # (see `complete()`)
+            except Exception as e:
+                queue.session.rollback()
+                l_logger.warning('{} {} ({}): {}'.format(
+                    'SKIP' if job.type in queue.optional_types else 'QUARANTINE', picture.path, job.type, e))
+                queue.fail(job, e)
+                failed += 1
+            else:
+                queue.complete(job)
+                done += 1
+
+    return done, failed
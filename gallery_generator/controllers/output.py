@@ -0,0 +1,412 @@
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import shutil
+import tarfile
+import time
+import zipfile
+from typing import List, Union, Iterator, Tuple, Callable, Dict, Any, Optional
+
+from gallery_generator import logger
+
+try:
+    import brotli
+except ImportError:  # optional
+    brotli = None
+
+
+l_logger = logger.getChild('controllers.output')
+
+
+def fingerprint(url: Union[str, pathlib.Path], content: bytes) -> pathlib.Path:
+    """Put (the beginning of) the hash of `content` in `url`, before its extension: `style.css` becomes, e.g.,
+    `style.0123456789.css`. Such an output never changes, so it can be cached forever.
+    """
+
+    url = pathlib.Path(url)
+    return url.with_name('{}.{}{}'.format(url.stem, hashlib.sha256(content).hexdigest()[:10], url.suffix))
+
+
+class OutputWriter:
+    """Write the outputs in the target directory.
+
+    An output is only written if its content differs from the one of the existing file (if any).
+    It is first written in a temporary file, which is then renamed, so that a file is never half-written.
+
+    With `precompress`, text outputs also get a `.gz` (and a `.br`, if `brotli` is available) sibling, at maximum
+    compression, so that the server does not have to compress them. Siblings are only written with their output (or
+    if they are missing).
+
+    A writer is also a context manager, which finishes the outputs (see `close()`) unless there was an error.
+    """
+
+    COMPRESSED_SUFFIXES = ('.html', '.css', '.js', '.json', '.xml', '.dzi', '.txt', '.svg')
+
+    SHARED = True  # other writers (e.g., in other processes) can write in the same target at the same time
+
+    def __init__(self, target: pathlib.Path, precompress: bool = False):
+        self.target = target
+        self.precompress = precompress
+        self.changed: List[str] = []
+
+    def __enter__(self) -> 'OutputWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        """Finish the outputs"""
+
+    def abort(self):
+        """Give up the outputs which are not finished"""
+
+    def release(self):
+        """Release what was opened to read the outputs, once the writer is closed (see `get_files()`)"""
+
+    def exists(self, url: Union[str, pathlib.Path]) -> bool:
+        return (self.target / url).exists()
+
+    def get_files(self) -> Iterator[Tuple[str, int, Optional[int], Optional[str]]]:
+        """Every file of the target (once the writer is closed), as `(url, size, mtime, sha256)`, the hash being
+        `None` if it is not known without reading the file
+        """
+
+        for path in sorted(self.target.glob('**/*')):
+            if path.is_file() and not (path.name.startswith('.') and path.suffix == '.tmp'):  # (being written)
+                stat = path.stat()
+                yield path.relative_to(self.target).as_posix(), stat.st_size, stat.st_mtime_ns, None
+
+    def read_output(self, url: Union[str, pathlib.Path]) -> bytes:
+        with (self.target / url).open('rb') as f:
+            return f.read()
+
+    def is_identical(self, path: pathlib.Path, content: bytes) -> bool:
+        """Check if `path` exists and contains `content` (size first, then content)
+        """
+
+        try:
+            if path.stat().st_size != len(content):
+                return False
+        except FileNotFoundError:
+            return False
+
+        with path.open('rb') as f:
+            return f.read() == content
+
+    def _write_file(self, path: pathlib.Path, content: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+
+        try:
+            with path_tmp.open('wb') as f:
+                f.write(content)
+            os.replace(path_tmp, path)
+        except BaseException:
+            if path_tmp.exists():
+                path_tmp.unlink()
+            raise
+
+    def get_compressed(
+            self, path: pathlib.Path, content: bytes
+    ) -> Iterator[Tuple[pathlib.Path, Callable[[], bytes]]]:
+        """Compressed versions of `content`, as `(path, function which compresses)`, if `path` is a text output
+        """
+
+        if path.suffix not in self.COMPRESSED_SUFFIXES:
+            return
+
+        def gzip_compress() -> bytes:
+            buffer = io.BytesIO()
+            with gzip.GzipFile(filename='', mode='wb', fileobj=buffer, compresslevel=9, mtime=0) as f:
+                f.write(content)
+            return buffer.getvalue()
+
+        yield path.with_name(path.name + '.gz'), gzip_compress
+
+        if brotli is not None:
+            yield path.with_name(path.name + '.br'), lambda: brotli.compress(content, quality=11)
+
+    def write(self, url: Union[str, pathlib.Path], content: Union[str, bytes]) -> bool:
+        """Write `content` in `target / url`, if it changed. Return `True` if the file was written.
+        """
+
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        url = pathlib.Path(url)
+        if self._is_unchanged(url, content):
+            l_logger.debug('UNCHANGED {}'.format(url))
+
+            if self.precompress:
+                for compressed_url, compress in self.get_compressed(url, content):
+                    if not self.exists(compressed_url):
+                        self._put(compressed_url, compress())
+
+            return False
+
+        self._put(url, content)
+
+        if self.precompress:
+            for compressed_url, compress in self.get_compressed(url, content):
+                self._put(compressed_url, compress())
+
+        self.changed.append(str(url))
+        return True
+
+    def _is_unchanged(self, url: pathlib.Path, content: bytes) -> bool:
+        return self.is_identical(self.target / url, content)
+
+    def _put(self, url: pathlib.Path, content: bytes):
+        self._write_file(self.target / url, content)
+
+
+class ArchiveWriter(OutputWriter):
+    """Write the outputs in an archive (`target`), sequentially, rather than in many small files.
+
+    An archive cannot be updated in place, so a new one is written (in `target` + `.part`, which then replaces the
+    previous one). The outputs which are identical to the ones of the previous archive, or which are not written
+    during this build (e.g., the thumbnails which already exist), are copied from it as they are when the writer is
+    closed.
+    """
+
+    SHARED = False
+
+    def __init__(self, target: pathlib.Path, precompress: bool = False):
+        super().__init__(target, precompress)
+
+        self.path_part = target.with_name(target.name + '.part')
+
+        self.previous: Dict[str, Any] = {}  # members of the previous archive, per name
+        self.written: Dict[str, str] = {}  # hash of the outputs written in the new archive, per name
+
+        self._previous_archive = self._open_previous() if target.exists() else None
+        self._archive = self._open_new()
+        self._reader = None  # (see `get_files()`)
+
+    def _open_previous(self) -> Any:
+        raise NotImplementedError()
+
+    def _open_new(self) -> Any:
+        raise NotImplementedError()
+
+    def _get_previous_size(self, name: str) -> int:
+        raise NotImplementedError()
+
+    def _read_previous(self, name: str) -> bytes:
+        raise NotImplementedError()
+
+    def _add(self, name: str, content: bytes):
+        raise NotImplementedError()
+
+    def _copy_previous(self, name: str):
+        raise NotImplementedError()
+
+    def _get_previous_mtime(self, name: str) -> int:
+        raise NotImplementedError()
+
+    def exists(self, url: Union[str, pathlib.Path]) -> bool:
+        return str(url) in self.written or str(url) in self.previous
+
+    def _is_unchanged(self, url: pathlib.Path, content: bytes) -> bool:
+        name = str(url)
+        if name in self.written:
+            if self.written[name] != hashlib.sha256(content).hexdigest():
+                raise ValueError('`{}` was already written in the archive, with another content'.format(name))
+            return True
+
+        if name not in self.previous or self._get_previous_size(name) != len(content):
+            return False
+
+        return self._read_previous(name) == content
+
+    def _put(self, url: pathlib.Path, content: bytes):
+        self._add(str(url), content)
+        self.written[str(url)] = hashlib.sha256(content).hexdigest()
+
+    def _close_archives(self):
+        self._archive.close()
+        if self._previous_archive is not None:
+            self._previous_archive.close()
+
+    def close(self):
+        copied = 0
+        for name in self.previous:
+            if name not in self.written:
+                self._copy_previous(name)
+                copied += 1
+
+        self._close_archives()
+        os.replace(self.path_part, self.target)
+
+        l_logger.info('{} output(s) written in `{}`, {} copied from the previous archive'.format(
+            len(self.written), self.target, copied))
+
+    def _open_reader(self):
+        """Read the archive which was just written, as if it was the previous one"""
+
+        if self._reader is None:
+            self._reader = self._previous_archive = self._open_previous()
+
+    def get_files(self) -> Iterator[Tuple[str, int, Optional[int], Optional[str]]]:
+        self._open_reader()
+        for name in self.previous:
+            yield name, self._get_previous_size(name), self._get_previous_mtime(name), self.written.get(name)
+
+    def read_output(self, url: Union[str, pathlib.Path]) -> bytes:
+        self._open_reader()
+        return self._read_previous(str(url))
+
+    def release(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def abort(self):
+        self._close_archives()
+        self.path_part.unlink()
+
+
+class TarWriter(ArchiveWriter):
+    """Write the outputs in a (uncompressed) tar archive"""
+
+    def _open_previous(self) -> tarfile.TarFile:
+        archive = tarfile.open(self.target, 'r:')
+        self.previous = dict((member.name, member) for member in archive.getmembers() if member.isfile())
+        return archive
+
+    def _open_new(self) -> tarfile.TarFile:
+        return tarfile.open(self.path_part, 'w|')  # (a stream, which is never sought)
+
+    def _get_previous_size(self, name: str) -> int:
+        return self.previous[name].size
+
+    def _get_previous_mtime(self, name: str) -> int:
+        return self.previous[name].mtime
+
+    def _read_previous(self, name: str) -> bytes:
+        return self._previous_archive.extractfile(self.previous[name]).read()
+
+    def _add(self, name: str, content: bytes):
+        member = tarfile.TarInfo(name)
+        member.size = len(content)
+        member.mtime = int(time.time())
+        member.mode = 0o644
+        self._archive.addfile(member, io.BytesIO(content))
+
+    def _copy_previous(self, name: str):
+        member = self.previous[name]
+        self._archive.addfile(member, self._previous_archive.extractfile(member))
+
+
+class ZipWriter(ArchiveWriter):
+    """Write the outputs in a zip archive, without compression (most of the outputs are images, while the text ones
+    can be precompressed), so that the outputs of the previous archive are copied without being decompressed
+    """
+
+    def _open_previous(self) -> zipfile.ZipFile:
+        archive = zipfile.ZipFile(self.target, 'r')
+        self.previous = dict((info.filename, info) for info in archive.infolist() if not info.is_dir())
+        return archive
+
+    def _open_new(self) -> zipfile.ZipFile:
+        return zipfile.ZipFile(self.path_part, 'w', compression=zipfile.ZIP_STORED)
+
+    def _get_previous_size(self, name: str) -> int:
+        return self.previous[name].file_size
+
+    def _get_previous_mtime(self, name: str) -> int:
+        return int(datetime.datetime(*self.previous[name].date_time).timestamp())
+
+    def _read_previous(self, name: str) -> bytes:
+        return self._previous_archive.read(self.previous[name])
+
+    def _add(self, name: str, content: bytes):
+        info = zipfile.ZipInfo(name, date_time=datetime.datetime.now().timetuple()[:6])
+        info.external_attr = 0o644 << 16
+        self._archive.writestr(info, content)
+
+    def _copy_previous(self, name: str):
+        info = self.previous[name]
+        with self._previous_archive.open(info) as f_in, self._archive.open(info, 'w') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+
+class ObjectStoreWriter(OutputWriter):
+    """Write the outputs in a content-addressed directory (`target`): the content of each output is in
+    `objects/`, under its hash, and `manifest.json` gives the hash of each output.
+
+    An object is written once, whatever the number of outputs (and of builds) which have that content. The manifest is
+    only written when the writer is closed, so that it never refers to a missing object.
+    """
+
+    OBJECTS_DIRECTORY = 'objects'
+    MANIFEST_NAME = 'manifest.json'
+
+    SHARED = False
+
+    def __init__(self, target: pathlib.Path, precompress: bool = False):
+        super().__init__(target, precompress)
+
+        self.objects: Dict[str, str] = {}  # hash of the content of each output
+        path_manifest = self.target / self.MANIFEST_NAME
+        if path_manifest.exists():
+            with path_manifest.open() as f:
+                self.objects = json.load(f)
+
+    def get_object_path(self, object_hash: str) -> pathlib.Path:
+        return self.target / self.OBJECTS_DIRECTORY / object_hash[:2] / object_hash[2:]
+
+    def exists(self, url: Union[str, pathlib.Path]) -> bool:
+        return str(url) in self.objects
+
+    def _is_unchanged(self, url: pathlib.Path, content: bytes) -> bool:
+        return self.objects.get(str(url)) == hashlib.sha256(content).hexdigest()
+
+    def _put(self, url: pathlib.Path, content: bytes):
+        object_hash = hashlib.sha256(content).hexdigest()
+
+        path = self.get_object_path(object_hash)
+        if not path.exists():
+            self._write_file(path, content)
+
+        self.objects[str(url)] = object_hash
+
+    def get_files(self) -> Iterator[Tuple[str, int, Optional[int], Optional[str]]]:
+        for url, object_hash in sorted(self.objects.items()):
+            yield url, self.get_object_path(object_hash).stat().st_size, None, object_hash
+
+    def read_output(self, url: Union[str, pathlib.Path]) -> bytes:
+        with self.get_object_path(self.objects[str(url)]).open('rb') as f:
+            return f.read()
+
+    def close(self):
+        self._write_file(
+            self.target / self.MANIFEST_NAME, json.dumps(self.objects, indent=0, sort_keys=True).encode())
+
+
+OUTPUT_FORMATS = {
+    'tar': TarWriter,
+    'zip': ZipWriter,
+    'objects': ObjectStoreWriter
+}
+
+
+def make_writer(target: pathlib.Path, output_format: str = None, precompress: bool = False) -> OutputWriter:
+    """Get the writer for `target`: a directory (the default), or one of `OUTPUT_FORMATS`
+    """
+
+    if output_format is None:
+        return OutputWriter(target, precompress)
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('`{}` is not a valid output format'.format(output_format))
+
+    return OUTPUT_FORMATS[output_format](target, precompress)
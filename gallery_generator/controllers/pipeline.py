@@ -0,0 +1,114 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from gallery_generator import logger
+
+l_logger = logger.getChild('controllers.pipeline')
+
+Stage = Callable[[Iterator[Any]], Iterable[Any]]
+
+_DONE = object()  # (end of the items of a queue)
+
+
+class _Inputs:
+    """Iterate over the items of `items` (a queue), until `_DONE`"""
+
+    def __init__(self, items: Optional['queue.Queue']):
+        self.items = items
+        self.done = items is None
+
+    def __iter__(self) -> '_Inputs':
+        return self
+
+    def __next__(self) -> Any:
+        if not self.done:
+            item = self.items.get()
+            if item is not _DONE:
+                return item
+            self.done = True
+
+        raise StopIteration()
+
+    def drain(self):
+        for _ in self:
+            pass
+
+
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Group `items` in lists of `size` items (but the last one), e.g. for a stage which works on several at once
+    """
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class Pipeline:
+    """Run stages concurrently, each in its own thread, connected by bounded queues.
+
+    A stage is a generator function, which gets an iterator over the items produced by the previous stage (an
+    empty one for the first stage) and yields its own items. So it can set up whatever it needs in its thread (e.g.,
+    a database session) around its loop. Since the queues are bounded, a stage waits for the next one if it is ahead,
+    and the number of items in flight does not depend on the total number of items.
+
+    If a stage fails, the others stop, and the exception is raised by `run()`.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 16):
+        self.stages = stages
+        self.queue_size = queue_size
+
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def _run_stage(self, stage: Stage, items: Optional['queue.Queue'], results: Optional['queue.Queue']):
+        inputs = _Inputs(items)
+
+        try:
+            outputs = stage(inputs)
+            try:
+                for item in outputs:
+                    if self._stop.is_set():
+                        break
+                    if results is not None:
+                        results.put(item)
+            finally:
+                if hasattr(outputs, 'close'):  # (a generator, which is then stopped)
+                    outputs.close()
+        except BaseException as e:
+            l_logger.error('stage `{}` failed: {}'.format(getattr(stage, '__name__', stage), e))
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            inputs.drain()  # so that the previous stage is not blocked
+            if results is not None:
+                results.put(_DONE)
+
+    def run(self):
+        queues = [queue.Queue(self.queue_size) for _ in self.stages[1:]]
+
+        threads = [
+            threading.Thread(
+                target=self._run_stage,
+                args=(stage, queues[i - 1] if i > 0 else None, queues[i] if i < len(queues) else None),
+                name='pipeline-{}'.format(getattr(stage, '__name__', i)),
+                daemon=True
+            )
+            for i, stage in enumerate(self.stages)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
@@ -0,0 +1,98 @@
+import collections
+import pathlib
+from typing import Dict, Tuple, Optional, Union
+
+from sqlalchemy.orm import Session
+
+from gallery_generator import logger
+from gallery_generator.controllers.output import OutputWriter
+from gallery_generator.controllers.thumbnails import BaseImageTransform, Thumbnailer
+from gallery_generator.models import Picture
+from gallery_generator.snapshot import PictureRecord, ThumbnailRecord
+
+l_logger = logger.getChild('controllers.preview')
+
+
+class ThumbnailCache:
+    """Thumbnails in memory, the least recently used ones being evicted when they take more than `max_size` bytes
+    """
+
+    MAX_SIZE = 64 * 2 ** 20
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.contents: 'collections.OrderedDict[str, bytes]' = collections.OrderedDict()
+
+    def get(self, url: str) -> Optional[bytes]:
+        content = self.contents.get(url)
+        if content is not None:
+            self.contents.move_to_end(url)
+
+        return content
+
+    def put(self, url: str, content: bytes):
+        if url in self.contents:
+            self.size -= len(self.contents.pop(url))
+
+        self.contents[url] = content
+        self.size += len(content)
+
+        while self.size > self.max_size and len(self.contents) > 1:
+            _, evicted = self.contents.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class PreviewThumbnailer(Thumbnailer):
+    """Thumbnails for the preview server, which never writes anything.
+
+    The thumbnails whose file exists in `target` are used as they are. The other ones are replaced by a stand-in (in
+    `PREVIEW_DIRECTORY`, and only in the main format and size of their type), which is only made when it is
+    requested (see `get_preview()`), and then kept in `cache`.
+    """
+
+    PREVIEW_DIRECTORY = pathlib.Path('_preview')
+
+    def __init__(
+        self,
+        root: pathlib.Path,
+        target: pathlib.Path,
+        session: Session,
+        thumb_types: Dict[str, BaseImageTransform],
+        cache: ThumbnailCache = None
+    ):
+        super().__init__(root, target, session, thumb_types, writer=OutputWriter(target))
+
+        self.missing = self.thumb_types.copy()  # (see `ThumbnailIndex`)
+        self.cache = cache if cache is not None else ThumbnailCache()
+        self.stand_ins: Dict[str, Tuple[Union[Picture, PictureRecord], str]] = {}
+
+    def _add_record(self, thumb: ThumbnailRecord):
+        if self.writer.exists(thumb.path):
+            super()._add_record(thumb)
+
+    def get_stand_in(self, picture: Union[Picture, PictureRecord], ttype: str) -> ThumbnailRecord:
+        thumb = super().get_stand_in(picture, ttype)
+
+        path = str(self.PREVIEW_DIRECTORY / self.thumb_types[ttype].get_name('id{}'.format(picture.id)))
+        self.stand_ins[path] = picture, ttype
+
+        return thumb._replace(path=path)
+
+    def get_preview(self, url: str) -> Optional[Tuple[bytes, str]]:
+        """Get the content and the mimetype of the stand-in at `url` (making it if needed), if there is one
+        """
+
+        if url not in self.stand_ins:
+            return None
+
+        picture, ttype = self.stand_ins[url]
+        transformer = self.thumb_types[ttype]
+
+        content = self.cache.get(url)
+        if content is None:
+            l_logger.info('MAKE {}'.format(url))
+            content, _ = transformer.encode(self.root / picture.path)
+            self.cache.put(url, content)
+
+        return content, transformer.get_mimetype()
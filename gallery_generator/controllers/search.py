@@ -0,0 +1,117 @@
+"""
+Inverted index of the pictures, for the static search (see `SearchView`).
+
+Each picture gets tokens (its tags and some of its EXIF info), such as `album:holidays`, `camera:nikon-d5600` or
+`month:2020-09`. The pictures are referred to by their index in `Snapshot.pictures` (so, in chronological order), and
+the list of the pictures of each token is delta-encoded.
+"""
+
+from typing import Dict, List, Iterable, Tuple
+
+from slugify import slugify
+
+from gallery_generator.snapshot import Snapshot, PictureRecord
+
+
+# fields which do not come from the tags, as `(field, description)`
+EXIF_FIELDS = (
+    ('make', 'brand of the camera'),
+    ('camera', 'model of the camera'),
+    ('focal-length', 'focal length, in mm'),
+    ('aperture', 'f-number'),
+    ('iso', 'ISO speed'),
+    ('year', 'year the picture was taken'),
+    ('month', 'month the picture was taken, as `YYYY-MM` (see `from:` and `to:`)'),
+)
+
+
+def get_exif_tokens(picture: PictureRecord) -> Iterable[str]:
+    if picture.exif_make:
+        yield 'make:{}'.format(slugify(picture.exif_make))
+    if picture.exif_model:
+        yield 'camera:{}'.format(slugify(picture.exif_model))
+    if picture.exif_focal_length:
+        yield 'focal-length:{}'.format(round(picture.exif_focal_length))
+    if picture.exif_f_number:
+        yield 'aperture:{:g}'.format(picture.exif_f_number)
+    if picture.exif_iso_speed:
+        yield 'iso:{}'.format(picture.exif_iso_speed)
+    if picture.exif_datetime_original:
+        yield 'year:{:%Y}'.format(picture.exif_datetime_original)
+        yield 'month:{:%Y-%m}'.format(picture.exif_datetime_original)
+
+
+def get_tokens(snapshot: Snapshot) -> Dict[str, List[int]]:
+    """The pictures (as their index in `snapshot.pictures`, in increasing order) of each token
+    """
+
+    tokens: Dict[str, List[int]] = {}
+
+    for i, picture in enumerate(snapshot.pictures):
+        for token in get_exif_tokens(picture):
+            tokens.setdefault(token, []).append(i)
+
+    for tag in snapshot.tags():
+        tokens['{}:{}'.format(tag.category.slug, tag.slug)] = list(tag.pictures)
+
+    return dict(sorted(tokens.items()))
+
+
+def encode_ids(ids: List[int]) -> List[int]:
+    """Delta-encode `ids` (in increasing order): each id is given as the difference with the previous one (the first
+    one with -1), and `n` consecutive ids after an id are replaced by `-n`.
+    E.g., `[3, 4, 5, 6, 10]` gives `[4, -3, 4]`.
+    """
+
+    encoded = []
+    previous = -1
+
+    for i in ids:
+        if i == previous + 1 and encoded and encoded[-1] < 0:
+            encoded[-1] -= 1
+        elif i == previous + 1 and len(encoded) > 0:
+            encoded.append(-1)
+        else:
+            encoded.append(i - previous)
+
+        previous = i
+
+    return encoded
+
+
+def decode_ids(encoded: List[int]) -> List[int]:
+    """Reverse of `encode_ids()` (as done by the client)"""
+
+    ids = []
+    previous = -1
+
+    for d in encoded:
+        if d < 0:
+            ids.extend(range(previous + 1, previous + 1 - d))
+            previous -= d
+        else:
+            previous += d
+            ids.append(previous)
+
+    return ids
+
+
+def shard_tokens(
+        tokens: Dict[str, List[int]], max_size: int, length: int = 1
+) -> List[Tuple[str, Dict[str, List[int]]]]:
+    """Split the (encoded) `tokens` in shards of at most about `max_size` ids (unless a token is larger by itself), as
+    `(prefix, tokens)`, sorted by prefix. A token is in the shard whose prefix is the longest one it starts with.
+    """
+
+    groups: Dict[str, Dict[str, List[int]]] = {}
+    for token, ids in tokens.items():
+        groups.setdefault(token[:length], {})[token] = ids
+
+    shards = []
+    for prefix, group in groups.items():
+        if len(group) > 1 and sum(len(ids) for ids in group.values()) > max_size:
+            shards.extend(shard_tokens(group, max_size, length + 1))
+        else:
+            shards.append((prefix, group))
+
+    return sorted(shards)
@@ -1,4 +1,4 @@
-from schema import Schema, Optional
+from schema import Schema, Optional, Or
 
 from typing import List
 
@@ -11,51 +11,105 @@ SETTINGS_BASE = {
         'thumbnails': {
             'gallery_small': {
                 'type': 'Scale',
-                'width': 300
+                'width': 300,
+                'widths': [600],  # other sizes, picked by the browser (`srcset`)
+                'encoder_options': {'quality': 85, 'optimize': True, 'progressive': True},
+                'formats': [{'format': 'WEBP', 'quality': 80}]  # other formats, preferred first (`<picture>`)
             },
             'gallery_large': {
                 'type': 'Scale',
                 'width': 1920,
-                'height': 1920
+                'height': 1920,
+                'widths': [960],
+                'encoder_options': {'quality': 85, 'optimize': True, 'progressive': True},
+                'formats': [{'format': 'WEBP', 'quality': 80}]
             },
             'tag_thumbnail': {
                 'type': 'ScaleAndCrop',
                 'width': 300,
-                'height': 225
+                'height': 225,
+                'widths': [600],
+                'encoder_options': {'quality': 85, 'optimize': True, 'progressive': True},
+                'formats': [{'format': 'WEBP', 'quality': 80}]
             },
             'social_media_card': {
                 'type': 'ScaleAndCrop',
                 'width': 600,
                 'height': 300
             },
+            'deep_zoom': {
+                'type': 'DeepZoom',
+                'tile_size': 256,
+                'min_megapixels': 50  # only for the pictures which are larger than that (e.g., panoramas)
+            },
+        },
+        'tag_pages': {
+            'page_size': 100,  # pictures in the tag page, the other ones are loaded later (<= 0 for a single page)
+            'page_size_per_category': {},  # e.g., `{'date': 50}`
+            'fallback_pages': False  # also generate `<category>/<tag>/page-<n>.html`
+        },
+        'output': {
+            'precompress': False,  # also write `.gz` (and `.br`, if `brotli` is installed) versions of text outputs
+            'fingerprint': False  # put the hash of their content in the name of `style.css` and the new thumbnails
         },
         'page_context': {
             'site_name': 'Gallery test',
             'index_categories_to_show': ['album', 'date'],
             'bootstrap_version': '5.2.3',
             'masonry_version': '4.2.2',
-            'imageloaded_version': '5',
             'lightgallery_version': '2.5.0',
+            'openseadragon_version': '4.1.0',
             'footer_text': 'Generated by `gallery_generator`.'
         }
     }
 }
 
+ENCODER_OPTIONS_SCHEMA = {
+    Optional('quality'): int,
+    Optional('method'): int,  # WebP
+    Optional('progressive'): bool,  # JPEG
+    Optional('optimize'): bool,
+    Optional('subsampling'): Or(int, str),
+    Optional('target_size'): int,  # search for the best quality within that many bytes,
+    Optional('max_error'): Or(int, float)  # ... or for the lowest quality within that error (RMS, from 0 to 255)
+}
+
 SETTINGS_VALIDATION_SCHEMA = Schema({
     'crawl_phase': {
         'picture_exts': [str],
         'excluded_dirs': [str]
     },
     'update_phase': {
-        'thumbnails': {str: {'type': str, 'width': int, Optional('height'): int}},
+        'thumbnails': {str: {
+            'type': str,
+            Optional('width'): int,
+            Optional('height'): int,
+            Optional('tile_size'): int,  # DeepZoom
+            Optional('overlap'): int,
+            Optional('min_megapixels'): Or(int, float),
+            Optional('widths'): [int],
+            Optional('output_format'): str,
+            Optional('encoder_options'): ENCODER_OPTIONS_SCHEMA,
+            Optional('formats'): [{'format': str, **ENCODER_OPTIONS_SCHEMA}]
+        }},
+        'tag_pages': {
+            'page_size': int,
+            'page_size_per_category': {Optional(str): int},
+            'fallback_pages': bool
+        },
+        'output': {
+            'precompress': bool,
+            'fingerprint': bool
+        },
         'page_context': {
             'site_name': str,
             Optional('domain'): str,
             'index_categories_to_show': [str],
             'bootstrap_version': str,
             'masonry_version': str,
-            'imageloaded_version': str,
+            Optional('imageloaded_version'): str,  # not used anymore
             'lightgallery_version': str,
+            'openseadragon_version': str,
             Optional('twitter_account'): str,
             'footer_text': str
         }
@@ -1,12 +1,19 @@
+import base64
+import copy
+import io
+import math
 import pathlib
 from enum import Enum
-from typing import Dict
+from typing import Dict, Tuple, Union, Optional, Iterable, List, Iterator
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageChops, ImageStat
 
 from gallery_generator import logger
+from gallery_generator.controllers.output import OutputWriter, fingerprint
 from gallery_generator.models import Picture, Thumbnail
+from gallery_generator.snapshot import PictureRecord, ThumbnailRecord, PlaceholderRecord
 
 
 l_logger = logger.getChild('controllers.thumbnails')
@@ -15,11 +22,44 @@ l_logger = logger.getChild('controllers.thumbnails')
 class BaseImageTransform:
     EXIF_ROT_TAG = 0x0112
 
-    def __init__(self, output_format: str = 'JPEG', encoder_options: dict = {'quality': 85}):
+    # encoder options which are not passed to the encoder, but make it search for the quality
+    TARGET_OPTIONS = ('target_size', 'max_error')
+    QUALITY_RANGE = (30, 95)
+
+    width: int = -1
+    height: int = -1
+
+    optional: bool = False  # a picture is shown without it, so it is not quarantined if it fails (see `run_jobs()`)
+
+    def __init__(
+            self,
+            output_format: str = 'JPEG',
+            encoder_options: dict = {'quality': 85},
+            widths: Iterable[int] = (),
+            formats: Iterable[dict] = ()
+    ):
         self.output_format = output_format
         self.encoder_options = encoder_options
+        self.widths = tuple(sorted(set(widths) - {self.width}))  # other sizes of the same thumbnail (for `srcset`)
+
+        # other formats, preferred first, e.g. `[{'format': 'WEBP', 'quality': 80}]`
+        self.formats = dict(
+            (f['format'], dict((k, v) for k, v in f.items() if k != 'format')) for f in formats)
         self._rotate = True
 
+        if self.widths and self.width < 0:
+            raise ValueError('a width is required to get the other sizes')
+
+        PILImage.init()
+        for output_format, options in ((self.output_format, self.encoder_options), *self.formats.items()):
+            if output_format not in PILImage.SAVE:
+                raise ValueError('cannot encode pictures in `{}`'.format(output_format))
+            if all(k in options for k in self.TARGET_OPTIONS):
+                raise ValueError('`{}` cannot have both a target size and a maximum error'.format(output_format))
+
+    def get_mimetype(self) -> str:
+        return PILImage.MIME.get(self.output_format, 'image/{}'.format(self.output_format.lower()))
+
     def _get_subname(self) -> str:
         raise NotImplementedError()
 
@@ -50,14 +90,121 @@ class BaseImageTransform:
         else:
             return im
 
-    def __call__(self, path_in: pathlib.Path, path_out: pathlib.Path, *args, **kwargs):
-        im = PILImage.open(path_in)
+    def variant(self, width: int = None, output_format: str = None) -> 'BaseImageTransform':
+        """Get the same transformation, for an output which is `width` pixels wide (the height is scaled accordingly)
+        and/or in one of the other formats
+        """
+
+        o = copy.copy(self)
+        o.widths = ()
+
+        if width is not None:
+            o.width = width
+            if self.height > 0:
+                o.height = round(self.height * width / self.width)
 
-        # rotate if needed
-        im = self.rotate_with_tag(im)
+        if output_format is not None:
+            o.output_format = output_format
+            o.encoder_options = self.formats[output_format]
+            o.formats = {}
+
+        return o
+
+    def open(self, path_in: pathlib.Path) -> PILImage.Image:
+        """Open the picture, and rotate it if needed
+        """
+
+        return self.rotate_with_tag(PILImage.open(path_in))
+
+    def save(self, im: PILImage.Image, quality: int = None) -> bytes:
+        """Encode an (already transformed) picture, with `quality` instead of the one of the options (if any)
+        """
+
+        options = dict((k, v) for k, v in self.encoder_options.items() if k not in self.TARGET_OPTIONS)
+        if quality is not None:
+            options['quality'] = quality
+
+        buffer = io.BytesIO()
+        im.save(buffer, self.output_format, **options)
+
+        return buffer.getvalue()
+
+    def has_target(self) -> bool:
+        return any(k in self.encoder_options for k in self.TARGET_OPTIONS)
+
+    @staticmethod
+    def get_error(im: PILImage.Image, content: bytes) -> float:
+        """RMS difference between the luminance of `im` and the one of its encoded version (from 0 to 255)
+        """
 
-        # transform and save
-        self.transform(im, *args, **kwargs).save(path_out, self.output_format, **self.encoder_options)
+        with PILImage.open(io.BytesIO(content)) as im_encoded:
+            difference = ImageChops.difference(im.convert('L'), im_encoded.convert('L'))
+
+        return ImageStat.Stat(difference).rms[0]
+
+    def search_quality(self, im: PILImage.Image) -> Tuple[bytes, int, int]:
+        """Binary search (in memory) of the quality to encode an (already transformed) picture with, so that:
+
+        + with `target_size`, the output is as good as possible while not exceeding that many bytes,
+        + with `max_error`, the output is as small as possible while not exceeding that error (see `get_error()`).
+
+        Return the output, its quality, and the size of the output with the quality of the options.
+        """
+
+        target_size = self.encoder_options.get('target_size')
+        max_error = self.encoder_options.get('max_error')
+
+        lower, upper = self.QUALITY_RANGE
+        found = None
+
+        while lower <= upper:
+            quality = (lower + upper) // 2
+            content = self.save(im, quality)
+
+            if target_size is not None:
+                if len(content) <= target_size:
+                    found, lower = (content, quality), quality + 1  # try better
+                else:
+                    upper = quality - 1
+            else:
+                if self.get_error(im, content) <= max_error:
+                    found, upper = (content, quality), quality - 1  # try smaller
+                else:
+                    lower = quality + 1
+
+        if found is None:  # cannot meet the target, so get as close as possible
+            quality = self.QUALITY_RANGE[0] if target_size is not None else self.QUALITY_RANGE[1]
+            found = self.save(im, quality), quality
+
+        return found[0], found[1], len(self.save(im))
+
+    def applies_to(self, width: int, height: int) -> bool:
+        """Check if a picture of that size gets this thumbnail"""
+
+        return True
+
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Size of the thumbnail of a picture of that size (without transforming it)"""
+
+        return width, height
+
+    def get_other_outputs(self, path: pathlib.Path, im: PILImage.Image) -> Iterator[Tuple[pathlib.Path, bytes]]:
+        """Files which come along with the thumbnail stored in `path`, as `(path, content)`"""
+
+        return iter(())
+
+    def encode_image(self, im: PILImage.Image, *args, **kwargs) -> Tuple[bytes, PILImage.Image]:
+        """Transform an opened picture, and return the encoded result, together with the transformed image
+        """
+
+        im = self.transform(im, *args, **kwargs)
+        return self.save(im), im
+
+    def encode(self, path_in: pathlib.Path, *args, **kwargs) -> Tuple[bytes, PILImage.Image]:
+        """Open the picture, transform it, and return the encoded result, together with the transformed image
+        """
+
+        return self.encode_image(self.open(path_in), *args, **kwargs)
 
 
 class ScalePicture(BaseImageTransform):
@@ -70,11 +217,11 @@ class ScalePicture(BaseImageTransform):
         if width < 0 and height < 0:
             raise ValueError('must provide a positive width and/or height')
 
-        super().__init__(*args, **kwargs)
-
         self.width = width
         self.height = height
 
+        super().__init__(*args, **kwargs)
+
     def _get_subname(self) -> str:
         if self.width < 0:
             return 'sh{}'.format(self.height)
@@ -83,23 +230,30 @@ class ScalePicture(BaseImageTransform):
         else:
             return 's{}x{}'.format(self.width, self.height)
 
-    def transform(self, im: PILImage, *args, **kwargs) -> PILImage:
-        # resize
-        size = im.size
-        new_size_w = self.width, int(size[1] / size[0] * self.width)
-        new_size_h = int(size[0] / size[1] * self.height), self.height
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        new_size_w = self.width, int(height / width * self.width)
+        new_size_h = int(width / height * self.height), self.height
 
         if self.width < 0:
             new_size = new_size_h
         elif self.height < 0:
             new_size = new_size_w
         else:
-            if size[0] < size[1]:  # portrait
+            if width < height:  # portrait
                 new_size = new_size_h
             else:
                 new_size = new_size_w
 
-        if new_size[0] <= size[0] and new_size[1] <= size[1]:
+        if new_size[0] <= width and new_size[1] <= height:
+            return new_size
+        else:
+            return width, height
+
+    def transform(self, im: PILImage, *args, **kwargs) -> PILImage:
+        # resize
+        new_size = self.get_size(*im.size)
+
+        if new_size != im.size:
             return im.resize(new_size)
         else:
             return im
@@ -123,15 +277,18 @@ class CropPicture(BaseImageTransform):
 
     def __init__(self, width: int, height: int, anchor: Anchor = Anchor.CENTER, *args, **kwargs):
 
-        super().__init__(*args, **kwargs)
-
         self.width = width
         self.height = height
         self.anchor = anchor
 
+        super().__init__(*args, **kwargs)
+
     def _get_subname(self) -> str:
         return 'c{}x{}'.format(self.width, self.height)
 
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        return self.width, self.height
+
     def transform(self, im: PILImage, *args, **kwargs) -> PILImage:
         # crop
         size = im.size
@@ -174,52 +331,491 @@ class ScaleAndCropPicture(CropPicture):
         return super().transform(im)
 
 
-class Thumbnailer:
+class DeepZoomPicture(BaseImageTransform):
+    """Pyramid of tiles, in the Deep Zoom (DZI) format, so that a viewer can load the parts it displays.
+
+    The thumbnail itself is the `.dzi` descriptor, and the tiles are in `<name>_files/<level>/<column>_<row>.<ext>`,
+    the last level being the picture at full resolution, and each other level being half the size of the next one.
+    Only pictures above `min_megapixels` get one.
+    """
+
+    DZI_TEMPLATE = \
+        '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" Overlap="{}" TileSize="{}">' \
+        '<Size Width="{}" Height="{}"/></Image>\n'
+
+    optional = True
+
+    def __init__(self, tile_size: int = 256, overlap: int = 1, min_megapixels: float = 0, *args, **kwargs):
+
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.min_megapixels = min_megapixels
+
+        super().__init__(*args, **kwargs)
+
+        if self.formats:
+            raise ValueError('tiles only have one format')
+
+    def _get_subname(self) -> str:
+        return 'dz{}'.format(self.tile_size)
+
+    def get_name(self, base: str):
+        return '{}_{}.dzi'.format(base, self._get_subname())
+
+    def get_tile_extension(self) -> str:
+        return 'jpg' if self.output_format == 'JPEG' else self.output_format.lower()
+
+    def applies_to(self, width: int, height: int) -> bool:
+        return width * height > self.min_megapixels * 1e6
+
+    def transform(self, im: PILImage, *args, **kwargs) -> PILImage:
+        return im  # full resolution
+
+    def save(self, im: PILImage.Image, quality: int = None) -> bytes:
+        return self.DZI_TEMPLATE.format(
+            self.get_tile_extension(), self.overlap, self.tile_size, im.width, im.height).encode()
+
+    def get_other_outputs(self, path: pathlib.Path, im: PILImage.Image) -> Iterator[Tuple[pathlib.Path, bytes]]:
+        """Tiles, from the last level to the first one.
+        At most two levels are in memory at the same time (the current one and the next one), and tiles are encoded
+        one at a time.
+        """
+
+        directory = path.with_name('{}_files'.format(path.stem))
+        extension = self.get_tile_extension()
+        tile_encoder = BaseImageTransform(self.output_format, self.encoder_options)
+        level = math.ceil(math.log2(max(im.size)))
+
+        while level >= 0:
+            columns, rows = math.ceil(im.width / self.tile_size), math.ceil(im.height / self.tile_size)
+
+            for column in range(columns):
+                x = column * self.tile_size
+                for row in range(rows):
+                    y = row * self.tile_size
+                    box = (
+                        max(0, x - self.overlap),
+                        max(0, y - self.overlap),
+                        min(im.width, x + self.tile_size + self.overlap),
+                        min(im.height, y + self.tile_size + self.overlap)
+                    )
+
+                    yield (
+                        directory / str(level) / '{}_{}.{}'.format(column, row, extension),
+                        tile_encoder.save(im.crop(box))
+                    )
+
+            im = im.resize((math.ceil(im.width / 2), math.ceil(im.height / 2)), PILImage.LANCZOS)
+            level -= 1
+
+
+def make_placeholder(picture_id: int, im: PILImage.Image, size: int = 8) -> PlaceholderRecord:
+    """Compute the average color and a `size`x`size` preview of `im`.
+    To keep it cheap whatever the size of `im`, a subset of its pixels is sampled first.
+    """
+
+    preview = im.resize((size * 8, size * 8), PILImage.NEAREST).resize((size, size), PILImage.BOX).convert('RGB')
+    color = preview.resize((1, 1), PILImage.BOX).getpixel((0, 0))
+
+    buffer = io.BytesIO()
+    preview.save(buffer, 'PNG')
+
+    return PlaceholderRecord(
+        picture_id,
+        '#{:02x}{:02x}{:02x}'.format(*color),
+        'data:image/png;base64,{}'.format(base64.b64encode(buffer.getvalue()).decode())
+    )
+
+
+# key of the other versions of a thumbnail: `(width, format)`, `None` standing for the ones of the thumbnail type
+VariantKey = Tuple[Optional[int], Optional[str]]
+
+# stands for a thumbnail which is not created yet (stretched to its size)
+MISSING_THUMBNAIL = pathlib.Path('thumbs') / 'missing.svg'
+MISSING_THUMBNAIL_CONTENT = \
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 1 1" preserveAspectRatio="none">' \
+    '<rect width="1" height="1" fill="#ddd"/></svg>'
+
+
+class ThumbnailIndex:
+    """Read-only lookup of existing thumbnails (and placeholders), which can be shipped to other processes.
+
+    For the types in `missing`, a thumbnail which does not exist is replaced by `MISSING_THUMBNAIL` (at its size).
+    """
+
+    def __init__(
+        self,
+        thumbnails: Dict[Tuple[int, str], ThumbnailRecord],
+        placeholders: Dict[int, PlaceholderRecord] = None,
+        variants: Dict[Tuple[int, str], Dict[VariantKey, ThumbnailRecord]] = None,
+        formats: Dict[str, Tuple[Tuple[str, str], ...]] = None,
+        missing: Dict[str, BaseImageTransform] = None
+    ):
+        self.thumbnails = thumbnails
+        self.placeholders = placeholders if placeholders is not None else {}
+        self.variants = variants if variants is not None else {}
+        self.formats = formats if formats is not None else {}  # other `(format, mimetype)` of each type
+        self.missing = missing if missing is not None else {}
+
+    def get_stand_in(self, picture: Union[Picture, PictureRecord], ttype: str) -> ThumbnailRecord:
+        """Stand-in for the thumbnail of `picture`, which is missing"""
+
+        width, height = picture.width, picture.height
+        if picture.exif_orientation in (5, 6, 7, 8):  # (rotated by a quarter)
+            width, height = height, width
+
+        return ThumbnailRecord(
+            None, picture.id, ttype, str(MISSING_THUMBNAIL), *self.missing[ttype].get_size(width, height),
+            None, None, None, None
+        )
+
+    def get_thumbnail(self, picture: Union[Picture, PictureRecord], ttype: str) -> ThumbnailRecord:
+        if (picture.id, ttype) not in self.thumbnails and ttype in self.missing:
+            return self.get_stand_in(picture, ttype)
+
+        return self.thumbnails[picture.id, ttype]
+
+    def get_srcset(
+            self, picture: Union[Picture, PictureRecord], ttype: str, output_format: str = None
+    ) -> List[ThumbnailRecord]:
+        """The thumbnail of `picture` and its other sizes (in `output_format`, if any), smallest first
+        (one per actual width)
+        """
+
+        variants = self.variants.get((picture.id, ttype), {})
+        if output_format is not None and (None, output_format) not in variants and ttype in self.missing:
+            return []
+
+        thumbs = [self.get_thumbnail(picture, ttype) if output_format is None else variants[None, output_format]]
+        thumbs.extend(t for (w, f), t in variants.items() if w is not None and f == output_format)
+
+        per_width = {}
+        for thumb in thumbs:
+            per_width.setdefault(thumb.width, thumb)
+
+        return [per_width[w] for w in sorted(per_width, key=lambda w: w or 0)]
+
+    def get_sources(
+            self, picture: Union[Picture, PictureRecord], ttype: str
+    ) -> List[Tuple[str, List[ThumbnailRecord]]]:
+        """The other formats of the thumbnail of `picture`, as `(mimetype, srcset)`, preferred first
+        """
+
+        sources = [
+            (mimetype, self.get_srcset(picture, ttype, output_format))
+            for output_format, mimetype in self.formats.get(ttype, ())
+        ]
+
+        return [(mimetype, srcset) for mimetype, srcset in sources if srcset]  # (but the missing ones)
+
+    def get_optional_thumbnail(self, picture: Union[Picture, PictureRecord], ttype: str) -> Optional[ThumbnailRecord]:
+        """The thumbnail of `picture`, if that type exists and applies to it (e.g., deep zoom)
+        """
+
+        return self.thumbnails.get((picture.id, ttype))
+
+    def get_placeholder(self, picture: Union[Picture, PictureRecord]) -> Optional[PlaceholderRecord]:
+        return self.placeholders.get(picture.id)
+
+
+class Thumbnailer(ThumbnailIndex):
 
     THUMBNAIL_DIRECTORY = pathlib.Path('thumbs')
 
     def __init__(
-        self, root: pathlib.Path, target: pathlib.Path, session: Session, thumb_types: Dict[str, BaseImageTransform]
+        self,
+        root: pathlib.Path,
+        target: pathlib.Path,
+        session: Session,
+        thumb_types: Dict[str, BaseImageTransform],
+        writer: OutputWriter = None,
+        fingerprint: bool = False
     ):
+        super().__init__(
+            {},
+            {},
+            {},
+            dict(
+                (ttype, tuple((f, transformer.variant(output_format=f).get_mimetype()) for f in transformer.formats))
+                for ttype, transformer in thumb_types.items()
+            )
+        )
+
         self.root = root
         self.target = target
         self.session = session
         self.thumb_types = thumb_types
+        self.writer = writer if writer is not None else OutputWriter(target)
+        self.fingerprint = fingerprint  # put the hash of the content in the name of the new thumbnails
+
+        self.refresh()
+
+        # adaptive quality: number of searches and bytes saved compared to the quality of the options
+        self.searched = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def _variant_keys(transformer: BaseImageTransform) -> List[VariantKey]:
+        """All the other versions of a thumbnail type, grouped per width"""
+
+        return [(w, f) for w in (None, *transformer.widths) for f in (None, *transformer.formats)][1:]
+
+    def _add_record(self, thumb: ThumbnailRecord):
+        if thumb.variant is None and thumb.format is None:
+            self.thumbnails[thumb.picture_id, thumb.type] = thumb
+        elif thumb.type in self.thumb_types and \
+                (thumb.variant, thumb.format) in self._variant_keys(self.thumb_types[thumb.type]):
+            self.variants.setdefault((thumb.picture_id, thumb.type), {})[thumb.variant, thumb.format] = thumb
+        # (other ones are not used anymore)
+
+    def refresh(self, picture: Union[Picture, PictureRecord] = None):
+        """Reload the thumbnails and the placeholder of `picture` (or all of them), which may have been created by
+        another process in the meantime
+        """
+
+        picture_id = picture.id if picture is not None else None
+
+        for thumb in ThumbnailRecord.fetch_all(self.session, picture_id):
+            self._add_record(thumb)
+
+        for placeholder in PlaceholderRecord.fetch_all(self.session, picture_id):
+            self.placeholders[placeholder.picture_id] = placeholder
+
+    def index(self) -> ThumbnailIndex:
+        """Get a read-only copy of the lookup, for the thumbnails created so far"""
+
+        return ThumbnailIndex(
+            self.thumbnails.copy(),
+            self.placeholders.copy(),
+            dict((k, v.copy()) for k, v in self.variants.items()),
+            self.formats.copy(),
+            self.missing.copy()
+        )
+
+    def stop_creating(self):
+        """From now on, do not create the missing thumbnails, but replace them by `MISSING_THUMBNAIL` (e.g., when
+        there is no time left for them)
+        """
+
+        self.missing = self.thumb_types.copy()
+        self.writer.write(MISSING_THUMBNAIL, MISSING_THUMBNAIL_CONTENT)
+
+    def _set_placeholder(self, picture: Union[Picture, PictureRecord], im: PILImage.Image):
+        """Compute the placeholder of `picture` from `im` (the whole picture, rotated, so that it has the framing of
+        the thumbnails which are not cropped, whatever the type created first) if it does not exists yet
+        """
+
+        if picture.id in self.placeholders:
+            return
+
+        placeholder = make_placeholder(picture.id, im)
+        self.session.execute(
+            update(Picture)
+            .where(Picture.id == picture.id)
+            .values(
+                placeholder_color=placeholder.color,
+                placeholder_preview=placeholder.preview,
+                date_obj_modified=Picture.date_obj_modified  # not a modification of the picture itself
+            )
+        )
+
+        self.placeholders[picture.id] = placeholder
+
+    def _get_record(self, picture: Union[Picture, PictureRecord], ttype: str, key: VariantKey) -> ThumbnailRecord:
+        if key == (None, None):
+            return self.thumbnails.get((picture.id, ttype))
+        else:
+            return self.variants.get((picture.id, ttype), {}).get(key)
+
+    def _set_record(
+            self, picture: Union[Picture, PictureRecord], ttype: str, key: VariantKey, thumb: ThumbnailRecord):
+        if key == (None, None):
+            self.thumbnails[picture.id, ttype] = thumb
+        else:
+            self.variants.setdefault((picture.id, ttype), {})[key] = thumb
+
+    def _is_missing(self, picture: Union[Picture, PictureRecord], ttype: str, key: VariantKey) -> bool:
+        thumb = self._get_record(picture, ttype, key)
+        return thumb is None or not self.writer.exists(thumb.path)
+
+    def _write(self, transformer: BaseImageTransform, path: pathlib.Path, content: bytes, im: PILImage.Image) -> int:
+        """Write the thumbnail and the files which come along with it, if any. Return the total size
+        """
+
+        size = len(content)
+        self.writer.write(path, content)
+
+        for other_path, other_content in transformer.get_other_outputs(path, im):
+            size += len(other_content)
+            self.writer.write(other_path, other_content)
+
+        return size
+
+    def _create_thumbnails(
+            self, picture: Union[Picture, PictureRecord], ttype: str, keys: Iterable[VariantKey], commit: bool = True):
+        """Create (or re-create the file of) the thumbnail of `picture` and its other versions in `keys`,
+        `(None, None)` standing for the thumbnail itself.
+        The picture is only decoded once, and transformed once per width.
+
+        Everything is encoded and written before the database is modified, so that it is only locked (for the other
+        workers) by a short transaction at the end, which is committed unless `commit` is `False` (e.g., to commit it
+        together with the state of the job).
+        """
 
-    def _create_thumbnail(self, picture: Picture, ttype: str) -> Thumbnail:
         transformer: BaseImageTransform = self.thumb_types[ttype]
-        name = transformer.get_name('{}_id{}'.format(pathlib.Path(picture.path).parent.name, picture.id))
-        l_logger.info('NEW THUMBNAIL {}'.format(self.THUMBNAIL_DIRECTORY / name))
+        im = transformer.open(self.root / picture.path)
 
-        # transform
-        transformer(self.root / picture.path, self.target / self.THUMBNAIL_DIRECTORY / name)
+        per_width: Dict[Optional[int], List[Optional[str]]] = {}
+        for width, output_format in keys:
+            per_width.setdefault(width, []).append(output_format)
+
+        renamed: Dict[VariantKey, ThumbnailRecord] = {}
+        created: Dict[VariantKey, Thumbnail] = {}
+
+        for width, output_formats in per_width.items():
+            width_transformer = transformer.variant(width) if width is not None else transformer
+            thumb_im = width_transformer.transform(im)
+
+            for output_format in output_formats:
+                variant_transformer = width_transformer.variant(output_format=output_format) \
+                    if output_format is not None else width_transformer
+
+                path = self.THUMBNAIL_DIRECTORY / variant_transformer.get_name(
+                    '{}_id{}'.format(pathlib.Path(picture.path).parent.name, picture.id))
+
+                thumb = self._get_record(picture, ttype, (width, output_format))
+                if thumb is not None:  # re-create (with the quality found previously, if any)
+                    l_logger.info('MAKE {}'.format(thumb.path))
+                    content = variant_transformer.save(thumb_im, thumb.quality)
+
+                    # a different content gets another name
+                    if self.fingerprint and str(fingerprint(path, content)) != thumb.path:
+                        thumb = renamed[width, output_format] = thumb._replace(path=str(fingerprint(path, content)))
+
+                    self._write(variant_transformer, pathlib.Path(thumb.path), content, thumb_im)
+                    continue
+
+                # encode
+                quality = None
+                if variant_transformer.has_target():
+                    content, quality, default_size = variant_transformer.search_quality(thumb_im)
+                    self.searched += 1
+                    self.bytes_saved += default_size - len(content)
+                else:
+                    content = variant_transformer.save(thumb_im)
+
+                if self.fingerprint:
+                    path = fingerprint(path, content)
+
+                l_logger.info('NEW THUMBNAIL {}'.format(path))
+                size = self._write(variant_transformer, path, content, thumb_im)
+
+                created[width, output_format] = Thumbnail.create(
+                    picture.id, str(path), ttype, thumb_im.size, size, width, output_format, quality)
 
         # put in database
-        thumb = Thumbnail.create(picture.id, str(self.THUMBNAIL_DIRECTORY / name), ttype)
-        picture.thumbnails.append(thumb)
-        self.session.add(thumb)
-        self.session.commit()
+        self._set_placeholder(picture, im)
 
-        return thumb
+        for key, thumb in renamed.items():
+            self.session.execute(update(Thumbnail).where(Thumbnail.id == thumb.id).values(path=thumb.path))
+            self._set_record(picture, ttype, key, thumb)
 
-    def get_thumbnail(self, picture: Picture, ttype: str) -> Thumbnail:
-        """Get or create a thumbnail for `picture`"""
+        self.session.add_all(created.values())
+        self.session.flush()
+
+        for key, obj in created.items():
+            self._set_record(
+                picture, ttype, key, ThumbnailRecord(*(getattr(obj, c.key) for c in ThumbnailRecord.columns())))
+
+        if commit:
+            self.session.commit()
 
+    def _check_type(self, ttype: str):
         if ttype not in self.thumb_types:
             raise ValueError('`{}` is not a valid thumbnail type'.format(ttype))
 
-        for thumb in picture.thumbnails:
-            if thumb.type == ttype:
-                if not (self.target / thumb.path).exists():  # re-create if needed
-                    l_logger.info('MAKE {}'.format(thumb.path))
-                    self.thumb_types[ttype](self.root / picture.path, self.target / thumb.path)
-                return thumb
+    def get_thumbnail(self, picture: Union[Picture, PictureRecord], ttype: str) -> ThumbnailRecord:
+        """Get or create a thumbnail for `picture`"""
+
+        self._check_type(ttype)
+
+        if self.missing:
+            return super().get_thumbnail(picture, ttype)
+
+        thumb = self.thumbnails.get((picture.id, ttype))
+        if thumb is None:  # create it, together with its other versions
+            self._create_thumbnails(picture, ttype, [(None, None)] + [
+                k for k in self._variant_keys(self.thumb_types[ttype]) if self._is_missing(picture, ttype, k)
+            ])
+        elif not self.writer.exists(thumb.path):  # re-create if needed
+            self._create_thumbnails(picture, ttype, [(None, None)])
+
+        return self.thumbnails[picture.id, ttype]
+
+    def get_missing(self, picture: Union[Picture, PictureRecord], ttype: str) -> List[VariantKey]:
+        """The versions of the thumbnail of `picture` which are missing, if that type exists and applies to it
+        """
+
+        transformer = self.thumb_types.get(ttype)
+        if transformer is None or not transformer.applies_to(picture.width, picture.height):
+            return []
+
+        return [k for k in [(None, None)] + self._variant_keys(transformer) if self._is_missing(picture, ttype, k)]
+
+    def create_missing(self, picture: Union[Picture, PictureRecord], ttypes: Iterable[str], commit: bool = True):
+        """Create the thumbnails of `picture` (and their other versions) that are missing, for the types in `ttypes`
+        (see `_create_thumbnails()` for `commit`)
+        """
+
+        for ttype in ttypes:
+            missing = self.get_missing(picture, ttype)
+            if missing:
+                self._create_thumbnails(picture, ttype, missing, commit)
+
+    def get_optional_types(self) -> List[str]:
+        """The types that a picture can do without (e.g., deep zoom)"""
+
+        return [ttype for ttype, transformer in self.thumb_types.items() if transformer.optional]
+
+    def get_optional_thumbnail(self, picture: Union[Picture, PictureRecord], ttype: str) -> Optional[ThumbnailRecord]:
+        """Get or create the thumbnail of `picture`, if that type exists and applies to it"""
+
+        transformer = self.thumb_types.get(ttype)
+        if transformer is None or not transformer.applies_to(picture.width, picture.height):
+            return None
+
+        if self.missing:
+            return super().get_optional_thumbnail(picture, ttype)
+
+        return self.get_thumbnail(picture, ttype)
+
+    def get_srcset(
+            self, picture: Union[Picture, PictureRecord], ttype: str, output_format: str = None
+    ) -> List[ThumbnailRecord]:
+        """Get or create the thumbnail of `picture` and its other sizes (in `output_format`, if any), smallest first
+        """
+
+        self._check_type(ttype)
+
+        transformer = self.thumb_types[ttype]
+        if output_format is not None and output_format not in transformer.formats:
+            raise ValueError('`{}` is not a format of `{}`'.format(output_format, ttype))
+
+        missing = [
+            (w, f) for w, f in [(None, None)] + self._variant_keys(transformer)
+            if f == output_format and self._is_missing(picture, ttype, (w, f))
+        ]
+
+        if missing and not self.missing:
+            self._create_thumbnails(picture, ttype, missing)
 
-        return self._create_thumbnail(picture, ttype)
+        return super().get_srcset(picture, ttype, output_format)
 
 
 TRANSFORMER_TYPES = {
     'Scale': ScalePicture,
     'Crop': CropPicture,
-    'ScaleAndCrop': ScaleAndCropPicture
+    'ScaleAndCrop': ScaleAndCropPicture,
+    'DeepZoom': DeepZoomPicture
 }
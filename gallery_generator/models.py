@@ -1,12 +1,12 @@
 import pathlib
 
-from markdown import markdown
 from slugify import slugify
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Table, select, func
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Table, UniqueConstraint, Index, select, \
+    func
 from sqlalchemy.orm import declarative_base, relationship
 
-from typing import Tuple
+from typing import Tuple, Optional
 
 Base = declarative_base()
 
@@ -107,12 +107,12 @@ class Tag(BaseModel):
 
         return self.category.get_directory() / '{}.html'.format(self.slug)
 
-    def update_from_file(self, tag_directory: pathlib.Path):
-        """Read `tag_directory / self.get_file()` and update `display_name` and `description` from it
+    @staticmethod
+    def read_input_file(path: pathlib.Path, name: str) -> Tuple[str, Optional[str]]:
+        """Read `path` and extract `(display_name, description)` from it, `name` being the default display name
         """
 
-        path = tag_directory / self.get_input_file()
-        self.display_name = self.name
+        display_name, description = name, None
 
         if path.exists():
             with path.open('r') as f:
@@ -122,12 +122,21 @@ class Tag(BaseModel):
                     if next_line < 0:
                         next_line = len(content)
 
-                    self.display_name = content[1:next_line].strip()
-                    self.description = content[next_line + 1:]
+                    display_name = content[1:next_line].strip()
+                    description = content[next_line + 1:]
                 else:
-                    self.description = content
+                    description = content
+
+        return display_name, description
+
+    def update_from_file(self, tag_directory: pathlib.Path):
+        """Read `tag_directory / self.get_file()` and update `display_name` and `description` from it
+        """
+
+        self.display_name, self.description = self.read_input_file(tag_directory / self.get_input_file(), self.name)
 
     def to_html(self) -> str:
+        from markdown import markdown  # (not needed to crawl)
         return markdown(self.description)
 
 
@@ -149,6 +158,10 @@ class Picture(BaseModel):
     exif_focal_length = Column(Float)
     exif_orientation = Column(Integer)
 
+    # computed during thumbnailing
+    placeholder_color = Column(String)
+    placeholder_preview = Column(String)
+
     tags = relationship(
         'Tag', secondary=tag_picture_at, back_populates='pictures'
     )
@@ -182,19 +195,88 @@ class Thumbnail(BaseModel):
     path = Column(String)
     type = Column(String)
 
+    width = Column(Integer)
+    height = Column(Integer)
+    size = Column(Integer)
+
+    variant = Column(Integer)  # requested width, for the other sizes of a thumbnail type (`NULL` for the main one)
+    format = Column(String)  # for the other formats of a thumbnail type (`NULL` for the main one)
+    quality = Column(Integer)  # if it was searched for
+
     picture_id = Column(Integer, ForeignKey('picture.id'))
     picture = relationship('Picture', back_populates='thumbnails')
 
     @classmethod
-    def create(cls, picture: int, path: str, ttype: str):
+    def create(
+            cls,
+            picture: int,
+            path: str,
+            ttype: str,
+            dimension: Tuple[int, int] = (None, None),
+            size: int = None,
+            variant: int = None,
+            output_format: str = None,
+            quality: int = None
+    ):
         o = cls()
         o.picture_id = picture
         o.path = path
         o.type = ttype
+        o.width, o.height = dimension
+        o.size = size
+        o.variant = variant
+        o.format = output_format
+        o.quality = quality
 
         return o
 
 
+class ThumbnailJob(BaseModel):
+    """Creation of the thumbnails of a type (and their other versions) for a picture, by a worker
+    """
+
+    __tablename__ = 'thumbnail_job'
+    __table_args__ = (
+        UniqueConstraint('picture_id', 'type'),
+        Index('ix_thumbnail_job_claim', 'state', 'priority', 'id'),  # (see `ThumbnailJobQueue.claim()`)
+        Index('ix_thumbnail_job_picture_id', 'picture_id'),
+    )
+
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'  # quarantined, see `error`
+    SKIPPED = 'skipped'  # failed as well, but the type is optional, so the picture is still shown
+
+    type = Column(String)
+    state = Column(String, default=PENDING)
+    priority = Column(Integer, default=0)  # the lowest first
+
+    worker = Column(String)  # which claimed it
+    lease_expires = Column(DateTime)  # after which it can be claimed again, if the worker did not finish it
+    attempts = Column(Integer, default=0)
+    error = Column(String)
+    picture_modified = Column(DateTime)  # when it failed, so that it is attempted again if the picture changed
+
+    picture_id = Column(Integer, ForeignKey('picture.id'))
+
+    def __repr__(self):
+        return 'ThumbnailJob(id={}, picture_id={}, type={}, state={})'.format(
+            repr(self.id), repr(self.picture_id), repr(self.type), repr(self.state))
+
+
+class PictureFragment(BaseModel):
+    """Rendered HTML of a picture on the tag pages, and the digest of its inputs
+    """
+
+    __tablename__ = 'picture_fragment'
+
+    digest = Column(String)
+    html = Column(String)
+
+    picture_id = Column(Integer, ForeignKey('picture.id'), unique=True)
+
+
 class Page:
     def __init__(self, title: str, slug: str, content: str):
         self.title = title
@@ -202,6 +284,7 @@ class Page:
         self.content = content
 
     def to_html(self) -> str:
+        from markdown import markdown
         return markdown(self.content)
 
     def get_url(self) -> str:
@@ -1,4 +1,8 @@
 import pathlib
+from typing import Set
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
 from gallery_generator import logger
 from gallery_generator.models import Picture
@@ -10,6 +14,30 @@ from gallery_generator.controllers.tags import TagManager
 l_logger = logger.getChild('scripts.crawl')
 
 
+def add_picture(picture: Picture, tag_manager: TagManager, session: Session):
+    """Tag `picture` (creating tags if required), and add it to the database
+    """
+
+    tag_manager.tag_picture(picture)
+
+    l_logger.info('[{}]'.format(', '.join(t.name for t in picture.tags)))
+
+    session.add(picture)
+    session.commit()
+
+
+def remove_pictures(session: Session, found: Set[str]):
+    """Remove the pictures which path is not in `found` from the database
+    """
+
+    for picture in session.scalars(Picture.select()).all():
+        if picture.path not in found:
+            l_logger.info('REMOVED PICTURE {}'.format(picture.path))
+            session.delete(picture)
+
+    session.commit()
+
+
 def command_crawl(root: pathlib.Path, settings: dict, db: GalleryDatabase):
     """Go through all accessible pictures in the root directory, then for each of them
 
@@ -26,7 +54,8 @@ def command_crawl(root: pathlib.Path, settings: dict, db: GalleryDatabase):
     with db.make_session() as session:
         tag_manager = TagManager(root, session)
 
-        existing_pictures = dict((p.path, [p, False]) for p in session.scalars(Picture.select()).all())
+        existing_pictures = set(session.scalars(select(Picture.path)).all())
+        found = set()
 
         # add new pictures
         for path in seek_pictures(
@@ -37,23 +66,11 @@ def command_crawl(root: pathlib.Path, settings: dict, db: GalleryDatabase):
 
             path_str = str(path)
             l_logger.debug('FOUND {}'.format(path))
+            found.add(path_str)
 
             if path_str not in existing_pictures:
                 l_logger.info('NEW PICTURE {}'.format(path))
-
-                picture = create_picture_object(root, path)
-                tag_manager.tag_picture(picture)
-
-                l_logger.info('[{}]'.format(', '.join(t.name for t in picture.tags)))
-
-                session.add(picture)
-                session.commit()
-            else:
-                existing_pictures[path_str][1] = True
+                add_picture(create_picture_object(root, path), tag_manager, session)
 
         # check if there is pictures to remove
-        for picture, found in existing_pictures.values():
-            if not found:
-                session.delete(picture)
-
-        session.commit()
+        remove_pictures(session, found)
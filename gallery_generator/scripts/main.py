@@ -1,14 +1,10 @@
 import argparse
 import pathlib
-import yaml
 
 from gallery_generator import CONFIG_DIR_NAME
-from gallery_generator.controllers.database import GalleryDatabase
 from gallery_generator.scripts import exit_failure
-from gallery_generator.scripts.crawl import command_crawl
-from gallery_generator.scripts.init import command_init
-from gallery_generator.scripts.update import command_update
-from gallery_generator.controllers.settings import SETTINGS_BASE, merge_settings, SETTINGS_VALIDATION_SCHEMA
+
+# (the subcommands, and their dependencies, are only imported if they are used, see `main()`)
 
 
 def main():
@@ -17,8 +13,32 @@ def main():
     parser.add_argument('source', help='source directory', type=pathlib.Path)
 
     parser.add_argument('-i', '--init', action='store_true', help='Initialize')
-    parser.add_argument('-c', '--crawl', action='store_true', help='Update the database with new pictures')
+    parser.add_argument(
+        '-c', '--crawl', action='store_true',
+        help='Update the database with new pictures (together with `--update`, both are done at once)')
     parser.add_argument('-u', '--update', type=pathlib.Path, help='Create a static website in a folder')
+    parser.add_argument(
+        '--render-jobs', type=int, default=1, metavar='N', help='Render the tag pages with N worker processes')
+    parser.add_argument(
+        '--time-budget', type=float, metavar='SECONDS',
+        help='Stop creating thumbnails after that time, the missing ones being replaced until the next update')
+    parser.add_argument(
+        '--output-format', choices=('tar', 'zip', 'objects'), metavar='FORMAT',
+        help='Write the website in an archive (`tar` or `zip`), or in a content-addressed directory (`objects`), '
+             'rather than in a folder')
+    parser.add_argument(
+        '--export-delta', type=pathlib.Path, metavar='DIR',
+        help='Copy the files which changed since the previous update in a folder (with the list of the removed ones)')
+    parser.add_argument(
+        '--serve', type=pathlib.Path, metavar='TARGET',
+        help='Serve a preview of the website, rendered on request (with the thumbnails of a folder, if any)')
+    parser.add_argument('--port', type=int, default=8000, help='Port of the preview server')
+    parser.add_argument(
+        '--thumbnail-worker', type=pathlib.Path, metavar='TARGET',
+        help='Create the thumbnails of the pending jobs in a folder, until there is none left')
+    parser.add_argument(
+        '--retry-thumbnails', action='store_true',
+        help='Attempt the thumbnails which failed again (the pictures left out because of them are put back)')
 
     args = parser.parse_args()
 
@@ -29,29 +49,63 @@ def main():
     if not args.source.is_dir():
         return exit_failure('source `{}` is not a directory'.format(args.source))
 
+    if not (args.init or args.crawl or args.update or args.thumbnail_worker or args.serve or args.retry_thumbnails):
+        return
+
+    if args.export_delta and args.export_delta.exists() and any(args.export_delta.iterdir()):
+        return exit_failure('export directory `{}` is not empty'.format(args.export_delta))
+
     # fetch settings, if any
+    from gallery_generator.controllers.settings import SETTINGS_BASE, merge_settings, SETTINGS_VALIDATION_SCHEMA
+
     settings = SETTINGS_BASE
     path_settings = args.source / CONFIG_DIR_NAME / 'settings.yml'
 
     if path_settings.exists():
+        import yaml
+
         with path_settings.open() as f:
             new_settings = yaml.load(f, Loader=yaml.Loader)
             if new_settings:
                 settings = SETTINGS_VALIDATION_SCHEMA.validate(merge_settings([settings, new_settings]))
 
     # database
+    from gallery_generator.controllers.database import GalleryDatabase
     db = GalleryDatabase(args.source)
 
     # do stuffs
     if args.init:
+        from gallery_generator.scripts.init import command_init
         command_init(args.source, db)
-    if args.crawl:
+    if args.retry_thumbnails:
+        from gallery_generator.controllers.jobs import ThumbnailJobQueue
+        with db.make_session() as session:
+            ThumbnailJobQueue(session).retry()
+
+    if args.update and not args.update.exists() and args.output_format in (None, 'objects'):
+        args.update.mkdir()
+
+    if args.crawl and args.update:  # both at once
+        from gallery_generator.scripts.pipeline import command_crawl_update
+        command_crawl_update(
+            args.source, settings, db, args.update, render_jobs=args.render_jobs, time_budget=args.time_budget,
+            output_format=args.output_format, export_delta=args.export_delta)
+    elif args.crawl:
+        from gallery_generator.scripts.crawl import command_crawl
         command_crawl(args.source, settings, db)
-    if args.update:
-        if not args.update.exists():
-            args.update.mkdir()
+    elif args.update:
+        from gallery_generator.scripts.update import command_update
+        command_update(
+            args.source, settings, db, args.update, render_jobs=args.render_jobs, time_budget=args.time_budget,
+            output_format=args.output_format, export_delta=args.export_delta)
+
+    if args.thumbnail_worker:
+        from gallery_generator.scripts.worker import command_thumbnail_worker
+        command_thumbnail_worker(args.source, settings, db, args.thumbnail_worker)
 
-        command_update(args.source, settings, db, args.update)
+    if args.serve:
+        from gallery_generator.scripts.serve import command_serve
+        command_serve(args.source, settings, db, args.serve, port=args.port)
 
 
 if __name__ == '__main__':
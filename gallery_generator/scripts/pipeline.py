@@ -0,0 +1,127 @@
+import pathlib
+import time
+from typing import Iterator, Set
+
+from sqlalchemy import select
+
+from gallery_generator import logger
+from gallery_generator.models import Picture
+from gallery_generator.controllers.database import GalleryDatabase
+from gallery_generator.controllers.jobs import ThumbnailJobQueue, run_jobs
+from gallery_generator.controllers.output import OutputWriter
+from gallery_generator.controllers.pictures import create_picture_object, seek_pictures
+from gallery_generator.controllers.pipeline import Pipeline, batched
+from gallery_generator.controllers.tags import TagManager
+from gallery_generator.controllers.thumbnails import Thumbnailer
+from gallery_generator.scripts.crawl import add_picture, remove_pictures
+from gallery_generator.scripts.update import command_update, get_thumb_types, PRIORITY_OTHERS
+from gallery_generator.snapshot import PictureRecord
+from gallery_generator.views import TagPageMixin
+
+l_logger = logger.getChild('scripts.pipeline')
+
+QUEUE_SIZE = 16  # maximum number of pictures waiting between two stages
+
+
+def command_crawl_update(
+    root: pathlib.Path,
+    settings: dict,
+    db: GalleryDatabase,
+    target: pathlib.Path,
+    render_jobs: int = 1,
+    time_budget: float = None,
+    queue_size: int = QUEUE_SIZE,
+    output_format: str = None,
+    export_delta: pathlib.Path = None
+):
+    """Crawl and update at once, the new pictures going through the following stages, which run concurrently:
+
+    - discovery of the pictures,
+    - extraction of their infos,
+    - tagging and insertion in the database,
+    - creation of their thumbnails (for the tag pages),
+
+    so that the thumbnails are created while the crawl is still going on (unless the outputs go in an archive, which
+    is only written by the update phase).
+    Then, the pictures which were not found are removed, and the outputs whose inputs changed are rendered.
+
+    The time budget, if any, starts with the pipeline: the jobs which are not run in time are left for the next run.
+    """
+
+    if not db.exists():
+        raise FileNotFoundError('Database file `{}` does not exists'.format(db.path))
+
+    l_logger.info('* Crawling and update phases *')
+
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+    with db.make_session() as session:
+        existing_pictures = set(session.scalars(select(Picture.path)).all())
+        ThumbnailJobQueue(session).clean()  # (once, see `make_thumbnails()`)
+
+    found: Set[str] = set()
+
+    def discover(_: Iterator) -> Iterator[pathlib.Path]:
+        for path in seek_pictures(
+                root,
+                extensions=settings['crawl_phase']['picture_exts'],
+                exclude_dirs=settings['crawl_phase']['excluded_dirs']
+        ):
+            path_str = str(path)
+            l_logger.debug('FOUND {}'.format(path))
+            found.add(path_str)
+
+            if path_str not in existing_pictures:
+                l_logger.info('NEW PICTURE {}'.format(path))
+                yield path
+
+    def extract(paths: Iterator[pathlib.Path]) -> Iterator[Picture]:
+        for path in paths:
+            yield create_picture_object(root, path)
+
+    def insert(pictures: Iterator[Picture]) -> Iterator[PictureRecord]:
+        with db.make_session() as session:
+            tag_manager = TagManager(root, session)
+            for picture in pictures:
+                add_picture(picture, tag_manager, session)
+                yield PictureRecord(*(getattr(picture, c.key) for c in PictureRecord.columns()))
+
+    def make_thumbnails(pictures: Iterator[PictureRecord]) -> Iterator[PictureRecord]:
+        writer = OutputWriter(target, precompress=settings['update_phase']['output']['precompress'])
+
+        with db.make_session() as session:
+            thumbnailer = Thumbnailer(
+                root, target, session, get_thumb_types(settings), writer=writer,
+                fingerprint=settings['update_phase']['output']['fingerprint']
+            )
+
+            # (through the job queue, so that a picture which fails is quarantined, as during the update)
+            queue = ThumbnailJobQueue(session, optional_types=thumbnailer.get_optional_types())
+
+            for batch in batched(pictures, queue.batch_size):
+                queue.add(
+                    (picture.id, ttype, PRIORITY_OTHERS)
+                    for picture in batch for ttype in TagPageMixin.picture_thumbnail_types
+                    if thumbnailer.get_missing(picture, ttype)
+                )
+
+                run_jobs(queue, thumbnailer, deadline)
+                yield from batch
+
+    stages = [discover, extract, insert]
+    if output_format is None:
+        stages.append(make_thumbnails)
+
+    Pipeline(stages, queue_size=queue_size).run()
+
+    # check if there is pictures to remove
+    with db.make_session() as session:
+        remove_pictures(session, found)
+
+    # the thumbnails of the new pictures exist by now (unless there was no time left for them), and the outputs
+    # which did not change are skipped
+    command_update(
+        root, settings, db, target, render_jobs=render_jobs,
+        time_budget=max(0., deadline - time.monotonic()) if deadline is not None else None,
+        output_format=output_format, export_delta=export_delta
+    )
@@ -0,0 +1,254 @@
+import mimetypes
+import pathlib
+import urllib.parse
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Optional, Tuple, Set, List
+
+from gallery_generator import logger, CONFIG_DIR_NAME, CACHE_DIR_NAME, PAGE_DIR_NAME
+from gallery_generator.controllers.database import GalleryDatabase
+from gallery_generator.controllers.fragments import PictureFragmentCache
+from gallery_generator.controllers.preview import PreviewThumbnailer
+from gallery_generator.controllers.tags import TagManager
+from gallery_generator.models import Page, Tag
+from gallery_generator.scripts.update import CommandUpdate, get_tag_views, get_thumb_types
+from gallery_generator.views import BaseView, PageView, IndexView, StyleView, ZoomView, TagPageMixin, \
+    search_views, set_bytecode_cache
+
+l_logger = logger.getChild('scripts.serve')
+
+PORT = 8000
+
+
+class CommandServe(CommandUpdate):
+    """Serve a preview of the website, whose views are rendered when they are requested (from the snapshot, in
+    memory), and kept until their inputs change.
+
+    The files of `.gallery/tags` and `.gallery/pages` are watched (before each view is served, but not before the
+    files which already exist, such as the thumbnails), and only the views which depend on the ones which changed
+    are rendered again: the views of a tag (or a page) if its description changed, every view if its name changed
+    (since the navbar is on every page).
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.views: Dict[str, BaseView] = {}
+        self.contents: Dict[str, bytes] = {}  # rendered views
+        self.target: pathlib.Path = None
+        self.root: pathlib.Path = None
+        self.mtimes: Dict[pathlib.Path, int] = {}  # of the watched files
+
+    def get_watched_files(self) -> Dict[pathlib.Path, int]:
+        """The files of the tags and pages, with their modification time"""
+
+        mtimes = {}
+        for directory, pattern in [(TagManager.TAG_DIRECTORY, '*/*.md'), (PAGE_DIR_NAME, '*.md')]:
+            for path in (self.root / CONFIG_DIR_NAME / directory).glob(pattern):
+                mtimes[path] = path.stat().st_mtime_ns
+
+        return mtimes
+
+    def set_views(self):
+        """(Re)create the views, and render the parts that are shared by every page"""
+
+        self.render_fragments()
+
+        views = []
+        for tag in self.snapshot.tags():
+            views.extend(get_tag_views(tag, self.common_context, self.tag_pages))
+
+        views.extend(PageView(page, self.common_context) for page in self.snapshot.pages.values())
+        views.append(IndexView(self.common_context))
+        views.extend(search_views(self.common_context))
+        if 'deep_zoom' in self.thumb_types:
+            views.append(ZoomView(self.common_context))
+
+        style_view = StyleView(self.common_context, cache_directory=self.cache_directory / 'sass')
+        self.assets[style_view.get_url()] = style_view.get_url()
+        views.append(style_view)
+
+        self.views = dict((str(view.get_url()), view) for view in views)
+
+    def reload_tag(self, path: pathlib.Path) -> Tuple[List[str], bool]:
+        """Read the file of a tag again. Return the URLs of its views, and whether its name changed
+        """
+
+        tag_directory = self.root / CONFIG_DIR_NAME / TagManager.TAG_DIRECTORY
+        for tags in self.snapshot.tags_per_cat.values():
+            for i, tag in enumerate(tags):
+                if tag_directory / tag.get_input_file() == path:
+                    display_name, description = Tag.read_input_file(path, tag.name)
+                    tags[i] = tag._replace(display_name=display_name, description=description)
+
+                    return [
+                        url for url, view in self.views.items() if isinstance(view, TagPageMixin) and view.tag == tag
+                    ], display_name != tag.display_name
+
+        return [], False  # (an empty tag)
+
+    def reload_page(self, path: pathlib.Path) -> Tuple[str, bool]:
+        """Read the file of a page again (or remove it). Return its URL, and whether its title changed (or if it was
+        added or removed)
+        """
+
+        slug = path.stem
+        previous = self.snapshot.pages.get(slug)
+
+        if not path.exists():
+            del self.snapshot.pages[slug]
+            return str(previous.get_url()), True
+
+        page = self.snapshot.pages[slug] = Page.create_from_file(path)
+        return str(page.get_url()), previous is None or previous.title != page.title
+
+    def check_changes(self):
+        """Find the watched files which changed, and forget the views which depend on them"""
+
+        mtimes = self.get_watched_files()
+        changed = set(
+            path for path in set(mtimes) | set(self.mtimes) if mtimes.get(path) != self.mtimes.get(path))
+        self.mtimes = mtimes
+
+        if not changed:
+            return
+
+        urls: Set[str] = set()
+        everything = False
+
+        for path in changed:
+            l_logger.info('CHANGED {}'.format(path))
+
+            if path.parent.parent.name == TagManager.TAG_DIRECTORY:
+                tag_urls, renamed = self.reload_tag(path)
+                urls.update(tag_urls)
+            else:
+                url, renamed = self.reload_page(path)
+                urls.add(url)
+
+            everything = everything or renamed
+
+        if everything:
+            self.contents.clear()
+        else:
+            for url in urls:
+                self.contents.pop(url, None)
+
+        self.set_views()
+
+    def get(self, url: str) -> Optional[Tuple[bytes, str]]:
+        """Get the content and the mimetype of `url`, rendering it (or making the thumbnail) if needed
+        """
+
+        preview = self.thumbnailer.get_preview(url)
+        if preview is not None:
+            return preview
+
+        mimetype = mimetypes.guess_type(url)[0] or 'application/octet-stream'
+
+        # the files which already exist (e.g., the thumbnails)
+        path = (self.target / url).resolve()
+        exists = path.is_file() and self.target.resolve() in path.parents
+
+        # (the watched files only change the views, or add some, e.g., a new page)
+        if url in self.views or not exists:
+            self.check_changes()
+
+        if url in self.views:
+            if url not in self.contents:
+                l_logger.info('GENERATE {}'.format(url))
+                content = self.views[url].render_content()
+                self.contents[url] = content.encode('utf-8') if isinstance(content, str) else content
+
+            return self.contents[url], mimetype
+
+        if exists:
+            with path.open('rb') as f:
+                return f.read(), mimetype
+
+        return None
+
+    def load(self, root: pathlib.Path, settings: dict, db: GalleryDatabase, target: pathlib.Path):
+        """Load the snapshot and the thumbnails of `target` (the output of the previous updates, if any)
+        """
+
+        if not db.exists():
+            raise FileNotFoundError('Database file `{}` does not exists'.format(db.path))
+
+        self.root = root
+        self.target = target
+
+        self.thumb_types = get_thumb_types(settings)
+        self.page_context = settings['update_phase']['page_context']
+        self.tag_pages = settings['update_phase']['tag_pages']
+        self.now = datetime.now().strftime('%d/%m/%Y')
+
+        self.cache_directory = root / CONFIG_DIR_NAME / CACHE_DIR_NAME
+        set_bytecode_cache(self.cache_directory / 'jinja')
+
+        # (nothing is read from the database afterwards)
+        with db.make_session() as session:
+            self.thumbnailer = PreviewThumbnailer(root, target, session, self.thumb_types)
+            self.fetch_all(root, session)
+
+        self.fragment_cache = PictureFragmentCache()
+        self.contents = {}
+        self.mtimes = self.get_watched_files()
+        self.set_views()
+
+    def __call__(
+        self,
+        root: pathlib.Path,
+        settings: dict,
+        db: GalleryDatabase,
+        target: pathlib.Path,
+        host: str = 'localhost',
+        port: int = PORT
+    ):
+        """Serve the preview on `host:port`, until interrupted
+        """
+
+        l_logger.info('* Preview server *')
+
+        self.load(root, settings, db, target)
+
+        server = HTTPServer((host, port), make_request_handler(self))
+        l_logger.warning('serving on http://{}:{}/'.format(host, port))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def make_request_handler(command: CommandServe) -> type:
+    """Get a handler of the requests, which serves what `command` gives"""
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip('/')
+            if url == '' or url.endswith('/'):
+                url += 'index.html'
+
+            result = command.get(url)
+            if result is None:
+                self.send_error(404)
+                return
+
+            content, mimetype = result
+            self.send_response(200)
+            self.send_header('Content-Type', mimetype)
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args):
+            l_logger.debug(format % args)
+
+    return RequestHandler
+
+
+command_serve = CommandServe()
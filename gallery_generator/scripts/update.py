@@ -1,20 +1,62 @@
+import multiprocessing
 import pathlib
+import time
 from datetime import datetime
-from typing import Dict, List
+from typing import List, Tuple, Dict, Iterator, Optional
 
+from markupsafe import Markup
 from sqlalchemy.orm import Session
-from sqlalchemy import select, func
 
-from gallery_generator import logger, CONFIG_DIR_NAME, PAGE_DIR_NAME
+from gallery_generator import logger, __version__, CONFIG_DIR_NAME, CACHE_DIR_NAME
 from gallery_generator.controllers.database import GalleryDatabase
-from gallery_generator.controllers.tags import TagManager
-from gallery_generator.controllers.thumbnails import TRANSFORMER_TYPES, Thumbnailer
-from gallery_generator.models import Category, tag_picture_at, Picture, Tag, Page, Thumbnail
-from gallery_generator.views import TagView, PageView, IndexView, StyleView
+from gallery_generator.controllers.delta import OutputManifest
+from gallery_generator.controllers.dependencies import DependencyManifest, digest
+from gallery_generator.controllers.fragments import PictureFragmentCache
+from gallery_generator.controllers.jobs import ThumbnailJobQueue, run_jobs
+from gallery_generator.controllers.output import OutputWriter, make_writer
+from gallery_generator.controllers.thumbnails import TRANSFORMER_TYPES, BaseImageTransform, Thumbnailer
+from gallery_generator.models import ThumbnailJob
+from gallery_generator.snapshot import Snapshot, TagRecord, PictureRecord
+from gallery_generator.views import BaseView, PageView, IndexView, StyleView, ZoomView, NavbarView, FooterView, \
+    NetlifyHeadersView, HtaccessView, TagPageMixin, search_views, set_bytecode_cache, tag_views
 
 l_logger = logger.getChild('scripts.update')
 
 
+def get_tag_views(tag: TagRecord, common_context: dict, tag_pages: dict) -> List[BaseView]:
+    """Get the views of `tag`, following the `tag_pages` settings
+    """
+
+    return tag_views(
+        tag,
+        common_context['snapshot'].pictures_of(tag),
+        common_context,
+        page_size=tag_pages['page_size_per_category'].get(tag.category.slug, tag_pages['page_size']),
+        fallback_pages=tag_pages['fallback_pages']
+    )
+
+
+def get_thumb_types(settings: dict) -> Dict[str, BaseImageTransform]:
+    """Get the thumbnail types, following the `thumbnails` settings
+    """
+
+    thumb_types = {}
+    for key, conf in settings['update_phase']['thumbnails'].items():
+        l_logger.info('REGISTER thumbnail format {}'.format(key))
+        conf = conf.copy()
+        transformer_type = conf.pop('type')
+        thumb_types[key] = TRANSFORMER_TYPES[transformer_type](**conf)
+
+    return thumb_types
+
+
+# order of the thumbnail jobs (see `CommandUpdate.get_thumbnail_jobs()`)
+PRIORITY_INDEX = 0
+PRIORITY_COVERS = 1
+PRIORITY_FIRST_PAGE = 2
+PRIORITY_OTHERS = 3
+
+
 class CommandUpdate:
     def __init__(self):
         self.thumb_types = {}
@@ -22,127 +64,342 @@ class CommandUpdate:
 
         self.page_context = {}
 
-        self.pages_dic: Dict[str, Page] = {}
-        self.categories_dic: Dict[str, Category] = {}
-        self.tags_per_cat_dic: Dict[str, List[Tag]] = {}
-        self.thumbnails_dic: Dict[str, Thumbnail] = {}
+        self.snapshot: Snapshot = None
+
+        self.manifest: DependencyManifest = None
+        self.output_manifest: OutputManifest = None
+        self.site_digest: str = None
+        self.rendered: List[str] = []
+
+        self.render_jobs = 1
+        self.writer: OutputWriter = None
+
+        self.now: str = None
+        self.fragments: Dict[str, Markup] = {}
+        self.tag_pages: dict = {}
+        self.fingerprint = False
+        self.cache_directory: pathlib.Path = None
+        self.assets: Dict[str, str] = {}  # where the fingerprinted outputs are (e.g., `style.css`)
+        self.deadline: float = None  # for the thumbnails (see `time.monotonic()`)
+        self.fragment_cache: PictureFragmentCache = None
 
     @property
     def common_context(self) -> dict:
         return dict(
             # required
             thumbnailer=self.thumbnailer,
-            pages=self.pages_dic,
-            categories=self.categories_dic,
-            tags_per_cat=self.tags_per_cat_dic,
-            now=datetime.now().strftime('%d/%m/%Y'),
+            snapshot=self.snapshot,
+            pages=self.snapshot.pages,
+            categories=self.snapshot.categories,
+            tags_per_cat=self.snapshot.tags_per_cat,
+            now=self.now,
+            assets=self.assets,
+            fragment_cache=self.fragment_cache,
             # others
-            **self.page_context
+            **self.page_context,
+            # pre-rendered fragments
+            **self.fragments
         )
 
     def fetch_all(self, root: pathlib.Path, session: Session):
+        l_logger.info('FETCH snapshot')
+        self.snapshot = Snapshot.load(root, session)
+
+        # everything that ends up on every page (i.e., the navbar)
+        self.site_digest = digest(
+            __version__,
+            [(c.slug, c.name, [(str(t.get_url()), t.display_name) for t in self.snapshot.tags_per_cat[c.slug]])
+             for c in self.snapshot.categories.values()],
+            [(p.get_url(), p.title) for p in self.snapshot.pages.values()]
+        )
 
-        # fetch pages
-        for path in (root / CONFIG_DIR_NAME / PAGE_DIR_NAME).glob('*.md'):
-            l_logger.info('FETCH {}'.format(path))
-            page = Page.create_from_file(path)
-            self.pages_dic[page.slug] = page
-
-        # fetch categories... And others:
-        categories = session.scalars(Category.select().order_by(Category.id)).all()
-
-        for category in categories:
-            subq = select(
-                tag_picture_at.c.left_id,
-                tag_picture_at.c.right_id,
-                func.max(Picture.exif_datetime_original)
-            ) \
-                .join(Picture, tag_picture_at.c.right_id == Picture.id) \
-                .group_by(tag_picture_at.c.left_id).subquery()
-
-            q = select(Tag, Picture) \
-                .where(Tag.category_id == category.id) \
-                .join(subq, subq.c.left_id == Tag.id) \
-                .join(Picture, subq.c.right_id == Picture.id) \
-                .order_by(Picture.exif_datetime_original.desc())
-
-            self.categories_dic[category.slug] = category
-            tag_and_thumb = session.execute(q).all()
-            self.tags_per_cat_dic[category.slug] = [c[0] for c in tag_and_thumb]
-            self.thumbnails_dic.update(**dict((t.slug, p) for t, p in tag_and_thumb))
-
-            # update tags
-            for tag in self.tags_per_cat_dic[category.slug]:
-                tag.update_from_file(root / CONFIG_DIR_NAME / TagManager.TAG_DIRECTORY)
-
-    def render_all(self, target: pathlib.Path, session: Session):
-
-        # make directory for thumbnails
-        path_thumbnail = target / self.thumbnailer.THUMBNAIL_DIRECTORY
-        if not path_thumbnail.exists():
-            path_thumbnail.mkdir()
+    def get_thumbnail_jobs(self) -> Iterator[Tuple[int, str, int]]:
+        """The thumbnails which are missing, as `(picture_id, type, priority)`: the ones of the covers which are on the
+        index first, then the social media cards of the covers, then the small ones of the first page of the tags,
+        then the others
+        """
 
-        # render style
-        l_logger.info('GENERATE style.css')
-        view = StyleView(self.common_context)
-        view.render(target)
+        jobs: Dict[Tuple[int, str], int] = {}
 
-        # renders categories and tags
-        for category in self.categories_dic.values():
+        def add(picture: PictureRecord, ttype: str, priority: int):
+            key = picture.id, ttype
+            if key in jobs:
+                jobs[key] = min(jobs[key], priority)
+            elif self.thumbnailer.get_missing(picture, ttype):
+                jobs[key] = priority
 
-            # create directory for category
-            path_category = target / category.get_directory()
-            if not path_category.exists():
-                path_category.mkdir()
+        for tags in IndexView(self.common_context).get_tags():
+            for tag in tags:
+                add(self.snapshot.cover(tag), IndexView.cover_thumbnail_type, PRIORITY_INDEX)
 
-            for tag in self.tags_per_cat_dic[category.slug]:
-                l_logger.info('GENERATE {}'.format(tag.get_url()))
+        for tag in self.snapshot.tags():
+            for ttype in TagPageMixin.cover_thumbnail_types:
+                add(self.snapshot.cover(tag), ttype, PRIORITY_COVERS)
 
-                # get pictures (in correct order)
-                pictures = session.scalars(
-                    Picture.select()
-                    .join(tag_picture_at, tag_picture_at.c.right_id == Picture.id)
-                    .join(Tag, Tag.id == tag_picture_at.c.left_id)
-                    .where(Tag.id == tag.id)
-                    .order_by(Picture.exif_datetime_original)
-                ).all()
+            first_page = get_tag_views(tag, self.common_context, self.tag_pages)[0]
+            for picture in first_page.get_page_pictures():
+                add(picture, 'gallery_small', PRIORITY_FIRST_PAGE)
+
+        for picture in self.snapshot.pictures:
+            for ttype in TagPageMixin.picture_thumbnail_types:
+                add(picture, ttype, PRIORITY_OTHERS)
+
+        return ((picture_id, ttype, priority) for (picture_id, ttype), priority in jobs.items())
+
+    def make_thumbnails(self, root: pathlib.Path, session: Session):
+        """Create the missing thumbnails through the job queue, so that the work is shared with the workers (if any)
+        and that the pictures which fail are quarantined.
+
+        If there is a time budget, the thumbnails which are not created in time are replaced by a stand-in, and will
+        be created by the next run.
+        """
+
+        queue = ThumbnailJobQueue(session, optional_types=self.thumbnailer.get_optional_types())
+
+        while True:
+            queue.enqueue(self.get_thumbnail_jobs())
+
+            done, failed = run_jobs(queue, self.thumbnailer, self.deadline)
+            l_logger.info('{} thumbnail job(s) done, {} failed'.format(done, failed))
+
+            self.thumbnailer.refresh()  # (the ones of the workers)
+
+            if failed == 0:
+                break
+
+            self.fetch_all(root, session)  # without the quarantined pictures, so some tags may have another cover
+
+        if self.deadline is not None:
+            left = queue.counts().get(ThumbnailJob.PENDING, 0)
+            if left > 0:
+                l_logger.warning('out of time, {} thumbnail job(s) left for the next run'.format(left))
+
+            self.thumbnailer.stop_creating()
+
+    def must_render(self, view: BaseView) -> bool:
+        """Check whether the inputs of `view` changed since the previous run
+        """
+
+        if self.manifest.is_up_to_date(view.get_url(), digest(self.site_digest, view.get_dependencies())):
+            l_logger.debug('SKIP {}'.format(view.get_url()))
+            return False
+
+        return True
+
+    def render(self, view: BaseView):
+        """Render `view`, unless its inputs did not change since the previous run
+        """
+
+        if self.must_render(view):
+            l_logger.info('GENERATE {}'.format(view.get_url()))
+            view.render(self.writer)
+            self.manifest.set_output_url(view.get_url(), view.output_url)
+            self.rendered.append(str(view.get_url()))
+
+    def render_tags_in_parallel(self, tags: List[TagRecord]):
+        """Render `tags` with `self.render_jobs` worker processes.
+        Thumbnails are created beforehand (by the dependency check), so that the workers only need a read-only index.
+        """
+
+        jobs = []
+        for tag in tags:
+            views = get_tag_views(tag, self.common_context, self.tag_pages)
+            jobs.extend((tag, i) for i, view in enumerate(views) if self.must_render(view))
+
+        if not jobs:
+            return
+
+        # (each worker has its own cache of the pictures, in memory only)
+        context = dict(
+            self.common_context, thumbnailer=self.thumbnailer.index(), fragment_cache=PictureFragmentCache())
+        chunk_size = max(1, len(jobs) // (4 * self.render_jobs))
+
+        # (if the workers cannot write in the target, e.g., an archive, they send the outputs back)
+        target = self.writer.target if self.writer.SHARED else None
+
+        with multiprocessing.Pool(
+                self.render_jobs,
+                initializer=_init_render_worker,
+                initargs=(context, self.tag_pages, target, self.writer.precompress)
+        ) as pool:
+            for url, changed, output, (hits, misses) in pool.imap(_render_tag_view, jobs, chunksize=chunk_size):
+                l_logger.info('GENERATE {}'.format(url))
+                self.rendered.append(url)
+                self.fragment_cache.hits += hits
+                self.fragment_cache.misses += misses
+                if output is not None:
+                    self.writer.write(*output)
+                elif changed:
+                    self.writer.changed.append(url)
+
+    def render_fragments(self):
+        """Render the parts that are shared by every page, once
+        """
+
+        self.fragments = {}  # (the fragments are rendered with the templates)
+        self.fragments = dict(
+            (view.context_name, view.render_content())
+            for view in (NavbarView(self.common_context), FooterView(self.common_context))
+        )
 
-                # render
-                view = TagView(tag, pictures, self.common_context)
-                view.render(target)
+    def render_all(self):
+
+        self.rendered = []
+        self.render_fragments()
+
+        # render style
+        style_view = StyleView(
+            self.common_context, fingerprint=self.fingerprint, cache_directory=self.cache_directory / 'sass')
+        self.render(style_view)
+        self.assets.clear()
+        self.assets[style_view.get_url()] = self.manifest.get_output_url(style_view.get_url())
+
+        # renders categories and tags
+        if self.render_jobs > 1:
+            self.render_tags_in_parallel(list(self.snapshot.tags()))
+        else:
+            for tag in self.snapshot.tags():
+                for view in get_tag_views(tag, self.common_context, self.tag_pages):
+                    self.render(view)
 
         # generate pages
-        for page in self.pages_dic.values():
-            l_logger.info('GENERATE {}'.format(page.get_url()))
-            view = PageView(page, self.common_context)
-            view.render(target)
+        for page in self.snapshot.pages.values():
+            self.render(PageView(page, self.common_context))
 
         # generate index
-        l_logger.info('GENERATE index.html')
-        view = IndexView(self.thumbnails_dic, self.common_context)
-        view.render(target)
+        self.render(IndexView(self.common_context))
+
+        # generate the search page and its index
+        for view in search_views(self.common_context):
+            self.render(view)
+
+        # generate the viewer of the deep zooms
+        if 'deep_zoom' in self.thumb_types:
+            self.render(ZoomView(self.common_context))
+
+        # generate the cache rules for the server
+        if self.fingerprint:
+            self.render(NetlifyHeadersView(self.common_context))
+            self.render(HtaccessView(self.common_context))
+
+        l_logger.info('{} output(s) generated, {} up to date'.format(
+            len(self.rendered), len(self.manifest.current) - len(self.rendered)))
+
+    def __call__(
+        self,
+        root: pathlib.Path,
+        settings: dict,
+        db: GalleryDatabase,
+        target: pathlib.Path,
+        render_jobs: int = 1,
+        time_budget: float = None,
+        output_format: str = None,
+        export_delta: pathlib.Path = None
+    ):
+        """Create the thumbnails and render the outputs in `target`, which is a directory, or an archive for the
+        other `output_format`s (see `make_writer()`).
+
+        Then, the output files are compared to the ones of the previous build (see `OutputManifest`), and the ones
+        which changed are copied in `export_delta`, if any.
+        """
 
-    def __call__(self, root: pathlib.Path, settings: dict, db: GalleryDatabase, target: pathlib.Path):
         l_logger.info('* Update phase *')
 
-        for key, conf in settings['update_phase']['thumbnails'].items():
-            l_logger.info('REGISTER thumbnail format {}'.format(key))
-            conf = conf.copy()
-            transformer_type = conf.pop('type')
-            self.thumb_types[key] = TRANSFORMER_TYPES[transformer_type](**conf)
+        self.render_jobs = render_jobs
+        self.deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+        self.thumb_types = get_thumb_types(settings)
 
         self.page_context = settings['update_phase']['page_context']
+        self.tag_pages = settings['update_phase']['tag_pages']
+        self.fingerprint = settings['update_phase']['output']['fingerprint']
+        self.now = datetime.now().strftime('%d/%m/%Y')
+
+        self.cache_directory = root / CONFIG_DIR_NAME / CACHE_DIR_NAME
+        set_bytecode_cache(self.cache_directory / 'jinja')
+
+        writer = make_writer(target, output_format, precompress=settings['update_phase']['output']['precompress'])
 
-        with db.make_session() as session:
+        with db.make_session() as session, writer:
 
             # create thumbnailer
-            self.thumbnailer = Thumbnailer(root, target, session, self.thumb_types)
+            self.writer = writer
+            self.thumbnailer = Thumbnailer(
+                root, target, session, self.thumb_types, writer=self.writer, fingerprint=self.fingerprint)
 
             # fetch other
             self.fetch_all(root, session)
 
+            self.make_thumbnails(root, session)
+
             # render
-            self.render_all(target, session)
+            self.fragment_cache = PictureFragmentCache(session)
+            self.manifest = DependencyManifest(root, target, self.writer.exists)
+            self.manifest.load()
+
+            self.render_all()
+
+            self.manifest.save()
+
+        l_logger.info('{} file(s) changed in `{}`'.format(len(self.writer.changed), target))
+
+        self.output_manifest = OutputManifest(root, target)
+        self.output_manifest.load()
+
+        try:
+            self.output_manifest.update(self.writer)
+            if export_delta is not None:
+                self.output_manifest.export_delta(self.writer, export_delta)
+        finally:
+            self.writer.release()
+
+        self.output_manifest.save()
+        l_logger.info('{} file(s) added, {} changed and {} removed since the previous build'.format(
+            len(self.output_manifest.added), len(self.output_manifest.changed), len(self.output_manifest.removed)))
+        l_logger.info('{} picture(s) rendered, {} reused'.format(self.fragment_cache.misses, self.fragment_cache.hits))
+
+        if self.thumbnailer.searched > 0:
+            l_logger.info('{} byte(s) saved by searching the quality of {} thumbnail(s)'.format(
+                self.thumbnailer.bytes_saved, self.thumbnailer.searched))
+
+
+# worker processes (see `CommandUpdate.render_tags_in_parallel()`)
+_worker_context: dict = None
+_worker_tag_pages: dict = None
+_worker_writer: OutputWriter = None
+
+
+def _init_render_worker(
+        common_context: dict, tag_pages: dict, target: Optional[pathlib.Path], precompress: bool = False):
+    global _worker_context, _worker_tag_pages, _worker_writer
+
+    _worker_context = common_context
+    _worker_tag_pages = tag_pages
+    _worker_writer = OutputWriter(target, precompress) if target is not None else None
+
+
+def _render_tag_view(
+        job: Tuple[TagRecord, int]) -> Tuple[str, bool, Optional[Tuple[str, bytes]], Tuple[int, int]]:
+    """Render a view, and write it, if possible. Otherwise, its output is given back, as `(output_url, content)`.
+    The hits and misses of the cache of the pictures are given back as well, to be counted by the main process.
+    """
+
+    tag, i = job
+    view = get_tag_views(tag, _worker_context, _worker_tag_pages)[i]
+
+    cache: PictureFragmentCache = _worker_context['fragment_cache']
+    hits, misses = cache.hits, cache.misses
+
+    if _worker_writer is None:
+        content = view.render_content()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        output, changed = (view.get_output_url(content), content), False
+    else:
+        output, changed = None, view.render(_worker_writer)
+
+    return str(view.get_url()), changed, output, (cache.hits - hits, cache.misses - misses)
 
 
 command_update = CommandUpdate()
@@ -0,0 +1,34 @@
+import pathlib
+
+from gallery_generator import logger
+from gallery_generator.controllers.database import GalleryDatabase
+from gallery_generator.controllers.jobs import ThumbnailJobQueue, run_jobs
+from gallery_generator.controllers.output import OutputWriter
+from gallery_generator.controllers.thumbnails import Thumbnailer
+from gallery_generator.scripts.update import get_thumb_types
+
+l_logger = logger.getChild('scripts.worker')
+
+
+def command_thumbnail_worker(root: pathlib.Path, settings: dict, db: GalleryDatabase, target: pathlib.Path):
+    """Create the thumbnails of the pending jobs (see `ThumbnailJobQueue`) in `target`, until there is none left.
+
+    Several workers can run at the same time (and together with the update phase, which adds the jobs).
+    """
+
+    if not db.exists():
+        raise FileNotFoundError('Database file `{}` does not exists'.format(db.path))
+
+    l_logger.info('* Thumbnail worker *')
+
+    with db.make_session() as session:
+        writer = OutputWriter(target, precompress=settings['update_phase']['output']['precompress'])
+        thumbnailer = Thumbnailer(
+            root, target, session, get_thumb_types(settings), writer=writer,
+            fingerprint=settings['update_phase']['output']['fingerprint']
+        )
+
+        queue = ThumbnailJobQueue(session, optional_types=thumbnailer.get_optional_types())
+        done, failed = run_jobs(queue, thumbnailer)
+
+    l_logger.info('{} thumbnail job(s) done, {} failed'.format(done, failed))
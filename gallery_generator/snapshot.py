@@ -0,0 +1,240 @@
+"""
+Read-only snapshot of the gallery, used during the render phase instead of live ORM objects.
+"""
+
+import pathlib
+from datetime import datetime
+from typing import NamedTuple, Tuple, Dict, List, Optional, Iterable
+
+from markdown import markdown
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from gallery_generator import CONFIG_DIR_NAME, PAGE_DIR_NAME
+from gallery_generator.models import Category, Tag, Picture, Thumbnail, ThumbnailJob, Page, tag_picture_at
+
+
+class CategoryRecord(NamedTuple):
+    id: int
+    name: str
+    slug: str
+
+    def get_directory(self) -> pathlib.Path:
+        return pathlib.Path(self.slug)
+
+
+class PictureRecord(NamedTuple):
+    id: int
+    path: str
+    width: int
+    height: int
+    size: int
+    date_modified: datetime
+
+    exif_datetime_original: Optional[datetime]
+    exif_exposure_time: Optional[float]
+    exif_f_number: Optional[float]
+    exif_make: Optional[str]
+    exif_model: Optional[str]
+    exif_iso_speed: Optional[int]
+    exif_focal_length: Optional[float]
+    exif_orientation: Optional[int]
+
+    @classmethod
+    def columns(cls) -> tuple:
+        return (
+            Picture.id, Picture.path, Picture.width, Picture.height, Picture.size, Picture.date_obj_modified,
+            Picture.exif_datetime_original, Picture.exif_exposure_time, Picture.exif_f_number, Picture.exif_make,
+            Picture.exif_model, Picture.exif_iso_speed, Picture.exif_focal_length, Picture.exif_orientation
+        )
+
+    def get_exif_info(self) -> dict:
+        return dict((k[5:], v) for k, v in self._asdict().items() if k.startswith('exif_'))
+
+    def get_caption(self) -> str:
+        if self.exif_exposure_time is not None and self.exif_exposure_time < 1:
+            exposure_time = '1/{}'.format(int(1 / self.exif_exposure_time))
+        else:
+            exposure_time = str(self.exif_exposure_time)
+
+        return '{} @ {}mm, ISO {}, {}s, f/{}'.format(
+            self.exif_model, self.exif_focal_length, self.exif_iso_speed, exposure_time, self.exif_f_number)
+
+
+class TagRecord(NamedTuple):
+    id: int
+    name: str
+    slug: str
+    display_name: str
+    description: Optional[str]
+    category: CategoryRecord
+    pictures: Tuple[int, ...]  # indices in `Snapshot.pictures`, oldest first
+
+    def get_input_file(self) -> pathlib.Path:
+        """Get path to the file where the info are stored
+        """
+
+        return self.category.get_directory() / '{}.md'.format(self.slug)
+
+    def get_url(self) -> pathlib.Path:
+        """Get URL
+        """
+
+        return self.category.get_directory() / '{}.html'.format(self.slug)
+
+    def get_page_url(self, page: int) -> pathlib.Path:
+        """Get URL of the `page`-th page (the first one being the tag page itself)
+        """
+
+        if page == 1:
+            return self.get_url()
+
+        return self.category.get_directory() / self.slug / 'page-{}.html'.format(page)
+
+    def get_chunk_url(self, page: int) -> pathlib.Path:
+        """Get URL of the JSON list of pictures of the `page`-th page
+        """
+
+        return self.category.get_directory() / self.slug / 'chunk-{}.json'.format(page)
+
+    def to_html(self) -> str:
+        return markdown(self.description)
+
+
+class ThumbnailRecord(NamedTuple):
+    id: int
+    picture_id: int
+    type: str
+    path: str
+    width: Optional[int]
+    height: Optional[int]
+    size: Optional[int]
+    variant: Optional[int]  # requested width, `None` for the main size of the type
+    format: Optional[str]  # `None` for the main format of the type
+    quality: Optional[int]  # if it was searched for
+
+    @classmethod
+    def columns(cls) -> tuple:
+        return (
+            Thumbnail.id, Thumbnail.picture_id, Thumbnail.type, Thumbnail.path, Thumbnail.width, Thumbnail.height,
+            Thumbnail.size, Thumbnail.variant, Thumbnail.format, Thumbnail.quality
+        )
+
+    @classmethod
+    def fetch_all(cls, session: Session, picture_id: int = None) -> Iterable['ThumbnailRecord']:
+        query = select(*cls.columns())
+        if picture_id is not None:
+            query = query.where(Thumbnail.picture_id == picture_id)
+
+        return (cls(*row) for row in session.execute(query))
+
+
+class PlaceholderRecord(NamedTuple):
+    picture_id: int
+    color: str  # e.g., `#a0b1c2`
+    preview: str  # data URI of a tiny version of the picture
+
+    @classmethod
+    def columns(cls) -> tuple:
+        return Picture.id, Picture.placeholder_color, Picture.placeholder_preview
+
+    @classmethod
+    def fetch_all(cls, session: Session, picture_id: int = None) -> Iterable['PlaceholderRecord']:
+        query = select(*cls.columns()).where(Picture.placeholder_color.isnot(None))
+        if picture_id is not None:
+            query = query.where(Picture.id == picture_id)
+
+        return (cls(*row) for row in session.execute(query))
+
+
+class Snapshot:
+    """Frozen view of pages, categories, tags and pictures.
+
+    Pictures are stored once, in chronological order, and tags refer to them by their index in `pictures`.
+    The whole object is picklable.
+    """
+
+    __slots__ = ('pictures', 'categories', 'tags_per_cat', 'pages')
+
+    def __init__(
+        self,
+        pictures: Tuple[PictureRecord, ...],
+        categories: Dict[str, CategoryRecord],
+        tags_per_cat: Dict[str, List[TagRecord]],
+        pages: Dict[str, Page]
+    ):
+        self.pictures = pictures
+        self.categories = categories
+        self.tags_per_cat = tags_per_cat
+        self.pages = pages
+
+    def tags(self) -> Iterable[TagRecord]:
+        for tags in self.tags_per_cat.values():
+            yield from tags
+
+    def pictures_of(self, tag: TagRecord) -> List[PictureRecord]:
+        """Pictures of `tag`, oldest first"""
+
+        return [self.pictures[i] for i in tag.pictures]
+
+    def cover(self, tag: TagRecord) -> PictureRecord:
+        """The most recent picture of `tag`"""
+
+        return self.pictures[tag.pictures[-1]]
+
+    @classmethod
+    def load(cls, root: pathlib.Path, session: Session) -> 'Snapshot':
+        """Load the snapshot from the database (and the files in `root`), without keeping any ORM object around
+        """
+
+        from gallery_generator.controllers.tags import TagManager
+
+        # pages
+        pages = {}
+        for path in sorted((root / CONFIG_DIR_NAME / PAGE_DIR_NAME).glob('*.md')):
+            page = Page.create_from_file(path)
+            pages[page.slug] = page
+
+        # pictures, in chronological order (but the quarantined ones, see `ThumbnailJob`)
+        quarantined = select(ThumbnailJob.picture_id).where(ThumbnailJob.state == ThumbnailJob.FAILED)
+        pictures = tuple(
+            PictureRecord(*row) for row in session.execute(
+                select(*PictureRecord.columns())
+                .where(Picture.id.notin_(quarantined))
+                .order_by(Picture.exif_datetime_original, Picture.id))
+        )
+
+        index_of = dict((p.id, i) for i, p in enumerate(pictures))
+
+        # links between tags and pictures
+        pictures_per_tag: Dict[int, List[int]] = {}
+        for tag_id, picture_id in session.execute(select(tag_picture_at.c.left_id, tag_picture_at.c.right_id)):
+            if picture_id in index_of:
+                pictures_per_tag.setdefault(tag_id, []).append(index_of[picture_id])
+
+        # categories and tags
+        categories = dict(
+            (row.slug, CategoryRecord(*row))
+            for row in session.execute(select(Category.id, Category.name, Category.slug).order_by(Category.id))
+        )
+
+        categories_by_id = dict((c.id, c) for c in categories.values())
+        tags_per_cat: Dict[str, List[TagRecord]] = dict((slug, []) for slug in categories)
+        tag_directory = root / CONFIG_DIR_NAME / TagManager.TAG_DIRECTORY
+
+        for tag_id, name, slug, category_id in session.execute(select(Tag.id, Tag.name, Tag.slug, Tag.category_id)):
+            if tag_id not in pictures_per_tag:  # empty tag
+                continue
+
+            category = categories_by_id[category_id]
+            display_name, description = Tag.read_input_file(
+                tag_directory / category.get_directory() / '{}.md'.format(slug), name)
+
+            tags_per_cat[category.slug].append(TagRecord(
+                tag_id, name, slug, display_name, description, category, tuple(sorted(pictures_per_tag[tag_id]))))
+
+        # most recent tags first
+        for tags in tags_per_cat.values():
+            tags.sort(key=lambda t: t.pictures[-1], reverse=True)
+
+        return cls(pictures, categories, tags_per_cat, pages)
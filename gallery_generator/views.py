@@ -1,54 +1,444 @@
+import functools
+import hashlib
+import json
+import math
 import pathlib
-from typing import List
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-import sass
+import re
+from typing import List, Tuple, Union, Dict
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template, select_autoescape
+from markupsafe import Markup
 from markdown import markdown
 
-from gallery_generator.models import Tag, Picture, Page
+from gallery_generator import __version__
+from gallery_generator.controllers.dependencies import digest
+from gallery_generator.controllers.output import OutputWriter, fingerprint
+from gallery_generator.controllers.search import EXIF_FIELDS, get_tokens, encode_ids, shard_tokens
+from gallery_generator.controllers.thumbnails import Thumbnailer
+from gallery_generator.models import Page
+from gallery_generator.snapshot import TagRecord, PictureRecord, ThumbnailRecord
 
-env = Environment(
-    loader=FileSystemLoader(pathlib.Path(__file__).parent / 'templates'),
-    autoescape=select_autoescape(['html', 'xml'])
-)
 
+@functools.lru_cache(maxsize=None)
+def get_env() -> Environment:
+    """Get the template environment, which is only built on first use
+    """
 
-class TemplateView:
-    template_name: str = None
+    env = Environment(
+        loader=FileSystemLoader(pathlib.Path(__file__).parent / 'templates'),
+        autoescape=select_autoescape(['html', 'xml']),
+        auto_reload=False
+    )
+
+    env.filters['markdown'] = markdown_filter
+    env.filters['srcset'] = srcset_filter
+    env.filters['sources'] = sources_filter
+
+    return env
+
+
+def set_bytecode_cache(directory: pathlib.Path):
+    """Store the compiled templates in `directory`, so that they are not compiled again on the next run
+    """
+
+    directory.mkdir(parents=True, exist_ok=True)
+    get_env().bytecode_cache = FileSystemBytecodeCache(str(directory))
+
+
+REFERENCED_TEMPLATES = re.compile(r'{%-?\s*(?:extends|include|import|from)\s+["\']([^"\']+)["\']')
+
+
+@functools.lru_cache(maxsize=None)
+def template_digest(name: str) -> str:
+    """Hash of the source of template `name` and of the templates it extends or includes
+    """
+
+    env = get_env()
+    source, _, _ = env.loader.get_source(env, name)
+    h = hashlib.sha256(source.encode())
+
+    # (without parsing the template)
+    for other in sorted(set(REFERENCED_TEMPLATES.findall(source))):
+        h.update(template_digest(other).encode())
+
+    return h.hexdigest()
+
+
+class BaseView:
+    fingerprint: bool = False  # put the hash of the content in the name of the output (see `get_output_url()`)
 
     def __init__(self, common_context: dict):
         self.common_context = common_context
+        self.output_url: str = None
 
     def get_url(self) -> str:
         raise NotImplementedError()
 
+    def get_dependencies(self) -> list:
+        """Inputs of the output (besides the site-wide ones), used to decide whether it must be rendered again
+        """
+
+        return []
+
+    def render_content(self, **kwargs) -> Union[str, bytes]:
+        raise NotImplementedError()
+
+    def get_output_url(self, content: bytes) -> str:
+        """Where the output is actually written, which is not `get_url()` for a fingerprinted view
+        """
+
+        return str(fingerprint(self.get_url(), content) if self.fingerprint else self.get_url())
+
+    def render(self, writer: OutputWriter, **kwargs) -> bool:
+        """Render and write through `writer` (in `self.output_url`). Return `True` if the output changed.
+        """
+
+        content = self.render_content(**kwargs)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+
+        self.output_url = self.get_output_url(content)
+        return writer.write(self.output_url, content)
+
+
+class TemplateView(BaseView):
+    template_name: str = None
+    page_context_keys: Tuple[str, ...] = (
+        'site_name', 'domain', 'twitter_account', 'bootstrap_version', 'footer_text', 'assets')
+
     def get_context_data(self, **kwargs) -> dict:
         return dict(view=self, **self.common_context)
 
-    def render(self, target: pathlib.Path, **kwargs):
-        with pathlib.Path(target / self.get_url()).open('w') as f:
-            template = env.get_template(self.template_name)
-            f.write(template.render(**self.get_context_data(**kwargs)))
+    @classmethod
+    def get_template(cls) -> Template:
+        """Get the template, which is only loaded once per class
+        """
 
+        if '_template' not in cls.__dict__:
+            cls._template = get_env().get_template(cls.template_name)
 
-class TagView(TemplateView):
-    template_name = 'tag.html'
+        return cls._template
 
-    def __init__(self, tag: Tag, pictures: List[Picture], common_context: dict):
-        super().__init__(common_context)
+    def get_dependencies(self) -> list:
+        return [
+            template_digest(self.template_name),
+            [self.common_context.get(k) for k in self.page_context_keys]
+        ]
+
+    def render_content(self, **kwargs) -> str:
+        return self.get_template().render(**self.get_context_data(**kwargs))
+
+
+class TagPageMixin:
+    """Split the pictures of a tag in pages of `page_size` pictures (`page_size <= 0` means a single page)
+    """
+
+    picture_thumbnail_types: Tuple[str, ...] = ('gallery_small', 'gallery_large', 'deep_zoom')  # of each picture
+    cover_thumbnail_types: Tuple[str, ...] = ('social_media_card', )  # of the cover (see `IndexView` for the other)
 
+    def __init__(self, tag: TagRecord, pictures: List[PictureRecord], page_size: int = 0, page: int = 1):
         self.tag = tag
         self.pictures = pictures
+        self.page_size = page_size if page_size > 0 else len(pictures)
+        self.page = page
+
+    @property
+    def pages_count(self) -> int:
+        return max(1, math.ceil(len(self.pictures) / self.page_size))
+
+    def get_page_pictures(self) -> List[PictureRecord]:
+        return self.pictures[(self.page - 1) * self.page_size:self.page * self.page_size]
+
+
+class TagView(TagPageMixin, TemplateView):
+    """Page of a tag.
+
+    The first page contains the first `page_size` pictures, and the others are loaded from JSON chunks
+    (see `TagChunkView`). If `fallback_pages` is set, the other pages also exist as HTML (with `page > 1`).
+    """
+
+    template_name = 'tag.html'
+    page_context_keys = TemplateView.page_context_keys + (
+        'masonry_version', 'lightgallery_version')
+
+    def __init__(
+        self,
+        tag: TagRecord,
+        pictures: List[PictureRecord],
+        common_context: dict,
+        page_size: int = 0,
+        page: int = 1,
+        fallback_pages: bool = False
+    ):
+        TemplateView.__init__(self, common_context)
+        TagPageMixin.__init__(self, tag, pictures, page_size, page)
+
+        self.fallback_pages = fallback_pages
 
     def get_url(self) -> str:
-        return self.tag.get_url()
+        return self.tag.get_page_url(self.page)
+
+    def get_items(self) -> List[Markup]:
+        """The HTML of the pictures of the page, which are shared with the other tags (see `PictureFragmentCache`)
+        """
+
+        views = [GridItemView(picture, self.common_context) for picture in self.get_page_pictures()]
+        cache = self.common_context.get('fragment_cache')
+
+        if cache is None:
+            return [view.render_content() for view in views]
+
+        return cache.get_many(
+            [(view.picture.id, digest(view.get_dependencies())) for view in views],
+            lambda i: views[i].render_content()
+        )
 
     def get_context_data(self, **kwargs) -> dict:
         ctx = super().get_context_data(**kwargs)
         ctx['tag'] = self.tag
-        ctx['pictures'] = self.pictures
+        ctx['items'] = self.get_items()
+        ctx['cover'] = self.pictures[-1]
+        ctx['page_number'] = self.page
+        ctx['pages_count'] = self.pages_count
+        ctx['fallback_pages'] = self.fallback_pages
+        ctx['chunk_urls'] = [
+            '/{}'.format(self.tag.get_chunk_url(i)) for i in range(2, self.pages_count + 1)
+        ] if self.page == 1 else []
 
         return ctx
 
+    def get_dependencies(self) -> list:
+        thumbnailer = self.common_context['thumbnailer']
+
+        return super().get_dependencies() + [
+            self.tag.display_name,
+            self.tag.description,
+            template_digest(GridItemView.template_name),
+            [GridItemView(p, self.common_context).get_picture_dependencies() for p in self.get_page_pictures()],
+            thumbnailer.get_thumbnail(self.pictures[-1], 'social_media_card').path,
+            [self.page, self.pages_count, self.fallback_pages]
+        ]
+
+
+class GridItemView(TemplateView):
+    """A picture on a tag page, which is the same whatever the tag
+    """
+
+    template_name = 'grid_item.inc.html'
+
+    def __init__(self, picture: PictureRecord, common_context: dict):
+        super().__init__(common_context)
+        self.picture = picture
+
+    def get_url(self) -> str:
+        raise ValueError('a fragment is not an output')
+
+    def get_context_data(self, **kwargs) -> dict:
+        return dict(picture=self.picture, thumbnailer=self.common_context['thumbnailer'])
+
+    def get_picture_dependencies(self) -> tuple:
+        thumbnailer = self.common_context['thumbnailer']
+        p = self.picture
+
+        return (
+            p.id,
+            p.date_modified,
+            thumbnailer.get_srcset(p, 'gallery_small'),
+            thumbnailer.get_sources(p, 'gallery_small'),
+            thumbnailer.get_thumbnail(p, 'gallery_small').path,
+            [t.path for t in thumbnailer.get_srcset(p, 'gallery_large')],
+            sources_filter(thumbnailer.get_sources(p, 'gallery_large')),
+            thumbnailer.get_thumbnail(p, 'gallery_large').path,
+            thumbnailer.get_optional_thumbnail(p, 'deep_zoom'),
+            thumbnailer.get_placeholder(p)
+        )
+
+    def get_dependencies(self) -> list:
+        # (the fragments are kept in the database, so the ones of a previous version, whose filters and helpers may
+        # have changed, must not be used)
+        return [__version__, template_digest(self.template_name), self.get_picture_dependencies()]
+
+
+class TagChunkView(TagPageMixin, BaseView):
+    """JSON list of the pictures of a page of a tag, fetched by the first page when the user scrolls
+    """
+
+    def __init__(self, tag: TagRecord, pictures: List[PictureRecord], common_context: dict, page_size: int, page: int):
+        BaseView.__init__(self, common_context)
+        TagPageMixin.__init__(self, tag, pictures, page_size, page)
+
+    def get_url(self) -> str:
+        return self.tag.get_chunk_url(self.page)
+
+    def get_items(self) -> List[dict]:
+        thumbnailer = self.common_context['thumbnailer']
+
+        items = []
+        for picture in self.get_page_pictures():
+            small = thumbnailer.get_thumbnail(picture, 'gallery_small')
+            small_srcset = thumbnailer.get_srcset(picture, 'gallery_small')
+            large_srcset = thumbnailer.get_srcset(picture, 'gallery_large')
+            zoom = thumbnailer.get_optional_thumbnail(picture, 'deep_zoom')
+            placeholder = thumbnailer.get_placeholder(picture)
+            items.append(dict(
+                src=small.path,
+                srcset=srcset_filter(small_srcset) if len(small_srcset) > 1 else None,
+                sources=sources_filter(thumbnailer.get_sources(picture, 'gallery_small')) or None,
+                large=thumbnailer.get_thumbnail(picture, 'gallery_large').path,
+                large_srcset=srcset_filter(large_srcset) if len(large_srcset) > 1 else None,
+                large_sources=sources_filter(thumbnailer.get_sources(picture, 'gallery_large'), '100vw') or None,
+                zoom=zoom.path if zoom else None,
+                width=small.width,
+                height=small.height,
+                caption=picture.get_caption(),
+                color=placeholder.color if placeholder else None,
+                placeholder=placeholder.preview if placeholder else None
+            ))
+
+        return items
+
+    def get_dependencies(self) -> list:
+        return [self.get_items()]
+
+    def render_content(self, **kwargs) -> str:
+        return json.dumps(self.get_items(), separators=(',', ':'))
+
+
+def tag_views(
+    tag: TagRecord, pictures: List[PictureRecord], common_context: dict, page_size: int = 0,
+    fallback_pages: bool = False
+) -> List[BaseView]:
+    """All the outputs of a tag: its page, then the JSON chunks (and the fallback pages) of the other pages
+    """
+
+    views = [TagView(tag, pictures, common_context, page_size, fallback_pages=fallback_pages)]
+
+    for page in range(2, views[0].pages_count + 1):
+        views.append(TagChunkView(tag, pictures, common_context, page_size, page))
+        if fallback_pages:
+            views.append(TagView(tag, pictures, common_context, page_size, page, fallback_pages=True))
+
+    return views
+
+
+class SearchView(TemplateView):
+    """Search page, whose script looks for the pictures in the shards of the index (see `search_views()`)
+    """
+
+    template_name = 'search.html'
+
+    def __init__(self, common_context: dict, shard_urls: Dict[str, str], chunk_size: int):
+        super().__init__(common_context)
+        self.shard_urls = shard_urls
+        self.chunk_size = chunk_size
+
+    def get_url(self) -> str:
+        return 'search.html'
+
+    def get_fields(self) -> List[Tuple[str, str]]:
+        """The fields of the tokens, as `(field, description)`"""
+
+        categories = self.common_context['categories'].values()
+        return [(category.slug, 'tag of {}'.format(category.name)) for category in categories] + list(EXIF_FIELDS)
+
+    def get_context_data(self, **kwargs) -> dict:
+        ctx = super().get_context_data(**kwargs)
+        ctx['search'] = dict(
+            shards=dict((prefix, '/{}'.format(url)) for prefix, url in self.shard_urls.items()),
+            chunk='/{}'.format(SearchPicturesView.URL),
+            chunk_size=self.chunk_size,
+            pictures=len(self.common_context['snapshot'].pictures)
+        )
+
+        return ctx
+
+    def get_dependencies(self) -> list:
+        return super().get_dependencies() + [
+            self.shard_urls, self.chunk_size, self.get_fields(), len(self.common_context['snapshot'].pictures)]
+
+
+class SearchShardView(BaseView):
+    """JSON object of the (encoded) lists of pictures of the tokens which start with `prefix`
+    """
+
+    def __init__(self, common_context: dict, prefix: str, tokens: Dict[str, List[int]]):
+        super().__init__(common_context)
+        self.prefix = prefix
+        self.tokens = tokens
+
+    def get_url(self) -> str:
+        # (a stable name, which is safe in an URL)
+        return 'search/shard-{}.json'.format(self.prefix.encode().hex())
+
+    def get_dependencies(self) -> list:
+        return [self.tokens]
+
+    def render_content(self, **kwargs) -> str:
+        return json.dumps(self.tokens, separators=(',', ':'))
+
+
+class SearchPicturesView(BaseView):
+    """JSON list of what is shown of the pictures of a chunk (by their index in `Snapshot.pictures`), in the results
+    """
+
+    URL = 'search/pictures-{}.json'
+
+    def __init__(self, common_context: dict, chunk: int, chunk_size: int):
+        super().__init__(common_context)
+        self.chunk = chunk
+        self.chunk_size = chunk_size
+
+    def get_url(self) -> str:
+        return self.URL.format(self.chunk)
+
+    def get_items(self) -> List[dict]:
+        thumbnailer = self.common_context['thumbnailer']
+        pictures = self.common_context['snapshot'].pictures[self.chunk * self.chunk_size:][:self.chunk_size]
+
+        items = []
+        for picture in pictures:
+            small = thumbnailer.get_thumbnail(picture, 'gallery_small')
+            items.append(dict(
+                src=small.path,
+                width=small.width,
+                height=small.height,
+                large=thumbnailer.get_thumbnail(picture, 'gallery_large').path,
+                caption=picture.get_caption()
+            ))
+
+        return items
+
+    def get_dependencies(self) -> list:
+        return [self.get_items()]
+
+    def render_content(self, **kwargs) -> str:
+        return json.dumps(self.get_items(), separators=(',', ':'))
+
+
+SEARCH_SHARD_SIZE = 2048  # ids per shard (so, a few kB each)
+SEARCH_CHUNK_SIZE = 32  # pictures per chunk of the results
+
+
+def search_views(
+    common_context: dict, shard_size: int = SEARCH_SHARD_SIZE, chunk_size: int = SEARCH_CHUNK_SIZE
+) -> List[BaseView]:
+    """The outputs of the search: its page, then the shards of the index and the chunks of the pictures
+    """
+
+    snapshot = common_context['snapshot']
+    tokens = dict((token, encode_ids(ids)) for token, ids in get_tokens(snapshot).items())
+
+    shards = [SearchShardView(common_context, prefix, shard) for prefix, shard in shard_tokens(tokens, shard_size)]
+    views: List[BaseView] = [
+        SearchView(common_context, dict((view.prefix, view.get_url()) for view in shards), chunk_size)
+    ]
+
+    views.extend(shards)
+    views.extend(
+        SearchPicturesView(common_context, i, chunk_size) for i in range(math.ceil(len(snapshot.pictures) / chunk_size))
+    )
+
+    return views
+
 
 class PageView(TemplateView):
     template_name = 'page.html'
@@ -66,42 +456,165 @@ class PageView(TemplateView):
 
         return ctx
 
+    def get_dependencies(self) -> list:
+        return super().get_dependencies() + [self.page.title, self.page.content]
+
 
 class IndexView(TemplateView):
     template_name = 'index.html'
+    page_context_keys = TemplateView.page_context_keys + ('index_categories_to_show', )
+    cover_thumbnail_type = 'tag_thumbnail'  # (only used here)
 
-    def __init__(self, thumbnails, common_context: dict):
+    def __init__(self, common_context: dict):
         super().__init__(common_context)
-        self.thumbnails = thumbnails
 
     def get_url(self) -> str:
         return 'index.html'
 
-    def get_context_data(self, **kwargs) -> dict:
-        ctx = super().get_context_data(**kwargs)
+    def get_tags(self) -> List[List[TagRecord]]:
+        """The tags shown (with the `tag_thumbnail` of their cover), per category"""
 
-        ctx['thumbnails'] = self.thumbnails
+        return [
+            self.common_context['tags_per_cat'][category_slug]
+            for category_slug in self.common_context['index_categories_to_show']
+        ]
 
-        return ctx
+    def get_dependencies(self) -> list:
+        thumbnailer = self.common_context['thumbnailer']
+        snapshot = self.common_context['snapshot']
+
+        return super().get_dependencies() + [
+            [(
+                str(tag.get_url()),
+                tag.display_name,
+                thumbnailer.get_thumbnail(snapshot.cover(tag), 'tag_thumbnail'),
+                thumbnailer.get_srcset(snapshot.cover(tag), 'tag_thumbnail'),
+                thumbnailer.get_sources(snapshot.cover(tag), 'tag_thumbnail'),
+                thumbnailer.get_placeholder(snapshot.cover(tag))
+            ) for tag in tags]
+            for tags in self.get_tags()
+        ]
+
+
+class ZoomView(TemplateView):
+    """Viewer of the deep zoom thumbnails, given in the URL (after `#`)
+    """
+
+    template_name = 'zoom.html'
+    page_context_keys = TemplateView.page_context_keys + ('openseadragon_version', )
+
+    def get_url(self) -> str:
+        return 'zoom.html'
 
 
 class StyleView(TemplateView):
+    """Stylesheet. The compiled CSS is stored in `cache_directory` (if any), so that libsass is only used (and loaded)
+    when the SCSS or the options changed.
+    """
+
     template_name = 'style.scss'
+    page_context_keys = ()  # (no context is used)
+    compile_options = {'output_style': 'compressed'}
 
-    def __init__(self, common_context: dict):
+    def __init__(self, common_context: dict, fingerprint: bool = False, cache_directory: pathlib.Path = None):
         super().__init__(common_context)
+        self.fingerprint = fingerprint
+        self.cache_directory = cache_directory
 
     def get_url(self) -> str:
         return 'style.css'
 
-    def render(self, target: pathlib.Path, **kwargs):
-        with pathlib.Path(target / self.get_url()).open('w') as f:
-            template = env.get_template(self.template_name)
-            f.write(sass.compile(string=template.render(**self.get_context_data(**kwargs)), output_style='compressed'))
+    def compile(self, scss: str) -> str:
+        import sass  # (loading libsass takes time)
+
+        return sass.compile(string=scss, **self.compile_options)
+
+    def render_content(self, **kwargs) -> str:
+        scss = super().render_content(**kwargs)
+
+        if self.cache_directory is None:
+            return self.compile(scss)
+
+        name = '{}.css'.format(digest(scss, self.compile_options))
+        path = self.cache_directory / name
+
+        if path.exists():
+            with path.open() as f:
+                return f.read()
+
+        css = self.compile(scss)
+        OutputWriter(self.cache_directory).write(name, css)
+
+        return css
+
+
+class CacheHeadersView(TemplateView):
+    """Cache rules for the server: fingerprinted outputs are immutable, while pages must be revalidated
+    """
+
+    page_context_keys = ('assets', )
+
+    def get_context_data(self, **kwargs) -> dict:
+        ctx = super().get_context_data(**kwargs)
+        ctx['thumbnail_directory'] = Thumbnailer.THUMBNAIL_DIRECTORY
+
+        return ctx
+
+
+class NetlifyHeadersView(CacheHeadersView):
+    """`_headers` file, as used by Netlify or Cloudflare Pages"""
+
+    template_name = 'headers.txt'
+
+    def get_url(self) -> str:
+        return '_headers'
+
+
+class HtaccessView(CacheHeadersView):
+    """`.htaccess` file, for Apache"""
+
+    template_name = 'htaccess.txt'
+
+    def get_url(self) -> str:
+        return '.htaccess'
+
+
+class FragmentView(TemplateView):
+    """Part shared by every page, which is rendered once and then injected (as safe HTML) in the context of the pages
+    """
+
+    context_name: str = None
+
+    def get_url(self) -> str:
+        raise ValueError('a fragment is not an output')
+
+    def render_content(self, **kwargs) -> Markup:
+        return Markup(super().render_content(**kwargs))
+
+
+class NavbarView(FragmentView):
+    template_name = 'navbar.inc.html'
+    context_name = 'navbar'
+
+
+class FooterView(FragmentView):
+    template_name = 'footer.inc.html'
+    context_name = 'footer'
 
 
 def markdown_filter(value: str) -> str:
     return markdown(value)
 
 
-env.filters['markdown'] = markdown_filter
+def srcset_filter(thumbnails: List[ThumbnailRecord]) -> str:
+    return ', '.join('/{} {}w'.format(t.path, t.width) for t in thumbnails)
+
+
+def sources_filter(sources: List[Tuple[str, List[ThumbnailRecord]]], sizes: str = None) -> List[dict]:
+    """Other formats of a thumbnail (see `ThumbnailIndex.get_sources()`), as expected by the scripts
+    """
+
+    return [
+        dict(type=mimetype, srcset=srcset_filter(srcset), **({'sizes': sizes} if sizes else {}))
+        for mimetype, srcset in sources
+    ]
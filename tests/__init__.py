@@ -21,6 +21,14 @@ class GCTestCase(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.root)
 
+    def make_temporary_directory(self) -> pathlib.Path:
+        """Create a temporary directory outside of the root (e.g., for the outputs), which is removed after the test
+        """
+
+        path = pathlib.Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
     def copy_to_temporary_directory(self, file_in_test_dir: str, new_name: str = '') -> pathlib.Path:
         """Copy the content of a file from the ``test_file_directory`` to the temporary directory
 
@@ -1,8 +1,11 @@
+import sqlite3
+
 from tests import GCTestCase
 
 from gallery_generator import CONFIG_DIR_NAME
 from gallery_generator.controllers.database import GalleryDatabase
-from sqlalchemy import inspect
+from gallery_generator.models import ThumbnailJob
+from sqlalchemy import inspect, select
 
 
 class InitTestCase(GCTestCase):
@@ -31,3 +34,30 @@ class InitTestCase(GCTestCase):
 
     def test_init_ok(self):
         self.assert_init_ok(self.root)
+
+    def test_upgrade_schema_ok(self):
+        # a database created by a previous version
+        with sqlite3.connect(str(self.db.path)) as connection:
+            connection.execute('ALTER TABLE picture DROP COLUMN placeholder_color')
+            connection.execute('DROP TABLE thumbnail_job')
+            connection.execute('CREATE TABLE thumbnail_job (id INTEGER PRIMARY KEY, type VARCHAR, picture_id INTEGER)')
+        connection.close()
+
+        db = GalleryDatabase(self.root)
+        with db.make_session() as session:
+            self.assertEqual(session.scalars(select(ThumbnailJob)).all(), [])
+
+        columns = [column['name'] for column in inspect(db._engine()).get_columns('picture')]
+        self.assertIn('placeholder_color', columns)
+
+        indexes = [index['name'] for index in inspect(db._engine()).get_indexes('thumbnail_job')]
+        self.assertIn('ix_thumbnail_job_claim', indexes)
+
+        # a column which cannot be added
+        with sqlite3.connect(str(self.db.path)) as connection:
+            connection.execute('DROP TABLE picture_fragment')
+            connection.execute('CREATE TABLE picture_fragment (id INTEGER PRIMARY KEY, digest VARCHAR, html VARCHAR)')
+        connection.close()
+
+        with self.assertRaises(RuntimeError):
+            GalleryDatabase(self.root).make_session()
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+import unittest
+
+
+class MainTestCase(unittest.TestCase):
+
+    MAX_IMPORT_TIME = 0.15  # in seconds (about 0.5 when everything was imported at once)
+    HEAVY_MODULES = ('sqlalchemy', 'jinja2', 'PIL', 'sass', 'markdown', 'yaml', 'exif', 'schema')
+
+    def get_import_times(self, module: str) -> dict:
+        """Import `module` in a new interpreter, and get the cumulative import time (in seconds) of each module
+        """
+
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+            capture_output=True, text=True, check=True
+        )
+
+        times = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative) / 1e6
+
+        return times
+
+    def test_import_time_ok(self):
+        times = self.get_import_times('gallery_generator.scripts.main')
+
+        # the subcommands (and their dependencies) are only imported when they are used
+        for name in times:
+            self.assertNotIn(name.split('.')[0], self.HEAVY_MODULES)
+
+        self.assertLess(times['gallery_generator.scripts.main'], self.MAX_IMPORT_TIME)
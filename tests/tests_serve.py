@@ -0,0 +1,151 @@
+import io
+import os
+import pathlib
+import threading
+import unittest.mock
+import urllib.request
+from http.server import HTTPServer
+
+from PIL import Image
+
+from gallery_generator import CONFIG_DIR_NAME, PAGE_DIR_NAME
+from gallery_generator.controllers import settings
+from gallery_generator.controllers.preview import ThumbnailCache
+from gallery_generator.scripts.crawl import command_crawl
+from gallery_generator.scripts.serve import CommandServe, make_request_handler
+from gallery_generator.scripts.update import command_update
+from tests import GCTestCase
+from tests.tests_crawl import DispatchPictureFixture
+
+
+class ServeTestCase(GCTestCase, DispatchPictureFixture):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.dispatch_pics()
+        self.settings = settings.SETTINGS_BASE
+        command_crawl(self.root, self.settings, self.db)
+
+        self.target = self.make_temporary_directory()
+
+        self.command = CommandServe()
+        self.command.load(self.root, self.settings, self.db, self.target)
+
+    def edit(self, path: pathlib.Path, content: str):
+        """Write `content` in `path`, with a modification time that is different from the previous one"""
+
+        mtime = path.stat().st_mtime_ns if path.exists() else 0
+        with path.open('w') as f:
+            f.write(content)
+
+        os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+    def test_serve_ok(self):
+        content, mimetype = self.command.get('index.html')
+        self.assertEqual(mimetype, 'text/html')
+        self.assertIn(b'Gallery test', content)
+
+        tag_url = 'album/{}.html'.format(self.dirs[0])
+        self.assertIsNone(self.command.get('{}.html'.format(self.dirs[0])))
+        content, _ = self.command.get(tag_url)
+
+        # the missing thumbnails are made when they are requested
+        thumbnail_url = next(url for url in self.command.thumbnailer.stand_ins if url in content.decode())
+        content, mimetype = self.command.get(thumbnail_url)
+        self.assertEqual(mimetype, 'image/jpeg')
+
+        with Image.open(io.BytesIO(content)) as im:
+            self.assertEqual(im.format, 'JPEG')
+
+        self.assertEqual(list(self.command.thumbnailer.cache.contents), [thumbnail_url])
+
+        # the existing ones are used
+        command_update(self.root, self.settings, self.db, self.target)
+        self.command.load(self.root, self.settings, self.db, self.target)
+
+        content, _ = self.command.get(tag_url)
+        self.assertNotIn(b'_preview/', content)
+
+        thumbnail = self.command.thumbnailer.get_thumbnail(self.command.snapshot.pictures[0], 'gallery_small')
+        with (self.target / thumbnail.path).open('rb') as f:
+            self.assertEqual(self.command.get(thumbnail.path)[0], f.read())
+
+        self.assertIsNone(self.command.get('../{}'.format(self.root.name)))
+
+    def test_serve_watch_ok(self):
+        for url in self.command.views:
+            self.command.get(url)
+
+        all_urls = set(self.command.views)
+        self.assertEqual(set(self.command.contents), all_urls)
+
+        tag = self.command.snapshot.tags_per_cat['album'][0]
+        tag_file = self.root / CONFIG_DIR_NAME / 'tags' / tag.get_input_file()
+
+        # a new description: only the views of that tag are rendered again
+        self.edit(tag_file, '# {}\nA new description'.format(tag.display_name))
+        self.command.check_changes()
+        self.assertEqual(all_urls - set(self.command.contents), {str(tag.get_url())})
+
+        self.assertIn(b'A new description', self.command.get(str(tag.get_url()))[0])
+
+        # a new name (which is in the navbar): every view is rendered again
+        self.edit(tag_file, '# Another name')
+        self.command.check_changes()
+        self.assertEqual(self.command.contents, {})
+
+        self.assertIn(b'Another name', self.command.get('index.html')[0])
+
+        # a new page
+        self.edit(self.root / CONFIG_DIR_NAME / PAGE_DIR_NAME / 'about.md', '# About\nSomething')
+        self.assertIn(b'Something', self.command.get('about.html')[0])
+        self.assertIn(b'/about.html', self.command.get('index.html')[0])
+
+    def test_serve_watch_views_only_ok(self):
+        with (self.target / 'existing.jpg').open('wb') as f:
+            f.write(b'\xff\xd8')
+
+        with unittest.mock.patch.object(self.command, 'check_changes') as check_changes:
+            # not for the files which already exist (e.g., the thumbnails) ...
+            self.assertEqual(self.command.get('existing.jpg'), (b'\xff\xd8', 'image/jpeg'))
+            check_changes.assert_not_called()
+
+            # ... but for the views, and for what may be a new view
+            self.command.get('index.html')
+            self.command.get('about.html')
+            self.assertEqual(check_changes.call_count, 2)
+
+    def test_serve_http_ok(self):
+        server = HTTPServer(('localhost', 0), make_request_handler(self.command))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            base = 'http://localhost:{}/'.format(server.server_address[1])
+
+            with urllib.request.urlopen(base) as response:
+                self.assertEqual(response.headers['Content-Type'], 'text/html')
+                self.assertIn(b'Gallery test', response.read())
+
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                urllib.request.urlopen(base + 'nope.html')
+            self.assertEqual(e.exception.code, 404)
+            e.exception.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_thumbnail_cache_ok(self):
+        cache = ThumbnailCache(max_size=10)
+
+        cache.put('a', b'12345')
+        cache.put('b', b'12345')
+        self.assertEqual(cache.get('a'), b'12345')  # (`b` is now the least recently used)
+
+        cache.put('c', b'123')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size, 8)
+
+        # (the last one is kept, whatever its size)
+        cache.put('d', b'1' * 20)
+        self.assertEqual(list(cache.contents), ['d'])
@@ -1,15 +1,40 @@
+import contextlib
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import math
 import pathlib
-import tempfile
+import pickle
+import re
+import sqlite3
+import tarfile
+import unittest.mock
+import zipfile
 
-from gallery_generator.controllers import settings
+from sqlalchemy import select, update
+
+from gallery_generator.controllers import settings, output
+from gallery_generator.controllers.dependencies import DependencyManifest
+from gallery_generator.controllers.jobs import ThumbnailJobQueue
+from gallery_generator.controllers.output import OutputWriter, TarWriter, ZipWriter, ObjectStoreWriter
+from gallery_generator.controllers.pipeline import Pipeline, batched
+from gallery_generator.controllers.search import encode_ids, decode_ids, shard_tokens
 from gallery_generator.scripts.update import command_update
 from tests import GCTestCase
 
 from PIL import Image
-from gallery_generator.controllers.thumbnails import ScalePicture, CropPicture, ScaleAndCropPicture, Thumbnailer
-from gallery_generator.models import Picture, Thumbnail, Page
+from gallery_generator.controllers.thumbnails import ScalePicture, CropPicture, ScaleAndCropPicture, DeepZoomPicture, \
+    Thumbnailer, MISSING_THUMBNAIL, BaseImageTransform, make_placeholder
+from gallery_generator.models import Picture, Thumbnail, ThumbnailJob, PictureFragment, Page
 from gallery_generator.scripts.crawl import command_crawl
-from gallery_generator import CONFIG_DIR_NAME, PAGE_DIR_NAME
+from gallery_generator.scripts.pipeline import command_crawl_update
+from gallery_generator.scripts.worker import command_thumbnail_worker
+from gallery_generator.snapshot import Snapshot
+from gallery_generator.views import TagView, StyleView, get_env, set_bytecode_cache, \
+    search_views
+from gallery_generator import CONFIG_DIR_NAME, PAGE_DIR_NAME, CACHE_DIR_NAME
 
 from tests.tests_crawl import DispatchPictureFixture
 
@@ -66,6 +91,118 @@ class PageTestCase(GCTestCase):
         self.assertEqual(page.slug, slug)
 
 
+class OutputWriterTestCase(GCTestCase):
+    def test_write_ok(self):
+        writer = OutputWriter(self.root)
+        path = self.root / 'sub' / 'test.txt'
+
+        self.assertTrue(writer.write('sub/test.txt', 'content'))
+        self.assertTrue(path.exists())
+        mtime = path.stat().st_mtime_ns
+
+        # same content: not written again
+        self.assertFalse(writer.write('sub/test.txt', b'content'))
+        self.assertEqual(path.stat().st_mtime_ns, mtime)
+
+        # other content
+        self.assertTrue(writer.write('sub/test.txt', 'other content'))
+        with path.open() as f:
+            self.assertEqual(f.read(), 'other content')
+
+        self.assertEqual(writer.changed, ['sub/test.txt', 'sub/test.txt'])
+        self.assertEqual(list(path.parent.iterdir()), [path])  # no temporary file left
+
+    def test_write_precompress_ok(self):
+        writer = OutputWriter(self.root, precompress=True)
+        path = self.root / 'test.html'
+        path_gz = self.root / 'test.html.gz'
+
+        self.assertTrue(writer.write('test.html', '<p>content</p>' * 100))
+        with gzip.open(path_gz, 'rt') as f:
+            self.assertEqual(f.read(), '<p>content</p>' * 100)
+
+        self.assertTrue(path.exists())
+        self.assertEqual((self.root / 'test.html.br').exists(), output.brotli is not None)
+        self.assertEqual(writer.changed, ['test.html'])
+
+        # not compressed again if the output did not change ...
+        mtime = path_gz.stat().st_mtime_ns
+        self.assertFalse(writer.write('test.html', '<p>content</p>' * 100))
+        self.assertEqual(path_gz.stat().st_mtime_ns, mtime)
+
+        # ... unless it is missing
+        path_gz.unlink()
+        self.assertFalse(writer.write('test.html', '<p>content</p>' * 100))
+        self.assertTrue(path_gz.exists())
+
+        # only text outputs
+        writer.write('test.jpg', b'\xff\xd8')
+        self.assertFalse((self.root / 'test.jpg.gz').exists())
+
+    def test_write_archive_ok(self):
+        def read_tar(path: pathlib.Path) -> dict:
+            with tarfile.open(path) as archive:
+                return dict((m.name, archive.extractfile(m).read()) for m in archive.getmembers())
+
+        def read_zip(path: pathlib.Path) -> dict:
+            with zipfile.ZipFile(path) as archive:
+                return dict((name, archive.read(name)) for name in archive.namelist())
+
+        for writer_class, read in [(TarWriter, read_tar), (ZipWriter, read_zip)]:
+            path = self.root / 'site.archive'
+
+            with writer_class(path) as writer:
+                self.assertTrue(writer.write('a.html', 'a'))
+                self.assertTrue(writer.write('sub/b.txt', 'b'))
+                self.assertFalse(writer.write('a.html', 'a'))
+                self.assertTrue(writer.exists('sub/b.txt'))
+
+                with self.assertRaises(ValueError):  # (cannot be overwritten)
+                    writer.write('a.html', 'other a')
+
+            self.assertEqual(read(path), {'a.html': b'a', 'sub/b.txt': b'b'})
+
+            # the outputs which are not written again are copied from the previous archive
+            with writer_class(path) as writer:
+                self.assertTrue(writer.exists('sub/b.txt'))
+                self.assertFalse(writer.write('a.html', 'a'))
+                self.assertTrue(writer.write('c.html', 'c'))
+                self.assertEqual(writer.changed, ['c.html'])
+
+            self.assertEqual(read(path), {'a.html': b'a', 'sub/b.txt': b'b', 'c.html': b'c'})
+
+            # the previous archive is kept if something fails
+            with self.assertRaises(RuntimeError):
+                with writer_class(path) as writer:
+                    writer.write('d.html', 'd')
+                    raise RuntimeError()
+
+            self.assertEqual(read(path), {'a.html': b'a', 'sub/b.txt': b'b', 'c.html': b'c'})
+            self.assertEqual(list(self.root.glob('*.part')), [])
+
+            path.unlink()
+
+    def test_write_objects_ok(self):
+        path = self.root / 'site'
+
+        with ObjectStoreWriter(path) as writer:
+            self.assertTrue(writer.write('a.html', 'same'))
+            self.assertTrue(writer.write('b.html', 'same'))
+
+        with (path / ObjectStoreWriter.MANIFEST_NAME).open() as f:
+            objects = json.load(f)
+
+        self.assertEqual(objects['a.html'], objects['b.html'])
+        self.assertEqual(len(list((path / ObjectStoreWriter.OBJECTS_DIRECTORY).glob('*/*'))), 1)
+
+        with writer.get_object_path(objects['a.html']).open() as f:
+            self.assertEqual(f.read(), 'same')
+
+        with ObjectStoreWriter(path) as writer:
+            self.assertTrue(writer.exists('a.html'))
+            self.assertFalse(writer.write('a.html', 'same'))
+
+
 class ImageTransformTestCase(GCTestCase, DispatchPictureFixture):
     def setUp(self) -> None:
         super().setUp()
@@ -113,7 +250,7 @@ class ThumbnailerTestCase(GCTestCase, DispatchPictureFixture):
         command_crawl(self.root, self.settings, self.db)
 
         # set up target
-        self.target = pathlib.Path(tempfile.mkdtemp())
+        self.target = self.make_temporary_directory()
         (self.target / Thumbnailer.THUMBNAIL_DIRECTORY).mkdir()
 
         self.thumb_types = {
@@ -129,20 +266,36 @@ class ThumbnailerTestCase(GCTestCase, DispatchPictureFixture):
             self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 0)
 
             picture = session.execute(Picture.select()).scalar_one()
+            date_modified = picture.date_obj_modified
 
             # generate a thumbnail
             thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=self.thumb_types)
             thumb_small = thumbnailer.get_thumbnail(picture, TTYPE)
 
-            self.assertEqual(thumb_small.picture, picture)
+            self.assertEqual(thumb_small.picture_id, picture.id)
             self.assertEqual(thumb_small.type, TTYPE)
 
             self.assertTrue((self.target / thumb_small.path).exists())
             self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 1)
 
+            # dimensions are stored
+            self.assertEqual((thumb_small.width, thumb_small.height), (128, 128))
+            self.assertEqual(thumb_small.size, (self.target / thumb_small.path).stat().st_size)
+
+            # placeholder is stored as well
+            placeholder = thumbnailer.get_placeholder(picture)
+            self.assertRegex(placeholder.color, r'^#[0-9a-f]{6}$')
+            self.assertTrue(placeholder.preview.startswith('data:image/png;base64,'))
+
+            # ... from the whole picture, not from the cropped thumbnail
+            self.assertEqual(
+                placeholder, make_placeholder(picture.id, BaseImageTransform().open(self.root / picture.path)))
+
             picture = session.execute(Picture.select()).scalar_one()
             self.assertEqual(len(picture.thumbnails), 1)
-            self.assertEqual(picture.thumbnails[0], thumb_small)
+            self.assertEqual(picture.thumbnails[0].id, thumb_small.id)
+            self.assertEqual(picture.placeholder_color, placeholder.color)
+            self.assertEqual(picture.date_obj_modified, date_modified)
 
             # ask for existing thumbnail gives the same thumb
             self.assertEqual(thumbnailer.get_thumbnail(picture, TTYPE), thumb_small)
@@ -154,6 +307,51 @@ class ThumbnailerTestCase(GCTestCase, DispatchPictureFixture):
             self.assertNotEqual(thumb_large, thumb_small)
             self.assertEqual(thumb_large.type, TTYPE2)
 
+    def test_thumbnail_not_locking_ok(self):
+        db_path = self.db.path
+        encoded = []
+
+        class CheckedScalePicture(ScalePicture):
+            def save(self, im: Image.Image, quality: int = None) -> bytes:
+                # another worker can write in the database while the thumbnails are encoded
+                with contextlib.closing(sqlite3.connect(str(db_path), timeout=0)) as connection:
+                    connection.execute('BEGIN IMMEDIATE')
+                    connection.rollback()
+
+                encoded.append(im.width)
+                return super().save(im, quality)
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+
+            thumbnailer = Thumbnailer(
+                self.root, self.target, session, thumb_types={'small': CheckedScalePicture(128, widths=[64, 256])})
+            thumbnailer.create_missing(picture, ['small'])
+
+            self.assertEqual(sorted(encoded), [64, 128, 256])
+            self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 3)
+            self.assertIsNotNone(thumbnailer.get_placeholder(picture))
+
+    def test_thumbnail_refresh_ok(self):
+        TTYPE = 'small_square'
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=self.thumb_types)
+
+            # created by another process (e.g., a worker)
+            with self.db.make_session() as other_session:
+                Thumbnailer(self.root, self.target, other_session, thumb_types=self.thumb_types).create_missing(
+                    picture, [TTYPE])
+
+            self.assertEqual(thumbnailer.get_missing(picture, TTYPE), [(None, None)])
+            self.assertIsNone(thumbnailer.get_placeholder(picture))
+
+            # the thumbnails and the placeholder are reloaded
+            thumbnailer.refresh(picture)
+            self.assertEqual(thumbnailer.get_missing(picture, TTYPE), [])
+            self.assertIsNotNone(thumbnailer.get_placeholder(picture))
+
     def test_thumbnail_delete_recreate_ok(self):
         TTYPE = 'small_square'
 
@@ -180,6 +378,157 @@ class ThumbnailerTestCase(GCTestCase, DispatchPictureFixture):
             self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 1)
             self.assertTrue(path.exists())
 
+    def test_thumbnail_widths_ok(self):
+        TTYPE = 'scaled'
+        thumb_types = {TTYPE: ScalePicture(128, widths=[256, 64, 128])}
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+
+            # all sizes are created at once
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+            thumb = thumbnailer.get_thumbnail(picture, TTYPE)
+            self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 3)
+            self.assertIsNone(thumb.variant)
+
+            srcset = thumbnailer.get_srcset(picture, TTYPE)
+            self.assertEqual([t.width for t in srcset], [64, 128, 256])
+            self.assertEqual([t.variant for t in srcset], [64, None, 256])
+            self.assertEqual(srcset[1], thumb)
+
+            for t in srcset:
+                self.assertTrue((self.target / t.path).exists())
+
+            # a deleted size is created again
+            path = self.target / srcset[0].path
+            path.unlink()
+
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+            self.assertEqual(thumbnailer.get_srcset(picture, TTYPE), srcset)
+            self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 3)
+            self.assertTrue(path.exists())
+
+            # a size which is not used anymore is ignored
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types={TTYPE: ScalePicture(128)})
+            self.assertEqual(thumbnailer.get_srcset(picture, TTYPE), [thumb])
+
+    def test_thumbnail_formats_ok(self):
+        TTYPE = 'scaled'
+        transformer = ScalePicture(128, widths=[256], formats=[{'format': 'WEBP', 'quality': 80, 'method': 6}])
+        thumb_types = {TTYPE: pickle.loads(pickle.dumps(transformer))}  # can be shipped to other processes
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+
+            # every format is created at once
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+            thumb = thumbnailer.get_thumbnail(picture, TTYPE)
+            self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 4)
+
+            sources = thumbnailer.get_sources(picture, TTYPE)
+            self.assertEqual([s[0] for s in sources], ['image/webp'])
+
+            webp_srcset = sources[0][1]
+            self.assertEqual([t.width for t in webp_srcset], [128, 256])
+            self.assertEqual([t.format for t in webp_srcset], ['WEBP', 'WEBP'])
+
+            for t, t_jpeg in zip(webp_srcset, thumbnailer.get_srcset(picture, TTYPE)):
+                with Image.open(self.target / t.path) as im:
+                    self.assertEqual(im.format, 'WEBP')
+                    self.assertEqual(im.size, (t_jpeg.width, t_jpeg.height))
+
+            self.assertEqual(thumbnailer.index().get_sources(picture, TTYPE), sources)
+            self.assertEqual(thumbnailer.get_thumbnail(picture, TTYPE), thumb)
+
+        # an unknown format is rejected
+        with self.assertRaises(ValueError):
+            ScalePicture(128, formats=[{'format': 'NOPE'}])
+
+    def test_thumbnail_quality_search_ok(self):
+        thumb_types = {
+            'budget': ScalePicture(256, encoder_options={'quality': 95, 'target_size': 8000}),
+            'error': ScalePicture(200, encoder_options={'quality': 95, 'max_error': 2}),
+        }
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+
+            # the best quality within the budget
+            thumb = thumbnailer.get_thumbnail(picture, 'budget')
+            self.assertLessEqual(thumb.size, 8000)
+            self.assertLess(thumb.quality, 95)
+
+            transformer = thumb_types['budget']
+            im = transformer.transform(transformer.open(self.root / picture.path))
+            self.assertGreater(len(transformer.save(im, thumb.quality + 1)), 8000)
+
+            # the smallest output within the error
+            thumb_error = thumbnailer.get_thumbnail(picture, 'error')
+            transformer = thumb_types['error']
+            with (self.target / thumb_error.path).open('rb') as f:
+                im_error = transformer.transform(transformer.open(self.root / picture.path))
+                self.assertLessEqual(transformer.get_error(im_error, f.read()), 2)
+
+            self.assertLess(thumb_error.quality, 95)
+            self.assertEqual(thumbnailer.searched, 2)
+            self.assertGreater(thumbnailer.bytes_saved, 0)
+
+            # the quality is stored, so it is not searched again
+            path = self.target / thumb.path
+            with path.open('rb') as f:
+                content = f.read()
+
+            path.unlink()
+
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+            self.assertEqual(thumbnailer.get_thumbnail(picture, 'budget'), thumb)
+            self.assertEqual(thumbnailer.searched, 0)
+
+            with path.open('rb') as f:
+                self.assertEqual(f.read(), content)
+
+        with self.assertRaises(ValueError):
+            ScalePicture(128, encoder_options={'target_size': 8000, 'max_error': 2})
+
+    def test_thumbnail_deep_zoom_ok(self):
+        thumb_types = {
+            'zoom': DeepZoomPicture(tile_size=64, min_megapixels=0.01),
+            'zoom_large_only': DeepZoomPicture(tile_size=128, min_megapixels=1000)
+        }
+
+        with self.db.make_session() as session:
+            picture = session.execute(Picture.select()).scalar_one()
+            thumbnailer = Thumbnailer(self.root, self.target, session, thumb_types=thumb_types)
+
+            # only above the threshold
+            self.assertIsNone(thumbnailer.get_optional_thumbnail(picture, 'zoom_large_only'))
+            self.assertIsNone(thumbnailer.get_optional_thumbnail(picture, 'gallery_small'))
+
+            thumb = thumbnailer.get_optional_thumbnail(picture, 'zoom')
+            self.assertIsNotNone(thumb)
+            self.assertTrue(thumb.path.endswith('.dzi'))
+            self.assertEqual(thumbnailer.index().get_optional_thumbnail(picture, 'zoom'), thumb)
+
+            with (self.target / thumb.path).open() as f:
+                self.assertIn('TileSize="64"', f.read())
+
+            # tiles: the last level is the picture at full resolution, and the first one is a single pixel
+            directory = (self.target / thumb.path).with_name(pathlib.Path(thumb.path).stem + '_files')
+            last_level = math.ceil(math.log2(max(thumb.width, thumb.height)))
+            self.assertEqual(sorted(int(p.name) for p in directory.iterdir()), list(range(last_level + 1)))
+
+            tiles = list((directory / str(last_level)).iterdir())
+            self.assertEqual(len(tiles), math.ceil(thumb.width / 64) * math.ceil(thumb.height / 64))
+
+            with Image.open(directory / str(last_level) / '1_1.jpg') as im:
+                self.assertEqual(im.size, (64 + 2, 64 + 2))  # overlap on both sides
+
+            with Image.open(directory / '0' / '0_0.jpg') as im:
+                self.assertEqual(im.size, (1, 1))
+
+            self.assertGreater(thumb.size, sum(p.stat().st_size for p in tiles))
+
 
 class UpdateTestCase(GCTestCase, DispatchPictureFixture):
     def setUp(self) -> None:
@@ -189,7 +538,561 @@ class UpdateTestCase(GCTestCase, DispatchPictureFixture):
         self.settings = settings.SETTINGS_BASE
         command_crawl(self.root, self.settings, self.db)
 
-        self.target = pathlib.Path(tempfile.mkdtemp())
+        self.target = self.make_temporary_directory()
 
     def test_update_ok(self):
         command_update(self.root, self.settings, self.db, self.target)
+
+    def test_bytecode_cache_ok(self):
+        directory = self.root / CONFIG_DIR_NAME / CACHE_DIR_NAME / 'jinja'
+        set_bytecode_cache(directory)
+
+        get_env().cache.clear()
+        get_env().get_template(TagView.template_name)
+        self.assertNotEqual(list(directory.iterdir()), [])
+
+    def test_style_cache_ok(self):
+        set_bytecode_cache(self.root / CONFIG_DIR_NAME / CACHE_DIR_NAME / 'jinja')  # (as during the update)
+
+        directory = self.root / CONFIG_DIR_NAME / CACHE_DIR_NAME / 'sass'
+        view = StyleView({}, cache_directory=directory)
+
+        css = view.render_content()
+        cached = list(directory.iterdir())
+        self.assertEqual(len(cached), 1)
+
+        with cached[0].open() as f:
+            self.assertEqual(f.read(), css)
+
+        # a hit does not compile
+        with cached[0].open('w') as f:
+            f.write('/* cached */')
+
+        self.assertEqual(StyleView({}, cache_directory=directory).render_content(), '/* cached */')
+
+    def test_update_incremental_ok(self):
+        command_update(self.root, self.settings, self.db, self.target)
+        # style, 7 tags, index, deep zoom viewer, search page, 7 shards of its index and a chunk of pictures
+        self.assertEqual(len(command_update.rendered), 19)
+
+        # nothing changed
+        command_update(self.root, self.settings, self.db, self.target)
+        self.assertEqual(command_update.rendered, [])
+
+        # add a picture in the first album (thus with the same date and focal tags as the one already in there)
+        new_pic = self.copy_to_temporary_directory('im1.JPEG', self.dirs[0] + '/im1_copy.jpg')
+        command_crawl(self.root, self.settings, self.db)
+        command_update(self.root, self.settings, self.db, self.target)
+
+        snapshot = command_update.snapshot
+        new_pic_index = next(
+            i for i, p in enumerate(snapshot.pictures) if p.path == str(new_pic.relative_to(self.root)))
+
+        # (the indices of the pictures changed, so the whole search index did)
+        search_urls = [str(view.get_url()) for view in search_views(command_update.common_context)]
+        tag_urls = [str(t.get_url()) for t in snapshot.tags() if new_pic_index in t.pictures]
+        self.assertEqual(sorted(command_update.rendered), sorted(tag_urls + ['index.html'] + search_urls))
+        self.assertEqual(len(command_update.rendered), 4 + 9)
+
+        # a deleted output is generated again
+        (self.target / 'index.html').unlink()
+        command_update(self.root, self.settings, self.db, self.target)
+        self.assertEqual(command_update.rendered, ['index.html'])
+
+        # without manifest, everything is rendered, but nothing is actually written
+        (self.root / CONFIG_DIR_NAME / DependencyManifest.MANIFEST_NAME).unlink()
+        command_update(self.root, self.settings, self.db, self.target)
+        self.assertEqual(len(command_update.rendered), 19)
+        self.assertEqual(command_update.writer.changed, [])
+
+    def test_update_tag_pages_ok(self):
+        tag_settings = copy.deepcopy(self.settings)
+        tag_settings['update_phase']['tag_pages'].update(page_size=1, fallback_pages=True)
+
+        command_update(self.root, tag_settings, self.db, self.target)
+
+        snapshot = command_update.snapshot
+        tag = next(t for t in snapshot.tags_per_cat['album'] if t.name == self.dirs[1])  # 2 pictures in there
+        pictures = snapshot.pictures_of(tag)
+        small_paths = [command_update.thumbnailer.get_thumbnail(p, 'gallery_small').path for p in pictures]
+
+        self.assertEqual(
+            [u for u in command_update.rendered if u.startswith('album/{}'.format(tag.slug))],
+            [str(tag.get_url()), str(tag.get_chunk_url(2)), str(tag.get_page_url(2))]
+        )
+
+        # the first picture is in the page, the second one is in the chunk
+        with (self.target / tag.get_url()).open() as f:
+            content = f.read()
+            self.assertIn(small_paths[0], content)
+            self.assertNotIn(small_paths[1], content)
+            self.assertIn('/{}'.format(tag.get_chunk_url(2)), content)
+            self.assertIn('/{}'.format(tag.get_page_url(2)), content)
+
+        with (self.target / tag.get_chunk_url(2)).open() as f:
+            chunk = json.load(f)
+            self.assertEqual(len(chunk), 1)
+            self.assertEqual(chunk[0]['src'], small_paths[1])
+            self.assertEqual(chunk[0]['caption'], pictures[1].get_caption())
+            self.assertEqual(chunk[0]['width'], 300)
+            self.assertIn(
+                command_update.thumbnailer.get_srcset(pictures[1], 'gallery_small')[-1].path, chunk[0]['srcset'])
+
+        with (self.target / tag.get_page_url(2)).open() as f:
+            self.assertIn(small_paths[1], f.read())
+
+    def test_thumbnail_jobs_ok(self):
+        # a picture which cannot be read anymore
+        with self.pic1.open('wb') as f:
+            f.write(b'not a picture')
+
+        command_update(self.root, self.settings, self.db, self.target)
+
+        with self.db.make_session() as session:
+            queue = ThumbnailJobQueue(session)
+            counts = queue.counts()
+            self.assertEqual(counts[ThumbnailJob.FAILED], 4)  # (it is a cover)
+            thumbnails_count = session.query(Thumbnail).count()
+
+            failed = session.scalars(select(ThumbnailJob).where(ThumbnailJob.state == ThumbnailJob.FAILED)).all()
+            path = str(self.pic1.relative_to(self.root))
+            picture = session.scalars(select(Picture).where(Picture.path == path)).one()
+            self.assertEqual(set(j.picture_id for j in failed), {picture.id})
+            self.assertTrue(all(j.error for j in failed))
+
+            # quarantined, so not on the pages
+            snapshot = Snapshot.load(self.root, session)
+            self.assertEqual(len(snapshot.pictures), 2)
+
+        # nothing is done again
+        command_update(self.root, self.settings, self.db, self.target)
+
+        with self.db.make_session() as session:
+            queue = ThumbnailJobQueue(session)
+            self.assertEqual(queue.counts(), counts)
+            self.assertEqual(session.query(Thumbnail).count(), thumbnails_count)
+
+            # a missing thumbnail is created again, by a worker
+            thumb = session.scalars(select(Thumbnail).where(Thumbnail.type == 'gallery_small')).first()
+            path = self.target / thumb.path
+            path.unlink()
+            queue.enqueue([(thumb.picture_id, 'gallery_small', 0)])
+            self.assertEqual(queue.counts()[ThumbnailJob.PENDING], 1)
+
+        command_thumbnail_worker(self.root, self.settings, self.db, self.target)
+        self.assertTrue(path.exists())
+
+        with self.db.make_session() as session:
+            self.assertNotIn(ThumbnailJob.PENDING, ThumbnailJobQueue(session).counts())
+
+    def test_thumbnail_jobs_optional_ok(self):
+        with self.db.make_session() as session:
+            picture_ids = session.scalars(select(Picture.id).order_by(Picture.id)).all()
+
+            queue = ThumbnailJobQueue(session, batch_size=10, optional_types=['deep_zoom'])
+            queue.enqueue([(picture_ids[0], 'deep_zoom', 0), (picture_ids[1], 'gallery_small', 0)])
+
+            for job in queue.claim():
+                queue.fail(job, MemoryError())
+
+            # only the picture whose required thumbnail failed is quarantined
+            self.assertEqual(queue.counts(), {ThumbnailJob.SKIPPED: 1, ThumbnailJob.FAILED: 1})
+
+            snapshot = Snapshot.load(self.root, session)
+            self.assertEqual(sorted(p.id for p in snapshot.pictures), [picture_ids[0], picture_ids[2]])
+
+            # nothing is attempted again, unless the picture changed ...
+            queue.enqueue([(picture_ids[0], 'deep_zoom', 0), (picture_ids[1], 'gallery_small', 0)])
+            self.assertEqual(queue.counts(), {ThumbnailJob.SKIPPED: 1, ThumbnailJob.FAILED: 1})
+
+            session.execute(
+                update(Picture).where(Picture.id == picture_ids[1]).values(date_obj_modified=datetime.datetime.now()))
+            queue.enqueue([])
+            self.assertEqual(queue.counts(), {ThumbnailJob.SKIPPED: 1, ThumbnailJob.PENDING: 1})
+
+            # ... or on request
+            queue.retry()
+            self.assertEqual(queue.counts(), {ThumbnailJob.PENDING: 2})
+
+    def test_fragment_cache_ok(self):
+        command_update(self.root, self.settings, self.db, self.target)
+
+        # each picture is rendered once, then reused by the other tags
+        self.assertEqual(command_update.fragment_cache.misses, 3)
+        self.assertEqual(command_update.fragment_cache.hits, 9 - 3)
+
+        with self.db.make_session() as session:
+            fragments = session.scalars(select(PictureFragment)).all()
+            self.assertEqual(len(fragments), 3)
+
+        with (self.target / 'album' / '{}.html'.format(self.dirs[0])).open() as f:
+            content = f.read()
+            self.assertTrue(any(fragment.html in content for fragment in fragments))
+
+        # ... and by the next builds
+        command_update(self.root, self.settings, self.db, self.make_temporary_directory())
+        self.assertEqual(command_update.fragment_cache.misses, 0)
+
+        # ... but not by another version
+        with unittest.mock.patch('gallery_generator.views.__version__', 'another'):
+            command_update(self.root, self.settings, self.db, self.make_temporary_directory())
+            self.assertEqual(command_update.fragment_cache.misses, 3)
+
+    def test_time_budget_ok(self):
+        command_update(self.root, self.settings, self.db, self.target, render_jobs=2, time_budget=0)
+
+        # no thumbnail, but stand-ins
+        thumbnails = list((self.target / Thumbnailer.THUMBNAIL_DIRECTORY).iterdir())
+        self.assertEqual(thumbnails, [self.target / MISSING_THUMBNAIL])
+
+        with (self.target / 'index.html').open() as f:
+            self.assertIn(str(MISSING_THUMBNAIL), f.read())
+
+        with self.db.make_session() as session:
+            queue = ThumbnailJobQueue(session, batch_size=100)
+            self.assertEqual(queue.counts(), {ThumbnailJob.PENDING: 3 * 2 + 3 * 2})  # (each picture is a cover)
+
+            # covers first (on the index, then for the social media cards), then the first pages
+            types = [job.type for job in queue.claim()]
+            self.assertEqual(types[:6], ['tag_thumbnail'] * 3 + ['social_media_card'] * 3)
+            self.assertEqual(types[6:], ['gallery_small'] * 3 + ['gallery_large'] * 3)
+
+            for job in queue.claim():
+                queue.release(job)
+
+        # the next run goes on
+        command_update(self.root, self.settings, self.db, self.target)
+
+        with (self.target / 'index.html').open() as f:
+            self.assertNotIn(str(MISSING_THUMBNAIL), f.read())
+
+    def test_thumbnail_jobs_priority_ok(self):
+        index_settings = copy.deepcopy(self.settings)
+        index_settings['update_phase']['page_context']['index_categories_to_show'] = ['album']
+
+        command_update(self.root, index_settings, self.db, self.target, time_budget=0)
+        snapshot = command_update.snapshot
+        covers = set(snapshot.cover(tag).id for tag in snapshot.tags_per_cat['album'])
+
+        with self.db.make_session() as session:
+            first = session.execute(
+                select(ThumbnailJob.picture_id, ThumbnailJob.type).where(ThumbnailJob.priority == 0)).all()
+
+            jobs = ThumbnailJobQueue(session, batch_size=100).claim()
+
+        # only the covers which are on the index come first (not the ones of the dates, which are not)
+        self.assertLess(len(covers), len(set(snapshot.cover(tag).id for tag in snapshot.tags())))
+        self.assertEqual(set(first), set((picture_id, 'tag_thumbnail') for picture_id in covers))
+        self.assertEqual(set((job.picture_id, job.type) for job in jobs[:len(covers)]), set(first))
+
+        # (which are the only ones which get a `tag_thumbnail`)
+        self.assertEqual(set(job.picture_id for job in jobs if job.type == 'tag_thumbnail'), covers)
+        self.assertEqual([job.type for job in jobs][-6:], ['gallery_small'] * 3 + ['gallery_large'] * 3)
+
+    def test_thumbnail_jobs_lease_ok(self):
+        with self.db.make_session() as session:
+            picture = session.scalars(select(Picture)).first()
+
+            queue = ThumbnailJobQueue(session, batch_size=1, lease=-1, max_attempts=2)
+            queue.enqueue([(picture.id, 'gallery_small', 0)])
+
+            # a worker which does not finish in time (e.g., it crashed) loses the job
+            job = queue.claim()[0]
+            self.assertEqual(ThumbnailJobQueue(session, lease=-1).claim()[0].id, job.id)
+
+            queue.complete(job)  # (too late)
+            self.assertEqual(queue.counts(), {ThumbnailJob.CLAIMED: 1})
+
+            # ... until it is quarantined
+            self.assertEqual(queue.claim(), [])
+            self.assertEqual(queue.counts(), {ThumbnailJob.FAILED: 1})
+
+    def test_update_fingerprint_ok(self):
+        fingerprint_settings = copy.deepcopy(self.settings)
+        fingerprint_settings['update_phase']['output']['fingerprint'] = True
+
+        command_update(self.root, fingerprint_settings, self.db, self.target)
+
+        style_url = command_update.assets['style.css']
+        self.assertRegex(style_url, r'^style\.[0-9a-f]{10}\.css$')
+        self.assertTrue((self.target / style_url).exists())
+        self.assertFalse((self.target / 'style.css').exists())
+
+        with (self.target / 'index.html').open() as f:
+            self.assertIn('href="/{}"'.format(style_url), f.read())
+
+        for thumb in command_update.thumbnailer.thumbnails.values():
+            self.assertRegex(thumb.path, r'\.[0-9a-f]{10}\.[A-Za-z]+$')
+
+        # cache rules
+        for url in ('_headers', '.htaccess'):
+            with (self.target / url).open() as f:
+                self.assertIn('/{}'.format(style_url), f.read())
+
+        # the location of the style is kept when nothing changed
+        command_update(self.root, fingerprint_settings, self.db, self.target)
+        self.assertEqual(command_update.rendered, [])
+        self.assertEqual(command_update.assets['style.css'], style_url)
+
+    def test_update_render_jobs_ok(self):
+        command_update(self.root, self.settings, self.db, self.target)
+        serial_rendered = command_update.rendered
+
+        target_parallel = self.make_temporary_directory()
+        command_update(self.root, self.settings, self.db, target_parallel, render_jobs=2)
+        self.assertEqual(command_update.rendered, serial_rendered)  # same order
+
+        # the pictures rendered by the workers are counted as well (each worker has its own cache)
+        self.assertEqual(command_update.fragment_cache.hits + command_update.fragment_cache.misses, 9)
+
+        for url in serial_rendered:
+            with (self.target / url).open('rb') as f, (target_parallel / url).open('rb') as fp:
+                self.assertEqual(f.read(), fp.read())
+
+    def test_update_output_format_ok(self):
+        command_update(self.root, self.settings, self.db, self.target)
+
+        # same outputs as in a directory
+        archives = self.make_temporary_directory()
+        path = archives / 'site.tar'
+        command_update(self.root, self.settings, self.db, path, output_format='tar')
+
+        with tarfile.open(path) as archive:
+            for member in archive.getmembers():
+                with (self.target / member.name).open('rb') as f:
+                    self.assertEqual(archive.extractfile(member).read(), f.read())
+
+            self.assertEqual(
+                len(archive.getmembers()), len([p for p in self.target.glob('**/*') if p.is_file()]))
+
+        # nothing is rendered again, and the outputs are copied from the previous archive
+        command_update(self.root, self.settings, self.db, path, output_format='tar')
+        self.assertEqual(command_update.rendered, [])
+        self.assertEqual(command_update.writer.changed, [])
+
+        with tarfile.open(path) as archive:
+            self.assertEqual(len(archive.getmembers()), len(command_update.writer.previous))
+
+        # in parallel, the outputs are written by the main process
+        path = archives / 'site.objects'
+        command_update(self.root, self.settings, self.db, path, render_jobs=2, output_format='objects')
+
+        for url in command_update.rendered:
+            with (self.target / url).open('rb') as f, \
+                    command_update.writer.get_object_path(command_update.writer.objects[url]).open('rb') as fo:
+                self.assertEqual(f.read(), fo.read())
+
+    def test_output_manifest_ok(self):
+        command_update(self.root, self.settings, self.db, self.target)
+
+        manifest = command_update.output_manifest
+        files = sorted(p.relative_to(self.target).as_posix() for p in self.target.glob('**/*') if p.is_file())
+        self.assertEqual(sorted(manifest.current), files)
+        self.assertEqual(manifest.added, files)
+
+        with (self.target / 'index.html').open('rb') as f:
+            content = f.read()
+            self.assertEqual(manifest.current['index.html']['size'], len(content))
+            self.assertEqual(manifest.current['index.html']['sha256'], hashlib.sha256(content).hexdigest())
+
+        # a file which is written again, with the same content, did not change
+        thumbnail = next(url for url in files if url.startswith('thumbs/'))
+        (self.target / thumbnail).unlink()
+        (self.target / 'old.html').write_text('old')
+
+        renamed_settings = copy.deepcopy(self.settings)
+        renamed_settings['update_phase']['page_context']['site_name'] = 'Another name'
+
+        delta = self.make_temporary_directory()
+        command_update(self.root, renamed_settings, self.db, self.target, export_delta=delta)
+
+        manifest = command_update.output_manifest
+        self.assertEqual(manifest.added, ['old.html'])
+        self.assertEqual(manifest.changed, sorted(command_update.rendered))
+        self.assertNotIn(thumbnail, manifest.changed)
+
+        # only those are exported
+        self.assertEqual(
+            sorted(p.relative_to(delta).as_posix() for p in delta.glob('**/*') if p.is_file()),
+            sorted(['delta.json', 'old.html'] + manifest.changed)
+        )
+
+        (self.target / 'old.html').unlink()
+
+        command_update(self.root, renamed_settings, self.db, self.target, export_delta=delta)
+        self.assertEqual(command_update.output_manifest.removed, ['old.html'])
+
+        with (delta / 'delta.json').open() as f:
+            self.assertEqual(json.load(f), {'added': [], 'changed': [], 'removed': ['old.html']})
+
+    def test_search_index_ok(self):
+        self.assertEqual(encode_ids([3, 4, 5, 6, 10]), [4, -3, 4])
+        for ids in [[], [0], [0, 1, 2], [1, 2, 5, 6, 7, 9]]:
+            self.assertEqual(decode_ids(encode_ids(ids)), ids)
+
+        # every token is in the shard whose prefix is the longest one it starts with
+        tokens = dict(('{}:{}'.format(field, i), [i]) for field in ['album', 'aperture', 'iso'] for i in range(4))
+        shards = shard_tokens(tokens, max_size=5)
+        self.assertEqual([prefix for prefix, _ in shards], ['al', 'ap', 'i'])
+        for token in tokens:
+            prefix = max((p for p, _ in shards if token.startswith(p)), key=len)
+            self.assertIn(token, dict(shards)[prefix])
+
+        command_update(self.root, self.settings, self.db, self.target)
+        self.assertTrue((self.target / 'search.html').exists())
+
+        with (self.target / 'search.html').open() as f:
+            search = json.loads(re.search("data-search='([^']*)'", f.read()).group(1))
+
+        with (self.target / search['shards']['a'].lstrip('/')).open() as f:
+            ids = decode_ids(json.load(f)['album:{}'.format(self.dirs[0])])
+
+        with (self.target / search['chunk'].format(0).lstrip('/')).open() as f:
+            chunk = json.load(f)
+
+        self.assertEqual(len(chunk), search['pictures'])
+        snapshot = command_update.snapshot
+        tag = next(tag for tag in snapshot.tags_per_cat['album'] if tag.name == self.dirs[0])
+        self.assertEqual(ids, list(tag.pictures))
+        for i in ids:
+            self.assertTrue((self.target / chunk[i]['src']).exists())
+
+
+class SnapshotTestCase(GCTestCase, DispatchPictureFixture):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.dispatch_pics()
+        self.settings = settings.SETTINGS_BASE
+        command_crawl(self.root, self.settings, self.db)
+
+    def test_snapshot_ok(self):
+        with self.db.make_session() as session:
+            snapshot = Snapshot.load(self.root, session)
+            self.assertEqual(len(session.identity_map), 0)  # no ORM object is kept
+
+        self.assertEqual(len(snapshot.pictures), 3)
+        dates = [p.exif_datetime_original for p in snapshot.pictures]
+        self.assertEqual(dates, sorted(dates))
+
+        self.assertEqual(len(list(snapshot.tags())), 7)
+
+        for category_slug, tags in snapshot.tags_per_cat.items():
+            # most recent first
+            covers = [snapshot.cover(t).exif_datetime_original for t in tags]
+            self.assertEqual(covers, sorted(covers, reverse=True))
+
+            for tag in tags:
+                self.assertEqual(tag.category.slug, category_slug)
+                self.assertEqual(tag.display_name, tag.name)
+
+        album = dict((t.name, t) for t in snapshot.tags_per_cat['album'])
+        self.assertEqual(
+            sorted(p.path for p in snapshot.pictures_of(album[self.dirs[1]])),
+            sorted(str(p.relative_to(self.root)) for p in [self.pic2, self.pic3])
+        )
+
+    def test_snapshot_picklable_ok(self):
+        with self.db.make_session() as session:
+            snapshot = Snapshot.load(self.root, session)
+
+        unpickled = pickle.loads(pickle.dumps(snapshot))
+
+        self.assertEqual(unpickled.pictures, snapshot.pictures)
+        self.assertEqual(unpickled.categories, snapshot.categories)
+        self.assertEqual(unpickled.tags_per_cat, snapshot.tags_per_cat)
+
+
+class CrawlUpdateTestCase(GCTestCase, DispatchPictureFixture):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.dispatch_pics()
+        self.settings = settings.SETTINGS_BASE
+        self.target = self.make_temporary_directory()
+
+    def test_crawl_update_ok(self):
+        command_crawl_update(self.root, self.settings, self.db, self.target, queue_size=1)
+
+        with self.db.make_session() as session:
+            self.assertEqual(session.query(Picture).count(), 3)
+
+            # the thumbnails of the pictures were created by the pipeline
+            for ttype in ('gallery_small', 'gallery_large'):
+                self.assertEqual(session.query(Thumbnail).filter(Thumbnail.type == ttype).count(), 3 * 4)
+
+        # same result as crawling, then updating
+        other_target = self.make_temporary_directory()
+        command_update(self.root, self.settings, self.db, other_target)
+
+        outputs = sorted(p.relative_to(self.target) for p in self.target.glob('**/*'))
+        self.assertEqual(outputs, sorted(p.relative_to(other_target) for p in other_target.glob('**/*')))
+
+        # removed pictures
+        self.pic1.unlink()
+        command_crawl_update(self.root, self.settings, self.db, self.target)
+
+        with self.db.make_session() as session:
+            self.assertEqual(session.query(Picture).count(), 2)
+
+    def test_crawl_update_quarantine_ok(self):
+        # a picture whose infos can be read, but not its content
+        with (self.tests_files_directory / 'im1.JPEG').open('rb') as f:
+            content = f.read()
+
+        with self.pic1.open('wb') as f:
+            f.write(content[:len(content) // 2])
+
+        command_crawl_update(self.root, self.settings, self.db, self.target)
+
+        with self.db.make_session() as session:
+            self.assertEqual(ThumbnailJobQueue(session).counts()[ThumbnailJob.FAILED], 2)  # (both types)
+
+        # the others are there
+        self.assertEqual(len(command_update.snapshot.pictures), 2)
+        self.assertTrue((self.target / 'index.html').exists())
+
+    def test_crawl_update_time_budget_ok(self):
+        command_crawl_update(self.root, self.settings, self.db, self.target, time_budget=0)
+
+        # the pipeline did not create any thumbnail either, the jobs are left for the next run
+        with self.db.make_session() as session:
+            self.assertEqual(session.execute(Thumbnail.count()).scalar_one(), 0)
+            self.assertEqual(ThumbnailJobQueue(session).counts(), {ThumbnailJob.PENDING: 3 * 2 + 3 * 2})
+
+        with (self.target / 'index.html').open() as f:
+            self.assertIn(str(MISSING_THUMBNAIL), f.read())
+
+        # the next run goes on
+        command_crawl_update(self.root, self.settings, self.db, self.target)
+
+        with self.db.make_session() as session:
+            self.assertEqual(ThumbnailJobQueue(session).counts(), {ThumbnailJob.DONE: 3 * 2 + 3 * 2})
+
+    def test_pipeline_failure_ok(self):
+        def produce(_):
+            yield from range(100)
+
+        def fail(items):
+            for item in items:
+                if item == 5:
+                    raise ValueError(item)
+                yield item
+
+        consumed = []
+
+        def consume(items):
+            for item in items:
+                consumed.append(item)
+                yield item
+
+        with self.assertRaises(ValueError):
+            Pipeline([produce, fail, consume], queue_size=2).run()
+
+        # the other stages stopped
+        self.assertLessEqual(len(consumed), 5)
+        self.assertEqual(consumed, list(range(len(consumed))))
+
+    def test_batched_ok(self):
+        self.assertEqual(list(batched(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batched([], 2)), [])